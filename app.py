@@ -1,71 +1,396 @@
 import streamlit as st
 import pandas as pd
+import functools
 from datetime import datetime
-import requests
-from requests.auth import HTTPBasicAuth
-import time
-from PyPDF2 import PdfMerger, PdfReader, PdfWriter
 import tempfile
+import html
 import os
-
-def parse_page_ranges(input_str):
-    try:
-        page_numbers = set()
-        for part in input_str.split(','):
-            part = part.strip()
-            if '-' in part:
-                start, end = map(int, part.split('-'))
-                if start > end:
-                    return None
-                page_numbers.update(range(start, end + 1))
-            else:
-                page_numbers.add(int(part))
-        return sorted(page_numbers)
-    except ValueError:
-        return None
-
-def split_pdf(file_row, page_numbers):
+import shutil
+import urllib.parse
+import requests
+from concurrent.futures import wait
+
+import core
+import optimize as optimizer
+import zamzar
+from attachments import ATTACHMENT_LABELS, ATTACHMENTS_CONVERT, ATTACHMENTS_ONLY, split_emails
+from cache import ConversionCache, link_or_copy
+from core import (
+    EMAIL_TYPES,
+    ConversionError,
+    MergeError,
+    RangeError,
+    SelectionError,
+    SplitError,
+    bookmark_groups,
+    burst_groups,
+    converted_name,
+    is_email,
+    page_count,
+    parse_page_ranges,
+    parse_range_groups,
+    parse_selection,
+    split_pdf_groups,
+    unique_path,
+    zip_files,
+)
+from converters import CONVERTER_LABELS, CONVERTER_LOCAL, CONVERTER_ZAMZAR, get_converter
+from instrumentation import RunMetrics, emit
+from jobs import DEFAULT_JOB_SWEEP_INTERVAL, FAILED, QUEUED, UNFINISHED, WAITING, JobRunner
+from metadata import MetadataIndex
+from registry import FileRegistry
+from storage import DEFAULT_SWEEP_INTERVAL, StorageManager, StorageQuotaError
+
+def split_pdf(file_row, page_numbers, metrics=None):
     try:
         # Get the PDF file path
         temp_file_path = file_row['Temp File Path']
         if not temp_file_path or not os.path.exists(temp_file_path):
-            # If temp file does not exist, create it from the uploaded file
-            uploaded_file = file_row.get('Data', None)
-            if uploaded_file is not None:
-                temp_file_path = os.path.join(st.session_state.temp_dir.name, file_row['File Name'])
-                with open(temp_file_path, 'wb') as pdf_file:
-                    pdf_file.write(uploaded_file.getvalue())
-            else:
-                st.error(f"No data found for PDF file {file_row['File Name']}")
-                return None
-
-        # Read the PDF
-        with open(temp_file_path, 'rb') as pdf_file:
-            pdf_reader = PdfReader(pdf_file)
-            pdf_writer = PdfWriter()
-
-            # Adjust page numbers to zero-based indexing
-            max_page_number = len(pdf_reader.pages)
-            selected_pages = [p - 1 for p in page_numbers if 1 <= p <= max_page_number]
-            if not selected_pages:
-                st.error("No valid page numbers selected.")
-                return None
-
-            # Create a new PDF with selected pages
-            for page_num in selected_pages:
-                pdf_writer.add_page(pdf_reader.pages[page_num])
-
-            # Write the output PDF
-            output_pdf_name = f"split_{file_row['File Name']}"
-            output_pdf_path = os.path.join(st.session_state.temp_dir.name, output_pdf_name)
-            with open(output_pdf_path, 'wb') as out_pdf_file:
-                pdf_writer.write(out_pdf_file)
-
-            return output_pdf_path
+            st.error(f"No data found for PDF file {file_row['File Name']}")
+            return None
+
+        output_pdf_name = f"split_{file_row['File Name']}"
+        output_dir = new_artifact_dir(os.path.getsize(temp_file_path))
+        output_pdf_path = os.path.join(output_dir, output_pdf_name)
+        return core.split_pdf(temp_file_path, page_numbers, output_pdf_path, metrics=metrics)
+    except (SplitError, StorageQuotaError) as e:
+        st.error(str(e))
+        return None
     except Exception as e:
         st.error(f"An error occurred while splitting the PDF: {e}")
         return None
 
+# Image resolutions offered by the optimization pass; None keeps images as they are
+IMAGE_DPI_CHOICES = [None, 300, 150, 96]
+
+def optimize_options(key):
+    # Returns (optimize, image_dpi) for the optional pass that shrinks an output
+    optimize = st.checkbox(
+        'Optimize output size (shared fonts and images stored once, uncompressed content compressed)',
+        key=f'{key}_optimize'
+    )
+    image_dpi = None
+    if optimize and optimizer.Image is not None:
+        image_dpi = st.selectbox(
+            'Downsample images to:',
+            IMAGE_DPI_CHOICES,
+            format_func=lambda dpi: 'Keep full resolution' if dpi is None else f'{dpi} DPI',
+            key=f'{key}_image_dpi'
+        )
+    return optimize, image_dpi
+
+def describe_optimization(before, after, seconds):
+    saved = 100 * (before - after) / before if before else 0
+    return (f"Optimized: {before / 1024:,.1f} KB → {after / 1024:,.1f} KB "
+            f"({saved:.0f}% smaller) in {seconds:.2f} s")
+
+def optimize_outputs(paths, image_dpi, run_metrics):
+    # Optimize each output in place and show the total size change
+    before = after = 0
+    seconds = 0.0
+    with st.spinner("Optimizing output..."):
+        for path in paths:
+            try:
+                size_before, size_after = core.optimize_output(path, image_dpi=image_dpi, metrics=run_metrics)
+            except MergeError as e:
+                # The output is still usable, just not smaller
+                st.warning(f"{e}; the file is kept as it was.")
+                continue
+            before += size_before
+            after += size_after
+            seconds += run_metrics.stages[-1].seconds
+    if before:
+        st.caption(describe_optimization(before, after, seconds))
+
+SPLIT_SINGLE = 'One PDF'
+SPLIT_RANGE_SETS = 'Several range sets'
+SPLIT_EVERY_N = 'Every N pages'
+SPLIT_BOOKMARKS = 'One PDF per bookmark'
+SPLIT_MODES = [SPLIT_SINGLE, SPLIT_RANGE_SETS, SPLIT_EVERY_N, SPLIT_BOOKMARKS]
+
+def split_many(file_row, split_mode):
+    source_path = file_row['Temp File Path']
+    if split_mode == SPLIT_RANGE_SETS:
+        range_sets_input = st.text_input(
+            "Enter one page range set per output, separated by ';' (e.g., '1-3; 4, 6; 7-'): ",
+            key='range_sets_input'
+        )
+        if not range_sets_input:
+            st.info("Please enter the page range sets to extract.")
+            return
+    elif split_mode == SPLIT_EVERY_N:
+        every = st.number_input('Pages per output file:', min_value=1, value=1, step=1, key='split_every')
+    optimize, image_dpi = optimize_options('split_many')
+
+    if not st.button('Split and Download All'):
+        return
+
+    if split_mode == SPLIT_RANGE_SETS:
+        try:
+            groups = parse_range_groups(range_sets_input, page_count(source_path))
+        except RangeError as e:
+            st.error(str(e))
+            return
+    elif split_mode == SPLIT_EVERY_N:
+        groups = burst_groups(page_count(source_path), int(every))
+    else:
+        groups = bookmark_groups(source_path)
+        if not groups:
+            st.error("This PDF has no bookmarks to split by.")
+            return
+
+    try:
+        # Room for the outputs and the zip holding them
+        output_dir = new_artifact_dir(2 * os.path.getsize(source_path))
+    except StorageQuotaError as e:
+        st.error(str(e))
+        return
+    base_name = os.path.splitext(file_row['File Name'])[0]
+    run_metrics = RunMetrics('split', mode=split_mode, outputs=len(groups))
+    try:
+        with st.spinner(f"Writing {len(groups)} PDF files..."):
+            output_paths = split_pdf_groups(
+                source_path, groups, output_dir, base_name, max_workers=os.cpu_count() or 1,
+                metrics=run_metrics
+            )
+    except Exception as e:
+        st.error(f"An error occurred while splitting the PDF: {e}")
+        report_run(run_metrics)
+        return
+    if optimize:
+        optimize_outputs(output_paths, image_dpi, run_metrics)
+
+    zip_name = f"split_{base_name}.zip"
+    zip_path = zip_files(output_paths, os.path.join(output_dir, zip_name), metrics=run_metrics)
+    for path in output_paths + [zip_path]:
+        st.session_state.temp_dir.share(path)
+    report_run(run_metrics)
+    st.success(f"{len(output_paths)} PDF files are ready!")
+    download_output("Download All (zip)", zip_path, zip_name, "application/zip",
+                    storage=st.session_state.temp_dir)
+
+# How long a rerun waits for background metadata before showing the table
+METADATA_WAIT_SECONDS = 2
+
+@st.cache_resource
+def get_metadata_index():
+    # One background parser and result cache shared by every session on this server
+    return MetadataIndex()
+
+def get_file_metadata(file_name):
+    # Future for a file's FileMetadata, submitting it to the index the first time
+    record = st.session_state.registry.get(file_name)
+    if record.metadata is None:
+        record.metadata = get_metadata_index().submit(record.path, record.name, record.sha256)
+    return record.metadata
+
+def describe_file(file_name):
+    future = get_file_metadata(file_name)
+    if not future.done():
+        return {'Pages': None, 'Size (KB)': None, 'Status': 'Reading...', 'Email': ''}
+    metadata = future.result()
+    email_summary = ' - '.join(
+        value for value in (metadata.headers.get('From'), metadata.headers.get('Subject')) if value
+    )
+    return {
+        'Pages': metadata.page_count,
+        'Size (KB)': round(metadata.size / 1024, 1),
+        'Status': metadata.status,
+        'Email': email_summary,
+    }
+
+def report_run(run_metrics, status=None):
+    # Log the finished run and show where its time went
+    emit(run_metrics, status)
+    show_run_summary(run_metrics.as_dict())
+
+def show_run_summary(summary):
+    with st.expander(f"Run summary: {summary['seconds']:.2f} s ({summary['status']})"):
+        if summary['stages']:
+            st.dataframe(pd.DataFrame(summary['stages']).set_index('stage'))
+        st.caption(f"Run {summary['run_id']}: " + ', '.join(
+            f"{name.replace('_', ' ')} {value}" for name, value in summary['totals'].items() if value
+        ))
+
+@st.cache_resource
+def get_conversion_cache():
+    # One cache instance shared by every session on this server
+    return ConversionCache()
+
+# How often the page checks on a running background job
+JOB_POLL_SECONDS = 1
+
+@st.cache_resource
+def get_job_runner():
+    # One job queue for every session, so the concurrency limit is server-wide
+    return JobRunner(cache=get_conversion_cache(), sweep_interval=DEFAULT_JOB_SWEEP_INTERVAL)
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def poll_job(job_id):
+    # Redraws only this part of the page until the job stops running
+    state = get_job_runner().get(job_id)
+    if state is None or state['status'] not in UNFINISHED:
+        st.rerun()
+
+    emails = [i['name'] for i in state['inputs'] if is_email(i['name'])]
+    converted = sum(1 for name in emails if name in state['converted'])
+    if state['status'] == QUEUED:
+        st.info("Waiting for other jobs on the server to finish...")
+    if emails:
+        st.progress(converted / len(emails))
+        st.text(f"Converted {converted} out of {len(emails)} email files")
+    for event in state['events'][-5:]:
+        st.write(event)
+
+def show_job(job_id):
+    state = get_job_runner().get(job_id)
+    if state is None:
+        st.warning("That job is no longer available; its files have been cleaned up.")
+        forget_job()
+        return
+
+    st.subheader("Convert and combine job")
+    if state['status'] == WAITING:
+        st.warning(state['message'])
+        api_key = st.text_input('Zamzar API key:', type='password', key='resume_api_key')
+        if st.button('Resume Job') and api_key:
+            get_job_runner().resume(job_id, api_key)
+            st.rerun()
+        return
+    if state['status'] in UNFINISHED:
+        poll_job(job_id)
+        return
+
+    if state['poll_stats']:
+        # Per-job polling statistics, useful for tuning the poll policy
+        with st.expander("Conversion polling statistics"):
+            st.dataframe(pd.DataFrame(state['poll_stats']))
+    cache_stats = get_conversion_cache().stats()
+    st.caption(
+        f"Conversion cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+        f"{cache_stats['entries']} entries ({cache_stats['bytes'] / 1024 ** 2:.1f} MB)"
+    )
+    if state.get('optimized'):
+        st.caption(describe_optimization(**state['optimized']))
+    if state['metrics']:
+        show_run_summary(state['metrics'])
+    if state['status'] == FAILED:
+        st.error(state['message'])
+        if st.button('Dismiss'):
+            forget_job()
+            st.rerun()
+        return
+
+    # Provide a download link
+    st.success("Combined PDF is ready!")
+    download_output("Download Combined PDF", state['output'], state['output_name'], "application/pdf")
+
+    # Downloading no longer reruns the script, so finishing up is a separate step
+    if st.button('Done', help="Replace the emails in the file list with their converted PDFs and start over"):
+        # Replace the '.eml' and '.msg' files with their converted '.pdf' versions
+        registry = st.session_state.registry
+        converted = [(file_name, path) for file_name, path in state['converted'].items() if file_name in registry]
+        try:
+            kept_paths = keep_job_files([path for _, path in converted])
+        except StorageQuotaError as e:
+            st.error(f"The converted PDFs were not added to the file list: {e}")
+            kept_paths = []
+            converted = []
+        for (file_name, _), path in zip(converted, kept_paths):
+            registry.replace(file_name, converted_name(file_name), path)
+
+        # Clear the previous user input and action
+        st.session_state.user_input = ''
+        st.session_state.action_selected = None
+        forget_job()
+
+        # Rerun the app to reflect changes
+        st.rerun()
+
+# Download links live in the app's static folder, which Streamlit serves when
+# server.enableStaticServing is set (see .streamlit/config.toml). Keep
+# EMLPDF_STORAGE_DIR and EMLPDF_JOBS_DIR on the same filesystem as the app, so
+# the links are hard links rather than copies.
+DOWNLOADS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'downloads')
+DOWNLOADS_URL = 'app/static/downloads/'
+
+# Streamlit's static route refuses larger files, so those get a download button
+STATIC_FILE_LIMIT = 200 * 1024 ** 2
+
+@st.cache_resource
+def get_storage():
+    # One storage manager for every session, so quotas and sweeping are server-wide
+    downloads_dir = DOWNLOADS_DIR if st.get_option('server.enableStaticServing') else None
+    return StorageManager(sweep_interval=DEFAULT_SWEEP_INTERVAL, downloads_dir=downloads_dir)
+
+def new_artifact_dir(nbytes):
+    # A directory for one run's intermediate files, after making room for about
+    # `nbytes`; raises StorageQuotaError if there is no room
+    storage = st.session_state.temp_dir
+    storage.reserve(nbytes)
+    return storage.artifact_dir()
+
+def keep_job_files(paths):
+    # The session's own copies of files from a job directory, which is swept
+    # some time after the job finishes
+    storage = st.session_state.temp_dir
+    storage.reserve(sum(os.path.getsize(path) for path in paths))
+    directory = tempfile.mkdtemp(dir=storage.name)
+    used_paths = set()
+    kept_paths = []
+    for path in paths:
+        kept_path = link_or_copy(path, unique_path(os.path.join(directory, os.path.basename(path)), used_paths))
+        storage.share(kept_path)
+        kept_paths.append(kept_path)
+    return kept_paths
+
+def discard_scratch(attachments_dir):
+    # Stripped email bodies are only needed until the job has its own copies,
+    # and the directory itself only while it holds listed attachments
+    shutil.rmtree(os.path.join(attachments_dir, 'bodies'), ignore_errors=True)
+    try:
+        os.rmdir(attachments_dir)
+    except OSError:
+        pass
+
+def read_output(path, storage=None):
+    # Called by a download button only when it is clicked, never on a rerun
+    if storage is not None:
+        # A download is a use, so the artifact is evicted after ones nobody fetched
+        storage.use(os.path.dirname(path))
+    with open(path, 'rb') as f:
+        return f.read()
+
+def download_output(label, path, file_name, mime, storage=None):
+    # Pass the session's storage when `path` is in one of its artifact
+    # directories; being shown counts as a use, so it is evicted after ones
+    # that are not. With static serving the browser fetches a download link
+    # straight from disk, and the file never passes through the server's memory.
+    if storage is not None:
+        storage.use(os.path.dirname(path))
+    manager = get_storage()
+    if manager.downloads_dir and os.path.getsize(path) <= STATIC_FILE_LIMIT:
+        url = DOWNLOADS_URL + urllib.parse.quote(manager.publish(path, file_name))
+        st.markdown(
+            f'<a href="{url}" download="{html.escape(file_name)}" type="{mime}">{html.escape(label)}</a>',
+            unsafe_allow_html=True
+        )
+        return
+    # Otherwise the file stays on disk until the button is clicked, and clicking
+    # does not rerun the script, so the button (and its file) are still there to
+    # serve it; it is read into memory only then.
+    return st.download_button(
+        label=label,
+        data=functools.partial(read_output, path, storage),
+        file_name=file_name,
+        mime=mime,
+        on_click='ignore'
+    )
+
+def forget_job():
+    st.session_state.job_id = None
+    st.query_params.pop('job', None)
+
 def main():
     # Set the title of the app
     st.title('Email Conversion and PDF Manipulation App')
@@ -77,37 +402,53 @@ def main():
     1. **Upload Files:**
        - Use the file uploader below to upload your EML, MSG, and PDF files.
        - You can select multiple files at once.
-       - Duplicate files will be ignored.
+       - Files whose content is already listed are ignored, whatever their name; a different file with an existing name is listed with a number added (e.g., 'report (2).pdf').
 
     2. **Select an Action:**
        - **Combine PDFs:**
          - Click on the 'Combine PDFs' button.
          - Enter the indices of the files you want to combine in a comma-separated list with either the index of the specific file or with a range of indices. (e.g., '1, 2-4').
-         - If you include EML or MSG files, you will need to provide your Zamzar API key for conversion. If the user does not already have a key, they can sign up for a free one at [THIS LINK](https://developers.zamzar.com/signup?plan=test)—includes 100 free conversions per month, after which the user can either pay or use a new email to generate another key. If the selected files do not include a .eml/.msg attatchement, the user can substitute any text for the API key to continue combining PDFs as normal.
-         - Click 'Convert and Combine Selected Files' to start the process.
+         - If you include EML or MSG files, choose how they are converted: locally on the server (no API key or network needed), through Zamzar, or locally with Zamzar as a fallback for emails that cannot be rendered locally, such as ones with characters outside Western European fonts.
+         - Choose what happens to the emails' attachments: convert them along with the email, merge the attached PDFs (and optionally images, one per page) directly after the converted email body, or merge only the attached PDFs and skip the email itself. Extracted attachments are added to the file list.
+         - When Zamzar is used, you will need to provide your Zamzar API key for conversion. If the user does not already have a key, they can sign up for a free one at [THIS LINK](https://developers.zamzar.com/signup?plan=test)—includes 100 free conversions per month, after which the user can either pay or use a new email to generate another key. If the selected files do not include a .eml/.msg attatchement, the user can substitute any text for the API key to continue combining PDFs as normal.
+         - Tick 'Optimize output size' to store fonts and images shared between files only once and compress uncompressed content; images can also be downsampled to a chosen resolution. This is also offered when splitting.
+         - Click 'Convert and Combine Selected Files' to start the process. The job runs in the background on the server: you can keep using the page or reload it, and the job's progress and result stay available at the same address.
        - **Split PDF:**
          - Click on the 'Split PDF' button.
          - Enter the index of the PDF file you want to split.
          - Specify the page numbers or ranges in the same manner as above to include in the new PDF (e.g., '1, 3-5').
          - Click 'Split PDF' to get the new PDF.
+         - To cut one PDF into many at once, choose 'Several range sets' (e.g., '1-3; 4-10; 11'), 'Every N pages' or 'One PDF per bookmark'; all outputs are delivered in a single zip file.
 
     3. **Download Results:**
-       - After processing, you can download the combined or split PDF file.
+       - After processing, you can download the combined or split PDF file. Downloading does not reload the page; for a combined PDF, click 'Done' afterwards to swap the emails in the file list for their converted PDFs.
 
     4. **Repeat or Upload More Files:**
        - You can upload more files at any time.
        - The app supports multiple actions without losing previously uploaded files.
-       - When users choose to access files they've already converted, those files are stored in a temporary cache to eliminate redundant API requests.
+       - Each session has a storage limit shown under the file list. When it is reached, the oldest split results are removed first; uploaded files are kept for as long as the session lasts.
+       - When users choose to access files they've already converted, those files are stored in a shared cache keyed by file content to eliminate redundant API requests, even across sessions.
     <br>
     """, unsafe_allow_html=True)
 
     # Initialize session state variables
-    if 'file_details' not in st.session_state:
-        st.session_state.file_details = []
-    if 'converted_files' not in st.session_state:
-        st.session_state.converted_files = {}
     if 'temp_dir' not in st.session_state:
-        st.session_state.temp_dir = tempfile.TemporaryDirectory()
+        st.session_state.temp_dir = get_storage().session()
+    # Tells the storage sweep that this session is still in use
+    if not st.session_state.temp_dir.touch():
+        # Its files were removed from under it, so start again with empty storage
+        st.session_state.temp_dir = get_storage().session()
+        for key in ('registry', 'file_table'):
+            st.session_state.pop(key, None)
+        st.warning("This session's files were removed after a long time without use; please upload them again.")
+    # Starting the job runner resumes jobs left unfinished by a restart, whether
+    # or not anyone opens them
+    get_job_runner()
+    if 'registry' not in st.session_state:
+        st.session_state.registry = FileRegistry(st.session_state.temp_dir.name)
+    if 'job_id' not in st.session_state:
+        # A reloaded page finds its job again through the URL
+        st.session_state.job_id = st.query_params.get('job')
     if 'api_key' not in st.session_state:
         st.session_state.api_key = ''
     if 'user_input' not in st.session_state:
@@ -121,33 +462,46 @@ def main():
         type=['eml', 'msg', 'pdf'],
         accept_multiple_files=True
     )
+    registry = st.session_state.registry
     if uploaded_files:
-        # Process each uploaded file
+        # Register new uploads; ones seen on an earlier rerun are skipped without reading them
         for uploaded_file in uploaded_files:
-            file_name = uploaded_file.name
-            file_type = os.path.splitext(file_name)[1]
-            file_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            # Check if the file is already in the list to avoid duplicates
-            if not any(fd['File Name'] == file_name for fd in st.session_state.file_details):
-                st.session_state.file_details.append({
-                    'File Name': file_name,
-                    'Date Modified': file_date,
-                    'File Type': file_type,
-                    'Data': uploaded_file,
-                    'Temp File Path': None
-                })
+            upload_id = getattr(uploaded_file, 'file_id', None) or (uploaded_file.name, uploaded_file.size)
+            if registry.has_upload(upload_id):
+                continue
+            try:
+                st.session_state.temp_dir.reserve(uploaded_file.size)
+            except StorageQuotaError as e:
+                st.error(f"{uploaded_file.name} was not added: {e}")
+                continue
+            uploaded_file.seek(0)
+            record, added = registry.add_upload(upload_id, uploaded_file.name, uploaded_file)
+            if added:
+                # Identical files uploaded in any session are stored once
+                st.session_state.temp_dir.share(record.path, record.sha256)
+                # Start reading the file's metadata in the background right away
+                get_file_metadata(record.name)
             else:
-                # Duplicate file - ignore without warning
-                pass
+                st.caption(f"{uploaded_file.name} has the same content as {record.name} and was not added again.")
 
-    if st.session_state.file_details:
-        # Create a DataFrame from the file details
-        df = pd.DataFrame(st.session_state.file_details)
-        df.index = df.index + 1  # Start index at 1
+    if len(registry):
+        df = registry.view()
 
-        # Display the DataFrame
+        # Display the files along with what is already known about each one
         st.write("Available Files:")
-        st.dataframe(df[['File Name', 'File Type']])
+        file_table = st.session_state.get('file_table')
+        if file_table is None or file_table[0] != registry.version:
+            wait([get_file_metadata(record.name) for record in registry], timeout=METADATA_WAIT_SECONDS)
+            metadata_df = pd.DataFrame([describe_file(record.name) for record in registry], index=df.index)
+            file_table = (registry.version, pd.concat([df[['File Name', 'File Type']], metadata_df], axis=1))
+            # Keep the table for later reruns once nothing in it is still being read
+            if all(record.metadata.done() for record in registry):
+                st.session_state.file_table = file_table
+        st.dataframe(file_table[1])
+        st.caption(
+            f"Files in this session: {st.session_state.temp_dir.usage() / 1024 ** 2:.1f} MB "
+            f"of {get_storage().session_quota / 1024 ** 2:.0f} MB"
+        )
 
         # Action selection
         st.write("Select an action:")
@@ -162,246 +516,156 @@ def main():
         if st.session_state.action_selected == 'combine':
             # Prompt the user to input the indices
             st.session_state.user_input = st.text_input(
-                "Choose the files you want to convert (e.g., '1, 2-4'): ",
+                "Choose the files you want to convert, in the order to combine them (e.g., '1, 2-4', '3, 1, 2' or '4-'): ",
                 value=st.session_state.user_input
             )
 
             if st.session_state.user_input:
                 # Parse the user input
-                selected_indices = set()
-                for part in st.session_state.user_input.split(','):
-                    part = part.strip()
-                    if '-' in part:
-                        try:
-                            start, end = map(int, part.split('-'))
-                            if start > end:
-                                st.error(f"Invalid range '{part}': start index is greater than end index.")
-                                st.stop()
-                            selected_indices.update(range(start, end + 1))  # Keep one-based indexing
-                        except ValueError:
-                            st.error(f"Invalid range in input: '{part}'")
-                            st.stop()
-                    else:
-                        try:
-                            selected_indices.add(int(part))
-                        except ValueError:
-                            st.error(f"Invalid number in input: '{part}'")
-                            st.stop()
-
-                # Filter the DataFrame based on the selected indices
-                selected_indices = sorted([i for i in selected_indices if 1 <= i <= len(df)])  # Keep one-based indexing
-
-                if not selected_indices:
-                    st.error("No valid indices selected.")
+                try:
+                    selected_indices = parse_selection(st.session_state.user_input, len(df))
+                except SelectionError as e:
+                    st.error(str(e))
                     st.stop()
 
                 selected_df = df.loc[selected_indices]
-                st.write("Selected Files:")
+                st.write("Selected Files (in combine order):")
                 st.dataframe(selected_df[['File Name', 'File Type']])
 
-                # Prompt for Zamzar API key (required for .eml and .msg to .pdf conversion)
-                st.session_state.api_key = st.text_input(
-                    'Enter your Zamzar API key (required for .eml and .msg to .pdf conversion):',
-                    type='password',
-                    value=st.session_state.api_key
+                # Reject unusable inputs before anything is converted
+                unusable = [
+                    f"{row['File Name']} ({metadata.error})"
+                    for _, row in selected_df.iterrows()
+                    for metadata in [get_file_metadata(row['File Name']).result()]
+                    if not metadata.ok
+                ]
+                if unusable:
+                    st.error("These files cannot be combined: " + ', '.join(unusable))
+                    st.stop()
+
+                # Attached PDFs can skip the converter and be merged as they are
+                attachment_mode = ATTACHMENTS_CONVERT
+                include_images = False
+                if any(file_type in EMAIL_TYPES for file_type in selected_df['File Type']):
+                    attachment_mode = st.radio(
+                        'Email attachments:',
+                        list(ATTACHMENT_LABELS),
+                        format_func=ATTACHMENT_LABELS.get,
+                        key='attachment_mode',
+                        horizontal=True
+                    )
+                    if attachment_mode != ATTACHMENTS_CONVERT:
+                        include_images = st.checkbox(
+                            'Also add attached images, one per page',
+                            key='attachment_images'
+                        )
+
+                # Choose how .eml and .msg files are converted to PDF
+                converter_name = CONVERTER_LOCAL
+                if attachment_mode != ATTACHMENTS_ONLY:
+                    converter_name = st.radio(
+                        'Convert emails with:',
+                        list(CONVERTER_LABELS),
+                        format_func=CONVERTER_LABELS.get,
+                        key='converter_name',
+                        horizontal=True,
+                        help="The local converter only has Western European fonts and shows other characters "
+                             "as '?'; with the Zamzar fallback such emails are converted by Zamzar instead."
+                    )
+
+                # Prompt for Zamzar API key (required for .eml and .msg to .pdf conversion through Zamzar)
+                if converter_name != CONVERTER_LOCAL:
+                    st.session_state.api_key = st.text_input(
+                        'Enter your Zamzar API key (required for .eml and .msg to .pdf conversion):',
+                        type='password',
+                        value=st.session_state.api_key
+                    )
+                    if st.session_state.api_key:
+                        # Show the remaining quota before any conversions are spent
+                        try:
+                            credits = zamzar.get_client(st.session_state.api_key).remaining_credits()
+                            st.caption(f"Zamzar conversions remaining: {credits}")
+                        except (ConversionError, requests.RequestException):
+                            st.caption("Could not read the remaining Zamzar conversions for this API key.")
+
+                # Streaming keeps memory flat for large batches but drops the inputs' bookmarks
+                streaming_merge = st.checkbox(
+                    'Low-memory merge (recommended for large batches; bookmarks are not kept)',
+                    value=len(selected_df) > 20,
+                    key='streaming_merge'
                 )
 
+                optimize, image_dpi = optimize_options('combine')
+
                 # Button to start conversion and combination
                 if st.button('Convert and Combine Selected Files'):
-                    # Copy the selected DataFrame to avoid modifying the original
-                    processed_df = selected_df.copy()
-
-                    # Count the number of .eml and .msg files
-                    num_email_files = processed_df[processed_df['File Type'].isin(['.eml', '.msg'])].shape[0]
-                    email_files_processed = 0  # Initialize the counter
-
-                    # Initialize the progress bar if there are .eml or .msg files
-                    if num_email_files > 0:
-                        progress_bar = st.progress(0)
-                        progress_text = st.empty()  # Placeholder for progress text
-
-                    # Iterate through the selected files
-                    for idx, (index, row) in enumerate(processed_df.iterrows(), start=1):
-                        file_name = row['File Name']
-                        file_type = row['File Type']
-                        uploaded_file = row.get('Data', None)
-                        temp_file_path = row.get('Temp File Path', None)
-
-                        if file_type in ['.eml', '.msg']:
-                            if st.session_state.api_key == '':
-                                st.error('API key is required for .eml and .msg to .pdf conversion.')
+                    inputs = [(row['File Name'], row['Temp File Path']) for _, row in selected_df.iterrows()]
+                    attachments_dir = None
+                    try:
+                        if attachment_mode != ATTACHMENTS_CONVERT:
+                            try:
+                                st.session_state.temp_dir.reserve(sum(os.path.getsize(path) for _, path in inputs))
+                            except StorageQuotaError as e:
+                                st.error(str(e))
+                                st.stop()
+                            # Not an artifact: extracted attachments stay for as long as the uploads do
+                            attachments_dir = tempfile.mkdtemp(dir=st.session_state.temp_dir.name)
+                            inputs, extracted = split_emails(inputs, attachments_dir, attachment_mode, include_images)
+                            # Extracted attachments are listed like uploads so they can be used again.
+                            # One already listed is used from there, and the new copy is removed.
+                            names = {}
+                            paths = {}
+                            for name, path in extracted:
+                                record, added = registry.add_path(name, path)
+                                if added:
+                                    st.session_state.temp_dir.share(path, record.sha256)
+                                elif record.path != path:
+                                    os.remove(path)
+                                names[path] = record.name
+                                paths[path] = record.path
+                            inputs = [(names.get(path, file_name), paths.get(path, path)) for file_name, path in inputs]
+                            st.write(f"Extracted {len(extracted)} attachment(s) from the selected emails.")
+                            if not inputs:
+                                st.error("The selected emails have no attachments that can be merged.")
+                                st.stop()
+                            # Attachments get the same check as uploads, before any email is converted
+                            unusable = [
+                                f"{name} ({metadata.error})"
+                                for name in dict.fromkeys(names.values())
+                                for metadata in [get_file_metadata(name).result()]
+                                if not metadata.ok
+                            ]
+                            if unusable:
+                                st.error("These attachments cannot be combined: " + ', '.join(unusable))
                                 st.stop()
 
-                            # Check if this file has already been converted
-                            if file_name in st.session_state.converted_files:
-                                st.write(f"Using cached PDF for {file_name}")
-                                converted_info = st.session_state.converted_files[file_name]
-                                output_pdf_name = converted_info['File Name']
-                                output_pdf_path = converted_info['Temp File Path']
-                            else:
-                                st.write(f"Converting {file_name} to PDF...")
-                                # Zamzar API conversion
-                                endpoint = "https://sandbox.zamzar.com/v1/jobs"
-                                target_format = "pdf"
-
-                                # Prepare the file for upload
-                                data_content = {'target_format': target_format}
-                                files = {'source_file': (file_name, uploaded_file.getvalue())}
-
-                                response = requests.post(
-                                    endpoint,
-                                    data=data_content,
-                                    files=files,
-                                    auth=HTTPBasicAuth(st.session_state.api_key, '')
-                                )
-
-                                if response.status_code != 201:
-                                    st.error(f"Error starting conversion job for {file_name}.")
-                                    st.stop()
-
-                                job = response.json()
-                                job_id = job['id']
-
-                                # Poll the job status
-                                status_endpoint = f"https://sandbox.zamzar.com/v1/jobs/{job_id}"
-                                with st.spinner(f"Converting {file_name}..."):
-                                    while True:
-                                        response = requests.get(
-                                            status_endpoint,
-                                            auth=HTTPBasicAuth(st.session_state.api_key, '')
-                                        )
-                                        job_status = response.json()
-                                        status = job_status['status']
-                                        if status == 'successful':
-                                            break
-                                        elif status == 'failed':
-                                            st.error(f"The conversion job for {file_name} failed.")
-                                            st.stop()
-                                        time.sleep(5)  # Wait before polling again
-
-                                # Download the converted PDF
-                                target_file_id = job_status['target_files'][0]['id']
-                                download_endpoint = f"https://sandbox.zamzar.com/v1/files/{target_file_id}/content"
-                                output_pdf_name = os.path.splitext(file_name)[0] + '.pdf'
-                                output_pdf_path = os.path.join(
-                                    st.session_state.temp_dir.name,
-                                    output_pdf_name
-                                )  # Save in temporary folder
-
-                                response = requests.get(
-                                    download_endpoint,
-                                    stream=True,
-                                    auth=HTTPBasicAuth(st.session_state.api_key, '')
-                                )
-                                if response.status_code == 200:
-                                    with open(output_pdf_path, 'wb') as pdf_file:
-                                        for chunk in response.iter_content(chunk_size=1024):
-                                            if chunk:
-                                                pdf_file.write(chunk)
-                                    st.write(f"PDF created: {output_pdf_name}")
-
-                                    # Update the session_state with converted file
-                                    st.session_state.converted_files[file_name] = {
-                                        'File Name': output_pdf_name,
-                                        'File Type': '.pdf',
-                                        'Date Modified': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                                        'Temp File Path': output_pdf_path
-                                    }
-
-                                    # Update progress bar
-                                    email_files_processed += 1
-                                    progress = email_files_processed / num_email_files
-                                    progress_bar.progress(progress)
-                                    progress_text.text(
-                                        f"Converted {email_files_processed} out of {num_email_files} email files"
-                                    )
-                                else:
-                                    st.error(f"Failed to download the converted PDF for {file_name}.")
-                                    st.stop()
-                            # Update processed_df with converted file info
-                            processed_df.at[index, 'File Name'] = output_pdf_name
-                            processed_df.at[index, 'File Type'] = '.pdf'
-                            processed_df.at[index, 'Date Modified'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                            processed_df.at[index, 'Temp File Path'] = output_pdf_path
-
-                        elif file_type == '.pdf':
-                            if temp_file_path and os.path.exists(temp_file_path):
-                                output_pdf_path = temp_file_path
-                            else:
-                                if uploaded_file is not None:
-                                    output_pdf_path = os.path.join(st.session_state.temp_dir.name, file_name)
-                                    with open(output_pdf_path, 'wb') as pdf_file:
-                                        pdf_file.write(uploaded_file.getvalue())
-                                    processed_df.at[index, 'Temp File Path'] = output_pdf_path
-                                else:
-                                    st.error(f"No data found for PDF file {file_name}")
-                                    st.stop()
-                        else:
-                            st.error(f"Unsupported file type: {file_type}")
+                        converter = get_converter(converter_name, st.session_state.api_key)
+                        has_emails = any(is_email(file_name) for file_name, _ in inputs)
+                        if has_emails and converter.needs_api_key and st.session_state.api_key == '':
+                            st.error('API key is required for .eml and .msg to .pdf conversion.')
                             st.stop()
 
-                        # Update processed_df with Temp File Path
-                        processed_df.at[index, 'Temp File Path'] = output_pdf_path
-
-                    # Combine the PDF files
-                    st.write("Combining PDF files...")
-                    pdf_merger = PdfMerger()
-
-                    for index, row in processed_df.iterrows():
-                        if row['File Type'] == '.pdf':
-                            pdf_file_path = row['Temp File Path']
-                            # Open the PDF file in binary mode
-                            try:
-                                with open(pdf_file_path, 'rb') as pdf_file:
-                                    pdf_reader = PdfReader(pdf_file)
-                                    pdf_merger.append(pdf_reader)
-                            except Exception as e:
-                                st.error(f"Error reading PDF file {row['File Name']}: {e}")
-                                st.stop()
-
-                    # Write the combined PDF
-                    combined_pdf_name = f'combined_output_{datetime.now().strftime("%Y%m%d%H%M%S")}.pdf'
-                    combined_pdf_path = os.path.join(st.session_state.temp_dir.name, combined_pdf_name)
-                    with open(combined_pdf_path, 'wb') as combined_pdf_file:
-                        pdf_merger.write(combined_pdf_file)
-                    pdf_merger.close()
-
-                    # Provide a download link
-                    with open(combined_pdf_path, 'rb') as f:
-                        st.success("Combined PDF is ready!")
-                        download_clicked = st.download_button(
-                            label="Download Combined PDF",
-                            data=f,
-                            file_name=combined_pdf_name,
-                            mime="application/pdf"
+                        # Don't start a Zamzar batch that the account cannot finish
+                        max_conversions = None
+                        if converter_name == CONVERTER_ZAMZAR:
+                            max_conversions = converter.client.credits_remaining
+
+                        # The job runs in the background, so it carries on through reruns and reloads
+                        job_id = get_job_runner().submit_combine(
+                            inputs,
+                            converter_name,
+                            api_key=st.session_state.api_key,
+                            streaming=streaming_merge,
+                            output_name=f'combined_output_{datetime.now().strftime("%Y%m%d%H%M%S")}.pdf',
+                            max_conversions=max_conversions,
+                            optimize=optimize,
+                            image_dpi=image_dpi
                         )
-
-                    # Automatically reset the action selected
-                    if download_clicked:
-                        # Update the file list to replace '.eml' and '.msg' files with their converted '.pdf' versions
-                        updated_file_details = []
-                        for file_detail in st.session_state.file_details:
-                            file_name = file_detail['File Name']
-                            if file_name in st.session_state.converted_files:
-                                # Replace with converted PDF
-                                converted_file = st.session_state.converted_files[file_name]
-                                updated_file_details.append({
-                                    'File Name': converted_file['File Name'],
-                                    'Date Modified': converted_file['Date Modified'],
-                                    'File Type': converted_file['File Type'],
-                                    'Data': None,  # Data is None because we have Temp File Path
-                                    'Temp File Path': converted_file['Temp File Path']
-                                })
-                            else:
-                                updated_file_details.append(file_detail)
-                        st.session_state.file_details = updated_file_details
-
-                        # Clear the previous user input and action
-                        st.session_state.user_input = ''
-                        st.session_state.action_selected = None
-
-                        # Rerun the app to reflect changes
-                        st.experimental_rerun()
+                    finally:
+                        if attachments_dir is not None:
+                            discard_scratch(attachments_dir)
+                    st.session_state.job_id = job_id
+                    st.query_params['job'] = job_id
 
                 else:
                     st.info("Click the button to convert and combine selected files.")
@@ -427,42 +691,57 @@ def main():
                         st.error("Selected file is not a PDF.")
                         st.stop()
                     else:
-                        st.write(f"Selected file: {selected_file['File Name']}")
+                        metadata = get_file_metadata(selected_file['File Name']).result()
+                        if not metadata.ok:
+                            st.error(f"{selected_file['File Name']} cannot be split: {metadata.error}")
+                            st.stop()
+                        st.write(f"Selected file: {selected_file['File Name']} ({metadata.page_count} pages)")
+                        split_mode = st.radio(
+                            'Split into:',
+                            SPLIT_MODES,
+                            key='split_mode',
+                            horizontal=True
+                        )
+                        if split_mode != SPLIT_SINGLE:
+                            # Several outputs from one pass over the file, delivered as a zip
+                            split_many(selected_file, split_mode)
+                            st.stop()
+
                         # Prompt for page ranges
                         page_ranges_input = st.text_input(
-                            "Enter the page numbers or ranges you want to include (e.g., '1, 3-5'): ",
+                            "Enter the pages to include, in output order "
+                            "(e.g., '1, 3-5', '5-' to the end, 'last', '-2' for second to last, "
+                            "'10-1' reversed, '1-:2' every other page): ",
                             value=st.session_state.get('page_ranges_input', '')
                         )
                         st.session_state.page_ranges_input = page_ranges_input
+                        optimize, image_dpi = optimize_options('split')
 
                         if page_ranges_input:
                             # Button to split and download
                             if st.button('Split and Download'):
                                 # Validate and parse the page ranges
-                                page_numbers = parse_page_ranges(page_ranges_input)
-                                if page_numbers is None:
-                                    st.error("Invalid page ranges entered.")
+                                try:
+                                    page_numbers = parse_page_ranges(page_ranges_input, metadata.page_count)
+                                except RangeError as e:
+                                    st.error(str(e))
                                     st.stop()
                                 else:
                                     # Perform splitting
-                                    split_pdf_path = split_pdf(selected_file, page_numbers)
+                                    run_metrics = RunMetrics('split', mode=split_mode)
+                                    split_pdf_path = split_pdf(selected_file, page_numbers, metrics=run_metrics)
+                                    if split_pdf_path and optimize:
+                                        optimize_outputs([split_pdf_path], image_dpi, run_metrics)
+                                    report_run(run_metrics)
                                     if split_pdf_path:
+                                        st.session_state.temp_dir.share(split_pdf_path)
                                         # Provide download link
-                                        with open(split_pdf_path, 'rb') as f:
-                                            st.success("Split PDF is ready!")
-                                            download_clicked = st.download_button(
-                                                label="Download Split PDF",
-                                                data=f,
-                                                file_name=f"split_{selected_file['File Name']}",
-                                                mime="application/pdf"
-                                            )
-                                        if download_clicked:
-                                            # Reset action
-                                            st.session_state.action_selected = None
-                                            st.session_state.split_file_input = ''
-                                            st.session_state.page_ranges_input = ''
-                                            # Rerun the app to loop back
-                                            st.experimental_rerun()
+                                        st.success("Split PDF is ready!")
+                                        download_output(
+                                            "Download Split PDF", split_pdf_path,
+                                            f"split_{selected_file['File Name']}", "application/pdf",
+                                            storage=st.session_state.temp_dir
+                                        )
                                     else:
                                         st.error("Failed to split the PDF.")
                                         st.stop()
@@ -479,5 +758,8 @@ def main():
     else:
         st.info("Please upload your EML, MSG, and PDF files to proceed.")
 
+    if st.session_state.job_id:
+        show_job(st.session_state.job_id)
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,126 @@
+import email
+import email.policy
+import os
+
+from core import converted_name, is_email, unique_path
+from emails import Attachment, EmailParseError, parse_email_file
+from render import PageLayout, PdfDocument
+
+# Pulling attachments out of emails so they are merged as they are instead of
+# going through a converter with the rest of the message.
+#
+# Attached PDFs are copied out byte for byte, and with `include_images` each
+# attached image becomes a one-page PDF. What is left of the email is converted
+# as before (ATTACHMENTS_SEPARATE) or dropped (ATTACHMENTS_ONLY). A .eml body is
+# rewritten without the extracted parts so they are not converted twice; a .msg
+# cannot be rewritten, so its whole message still goes to the converter.
+
+ATTACHMENTS_CONVERT = 'convert'
+ATTACHMENTS_SEPARATE = 'separate'
+ATTACHMENTS_ONLY = 'only'
+ATTACHMENT_LABELS = {
+    ATTACHMENTS_CONVERT: 'Convert with the email',
+    ATTACHMENTS_SEPARATE: 'Merge attached PDFs after the email',
+    ATTACHMENTS_ONLY: 'Attached PDFs only',
+}
+
+
+def _extractable(attachment, include_images):
+    return attachment.is_pdf or (include_images and attachment.is_image)
+
+
+def image_pdf(data, output_path, mime_type=None):
+    # One page holding the image, scaled down to fit. False if it cannot be embedded.
+    document = PdfDocument()
+    layout = PageLayout(document)
+    if not layout.image(data, mime_type):
+        return False
+    layout.finish()
+    document.save(output_path)
+    return True
+
+
+def extract_attachments(file_name, source_path, output_dir, include_images=False, used_paths=None):
+    # Write the attachments of one email to `output_dir` as PDFs and return
+    # (name, path) pairs in message order, named '<email> - <attachment>.pdf'.
+    # Raises EmailParseError if the email cannot be read.
+    parsed = parse_email_file(file_name, source_path)
+    stem = os.path.splitext(os.path.basename(file_name))[0]
+    used_paths = set() if used_paths is None else used_paths
+    extracted = []
+    for attachment in parsed.attachments:
+        if not _extractable(attachment, include_images):
+            continue
+        name = f"{stem} - {converted_name(os.path.basename(attachment.filename))}"
+        path = unique_path(os.path.join(output_dir, name), used_paths)
+        if attachment.is_pdf:
+            with open(path, 'wb') as pdf_file:
+                pdf_file.write(attachment.data)
+        elif not image_pdf(attachment.data, path, attachment.mime_type):
+            used_paths.discard(path)
+            continue
+        extracted.append((name, path))
+    return extracted
+
+
+def strip_attachments(source_path, output_path, include_images=False):
+    # Copy a .eml without the parts `extract_attachments` takes out. Returns False,
+    # writing nothing, when there was nothing to remove.
+    with open(source_path, 'rb') as eml_file:
+        message = email.message_from_binary_file(eml_file, policy=email.policy.default)
+    removed = False
+    for part in message.walk():
+        if not part.is_multipart():
+            continue
+        kept = []
+        for child in part.get_payload():
+            is_attachment = not child.is_multipart() and (
+                child.get_filename() or child.get_content_disposition() == 'attachment'
+            )
+            attachment = Attachment(child.get_filename() or 'attachment', child.get_content_type(), b'')
+            if is_attachment and _extractable(attachment, include_images):
+                removed = True
+            else:
+                kept.append(child)
+        part.set_payload(kept)
+    if not removed:
+        return False
+    with open(output_path, 'wb') as eml_file:
+        eml_file.write(message.as_bytes())
+    return True
+
+
+def split_emails(inputs, output_dir, mode, include_images=False):
+    # Expand (file_name, path) combine inputs for `mode`. Each email becomes its
+    # body, unless mode is ATTACHMENTS_ONLY, followed by its extracted attachments;
+    # other files pass through. Returns (inputs, extracted) where `extracted` lists
+    # the new (name, path) attachment files. Emails that cannot be parsed here are
+    # left whole for the converter.
+    if mode == ATTACHMENTS_CONVERT:
+        return list(inputs), []
+    os.makedirs(output_dir, exist_ok=True)
+    expanded = []
+    extracted = []
+    used_paths = set()
+    for position, (file_name, path) in enumerate(inputs):
+        if not is_email(file_name):
+            expanded.append((file_name, path))
+            continue
+        try:
+            attachments = extract_attachments(file_name, path, output_dir, include_images, used_paths)
+        except EmailParseError:
+            expanded.append((file_name, path))
+            continue
+        if mode == ATTACHMENTS_SEPARATE:
+            body_path = path
+            if attachments and file_name.lower().endswith('.eml'):
+                # A numbered directory keeps the body's own name for the converter
+                body_dir = os.path.join(output_dir, 'bodies', str(position))
+                os.makedirs(body_dir, exist_ok=True)
+                stripped_path = os.path.join(body_dir, os.path.basename(file_name))
+                if strip_attachments(path, stripped_path, include_images):
+                    body_path = stripped_path
+            expanded.append((file_name, body_path))
+        expanded.extend(attachments)
+        extracted.extend(attachments)
+    return expanded, extracted
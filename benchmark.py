@@ -0,0 +1,447 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import ExitStack
+from email.message import EmailMessage
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+from converters import LocalConverter, ZamzarConverter
+from core import combine_pdfs, convert_emails, page_count, parse_page_ranges, split_pdf
+from optimize import optimize_pdf
+from render import PageLayout, PdfDocument
+from zamzar import ZamzarClient
+
+# Reproducible timings for the combine, split, page-range and conversion paths.
+#
+#   python benchmark.py run -o before.json
+#   python benchmark.py run -o after.json --zamzar-latency 0.5
+#   python benchmark.py compare before.json after.json --threshold 0.15
+#
+# Every case runs against a synthetic corpus built from a fixed seed, so two runs
+# on the same machine measure the same work. Wall time is the median of --repeat
+# runs; peak memory comes from one extra run under tracemalloc, which only sees
+# Python allocations in this process (not the local converter's worker processes).
+# `compare` exits with status 1 if any case got slower or used more memory by more
+# than the threshold.
+
+CORPUS_SEED = 1234
+
+# Corpus size presets: (text PDFs as page counts, scanned PDFs, scanned pages, scan KB, emails)
+SCALES = {
+    'small': ((1, 5, 20), 2, 5, 200, 10),
+    'medium': ((1, 10, 50, 200), 4, 20, 500, 50),
+    'large': ((1, 10, 100, 500, 1000), 8, 50, 1000, 200),
+}
+
+LOREM = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+         'incididunt ut labore et dolore magna aliqua').split()
+
+
+def text_pdf(path, pages, rng):
+    document = PdfDocument()
+    layout = PageLayout(document)
+    for page in range(pages):
+        layout.text_line(f"Page {page + 1} of {pages}", size=14, bold=True)
+        for _ in range(40):
+            layout.text_line(' '.join(rng.choice(LOREM) for _ in range(12)))
+        if page + 1 < pages:
+            layout.new_page()
+    layout.finish()
+    document.save(path)
+
+
+def scanned_pdf(path, pages, image_kb, rng):
+    # Uncompressed greyscale noise, about image_kb per page, like a scanner's raw output
+    document = PdfDocument()
+    width = 1024
+    height = image_kb * 1024 // width
+    for page in range(pages):
+        pixels = rng.randbytes(width * height)
+        image = document._add_stream(
+            b'/Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceGray /BitsPerComponent 8'
+            % (width, height), pixels
+        )
+        document.add_page(b'q 512 0 0 700 50 70 cm /Im Do Q BT /F1 10 Tf 50 50 Td (Scan %d) Tj ET'
+                          % (page + 1), {'Im': image})
+    document.save(path)
+
+
+def email_file(path, index, rng, attachment=None):
+    message = EmailMessage()
+    message['From'] = f"Sender {index} <sender{index}@example.com>"
+    message['To'] = 'recipient@example.com'
+    message['Subject'] = f"Benchmark message {index}"
+    message['Date'] = 'Mon, 01 Jan 2024 10:00:00 +0000'
+    paragraphs = ['\n'.join(' '.join(rng.choice(LOREM) for _ in range(14)) for _ in range(8))
+                  for _ in range(rng.randint(2, 10))]
+    message.set_content('\n\n'.join(paragraphs))
+    message.add_alternative(''.join(f"<p>{paragraph}</p>" for paragraph in paragraphs), subtype='html')
+    if attachment is not None:
+        with open(attachment, 'rb') as f:
+            message.add_attachment(f.read(), maintype='application', subtype='pdf',
+                                   filename=os.path.basename(attachment))
+    with open(path, 'wb') as f:
+        f.write(bytes(message))
+
+
+def build_corpus(directory, scale='small'):
+    # Returns {'pdfs': [...], 'scans': [...], 'emails': [...]} paths under `directory`
+    page_counts, scan_count, scan_pages, scan_kb, email_count = SCALES[scale]
+    rng = random.Random(CORPUS_SEED)
+    corpus = {'pdfs': [], 'scans': [], 'emails': []}
+    for pages in page_counts:
+        path = os.path.join(directory, f"text_{pages:04d}p.pdf")
+        text_pdf(path, pages, rng)
+        corpus['pdfs'].append(path)
+    for i in range(scan_count):
+        path = os.path.join(directory, f"scan_{i:02d}.pdf")
+        scanned_pdf(path, scan_pages, scan_kb, rng)
+        corpus['scans'].append(path)
+    for i in range(email_count):
+        path = os.path.join(directory, f"email_{i:03d}.eml")
+        # Every third email carries the smallest PDF as an attachment
+        email_file(path, i, rng, attachment=corpus['pdfs'][0] if i % 3 == 0 else None)
+        corpus['emails'].append(path)
+    return corpus
+
+
+class FakeZamzarServer:
+    # Just enough of the Zamzar API for ZamzarClient: jobs finish `latency` seconds
+    # after they are created and every target file is a one-page PDF naming the
+    # file it was converted from. Tests can give single files their own latency,
+    # make the jobs for names in `failing` end in status 'failed' and queue error
+    # responses with `fail_next`. `connections` counts the TCP connections opened.
+    def __init__(self, latency=0.2, latencies=None, failing=(), credits=1000000):
+        self.latency = latency
+        self.latencies = dict(latencies or {})
+        self.failing = set(failing)
+        self.credits = credits
+        self.requests = 0
+        self.connections = 0
+        self.request_times = []
+        self._errors = []
+        self._jobs = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._results = {}
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def _result(self, file_name):
+        with self._lock:
+            if file_name not in self._results:
+                document = PdfDocument()
+                layout = PageLayout(document)
+                layout.text_line(f"Converted {file_name} by the fake Zamzar server")
+                layout.finish()
+                buffer = BytesIO()
+                document.save(buffer)
+                self._results[file_name] = buffer.getvalue()
+            return self._results[file_name]
+
+    def fail_next(self, path, status, count=1, retry_after=None, body=None):
+        # Answer the next `count` requests whose path contains `path` with `status`
+        # and `body`, by default a JSON error; bytes are sent as they are
+        if body is None:
+            body = {'errors': [{'message': 'injected'}]}
+        with self._lock:
+            self._errors.extend([(path, status, retry_after, body)] * count)
+
+    def _injected_error(self, path):
+        with self._lock:
+            for i, (fragment, status, retry_after, body) in enumerate(self._errors):
+                if fragment in path:
+                    del self._errors[i]
+                    return status, retry_after, body
+        return None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_port}/v1"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                with server._lock:
+                    server.connections += 1
+
+            def _send(self, status, body, content_type='application/json', headers=()):
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Zamzar-Test-Credits-Remaining', str(server.credits))
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _count(self):
+                # Counts the request; True if an injected error was sent instead
+                with server._lock:
+                    server.requests += 1
+                    server.request_times.append((time.monotonic(), self.command, self.path))
+                error = server._injected_error(self.path)
+                if error is None:
+                    return False
+                status, retry_after, body = error
+                headers = [('Retry-After', str(retry_after))] if retry_after is not None else []
+                content_type = 'text/html' if isinstance(body, bytes) else 'application/json'
+                self._send(status, body, content_type, headers)
+                return True
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self._count():
+                    return
+                match = re.search(rb'filename="([^"]*)"', body)
+                file_name = match.group(1).decode() if match else ''
+                with server._lock:
+                    job_id = next(server._ids)
+                    server._jobs[job_id] = (file_name, time.monotonic())
+                    server.credits -= 1
+                self._send(201, {'id': job_id, 'status': 'initialising'})
+
+            def do_GET(self):
+                if self._count():
+                    return
+                parts = self.path.rstrip('/').split('/')
+                if parts[-1] == 'account':
+                    self._send(200, {'test_credits_remaining': server.credits, 'credits_remaining': server.credits})
+                elif parts[-2] == 'jobs':
+                    job_id = int(parts[-1])
+                    file_name, created = server._jobs[job_id]
+                    done = time.monotonic() - created >= server.latencies.get(file_name, server.latency)
+                    status = 'converting'
+                    if done:
+                        status = 'failed' if file_name in server.failing else 'successful'
+                    self._send(200, {
+                        'id': job_id,
+                        'status': status,
+                        'target_files': [{'id': job_id}] if status == 'successful' else [],
+                    })
+                elif parts[-1] == 'content':
+                    self._send(200, server._result(server._jobs[int(parts[-2])][0]), 'application/pdf')
+                else:
+                    self._send(404, {'errors': [{'message': 'not found'}]})
+
+        return Handler
+
+
+def measure(function, repeat=3):
+    # Median wall time over `repeat` runs, then one traced run for peak memory
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'seconds': statistics.median(timings),
+        'min_seconds': min(timings),
+        'peak_mb': peak / (1024 * 1024),
+        'runs': repeat,
+    }
+
+
+def benchmark_cases(corpus, work_dir, zamzar_url=None):
+    # (name, function, details) for every case; each function writes into work_dir
+    pdfs = corpus['pdfs'] + corpus['scans']
+    largest = corpus['pdfs'][-1]
+    combined = os.path.join(work_dir, 'combined.pdf')
+    split_output = os.path.join(work_dir, 'split.pdf')
+    every_other_page = list(range(1, page_count(largest) + 1, 2))
+    wide_range = '1-1000000'
+    long_range = ', '.join(f"{n}-{n + 2}" for n in range(1, 30000, 5))
+    emails = [(path, path) for path in corpus['emails']]
+
+    def optimize_combined():
+        # Combines first when run with --only; the median keeps that one slow run out
+        if not os.path.exists(combined):
+            combine_pdfs(pdfs, combined)
+        return optimize_pdf(combined, os.path.join(work_dir, 'optimized.pdf'))
+
+    def convert(converter):
+        output_dir = tempfile.mkdtemp(dir=work_dir)
+        return lambda: convert_emails(converter, emails, output_dir)
+
+    cases = [
+        ('combine_pdfmerger', lambda: combine_pdfs(pdfs, combined), {'files': len(pdfs)}),
+        ('combine_streaming', lambda: combine_pdfs(pdfs, combined, streaming=True), {'files': len(pdfs)}),
+        ('split_pdf_every_other_page', lambda: split_pdf(largest, every_other_page, split_output),
+         {'pages': len(every_other_page)}),
+        ('split_pdf_scan', lambda: split_pdf(corpus['scans'][0], [1, 2, 3], split_output), {'pages': 3}),
+        ('optimize_combined', optimize_combined, {'files': len(pdfs)}),
+        ('parse_page_ranges_wide', lambda: list(parse_page_ranges(wide_range, 1000000)),
+         {'input_chars': len(wide_range)}),
+        ('parse_page_ranges_long', lambda: list(parse_page_ranges(long_range, 30000)),
+         {'input_chars': len(long_range)}),
+        ('convert_local', convert(LocalConverter()), {'emails': len(emails)}),
+    ]
+    if zamzar_url is not None:
+        converter = ZamzarConverter('benchmark')
+        # No client-side rate limit: the fake server's latency is what is being modelled
+        converter.client = ZamzarClient('benchmark', base_url=zamzar_url, requests_per_second=0)
+        cases.append(('convert_zamzar_fake', convert(converter), {'emails': len(emails)}))
+    return cases
+
+
+def run_benchmarks(scale='small', repeat=3, zamzar_latency=0.2, only=None):
+    results = {}
+    with tempfile.TemporaryDirectory() as corpus_dir, tempfile.TemporaryDirectory() as work_dir, \
+            ExitStack() as stack:
+        start = time.perf_counter()
+        corpus = build_corpus(corpus_dir, scale)
+        corpus_seconds = time.perf_counter() - start
+        corpus_bytes = sum(os.path.getsize(path) for paths in corpus.values() for path in paths)
+
+        server = None
+        if zamzar_latency is not None:
+            server = stack.enter_context(FakeZamzarServer(zamzar_latency))
+        for name, function, details in benchmark_cases(corpus, work_dir, server and server.url):
+            if only and not any(pattern in name for pattern in only):
+                continue
+            print(f"running    {name}", file=sys.stderr)
+            requests_before = server.requests if server else 0
+            result = measure(function, repeat)
+            if name == 'convert_zamzar_fake':
+                result['latency'] = zamzar_latency
+                result['api_requests_per_run'] = (server.requests - requests_before) / (repeat + 1)
+            result.update(details)
+            results[name] = result
+
+    return {
+        'meta': {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'scale': scale,
+            'repeat': repeat,
+            'seed': CORPUS_SEED,
+            'corpus_files': sum(len(paths) for paths in corpus.values()),
+            'corpus_mb': corpus_bytes / (1024 * 1024),
+            'corpus_seconds': corpus_seconds,
+        },
+        'results': results,
+    }
+
+
+def compare_results(baseline, current, threshold=0.1, metrics=('seconds', 'peak_mb')):
+    # Returns (rows, regressions); a regression is a metric that grew by more than `threshold`
+    rows = []
+    regressions = []
+    for name in sorted(set(baseline['results']) | set(current['results'])):
+        before = baseline['results'].get(name)
+        after = current['results'].get(name)
+        if before is None or after is None:
+            rows.append((name, None, before, after, None))
+            continue
+        for metric in metrics:
+            old, new = before.get(metric), after.get(metric)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old if old else 0.0
+            rows.append((name, metric, old, new, change))
+            if change > threshold:
+                regressions.append((name, metric, change))
+    return rows, regressions
+
+
+def command_run(args):
+    report = run_benchmarks(args.scale, args.repeat, None if args.no_zamzar else args.zamzar_latency, args.only)
+    for name, result in report['results'].items():
+        print(f"{name:32s} {result['seconds']:9.4f} s  {result['peak_mb']:9.2f} MB")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print(f"wrote      {args.output}")
+    return 0
+
+
+def command_compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    if baseline['meta'].get('scale') != current['meta'].get('scale'):
+        print("warning: the two runs used different corpus scales", file=sys.stderr)
+
+    rows, regressions = compare_results(baseline, current, args.threshold)
+    for name, metric, old, new, change in rows:
+        if metric is None:
+            print(f"{name:32s} only in {'current' if old is None else 'baseline'}")
+        else:
+            print(f"{name:32s} {metric:8s} {old:10.4f} -> {new:10.4f}  {change:+7.1%}")
+    if regressions:
+        print(f"{len(regressions)} regression(s) above {args.threshold:.0%}:", file=sys.stderr)
+        for name, metric, change in regressions:
+            print(f"  {name} {metric} {change:+.1%}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Benchmark conversion, combine and split throughput.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run = subparsers.add_parser('run', help='run the benchmarks on a synthetic corpus')
+    run.add_argument('--scale', choices=list(SCALES), default='small', help='corpus size (default: small)')
+    run.add_argument('--repeat', type=int, default=3, help='timed runs per case (default: 3)')
+    run.add_argument('--zamzar-latency', type=float, default=0.2,
+                     help='seconds the fake Zamzar server takes per job (default: 0.2)')
+    run.add_argument('--no-zamzar', action='store_true', help='skip the fake Zamzar conversion case')
+    run.add_argument('--only', action='append', help='run only cases whose name contains this (repeatable)')
+    run.add_argument('-o', '--output', help='write the results to this JSON file')
+    run.set_defaults(handler=command_run)
+
+    compare = subparsers.add_parser('compare', help='compare two result files')
+    compare.add_argument('baseline', help='results of the earlier run')
+    compare.add_argument('current', help='results of the run being checked')
+    compare.add_argument('--threshold', type=float, default=0.1,
+                         help='allowed relative slowdown or memory growth (default: 0.1)')
+    compare.set_defaults(handler=command_compare)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from workers import walk_files
+
+# Shared location of the conversion cache; every session on the server uses it
+DEFAULT_CACHE_DIR = os.environ.get(
+    'EMLPDF_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'emlpdf-conversion-cache')
+)
+DEFAULT_MAX_BYTES = int(os.environ.get('EMLPDF_CACHE_MAX_BYTES', str(1024 ** 3)))
+DEFAULT_MAX_AGE = float(os.environ.get('EMLPDF_CACHE_MAX_AGE', str(30 * 24 * 3600)))
+
+
+def content_hash(data, chunk_size=1024 * 1024):
+    # SHA-256 of bytes or of a binary file object (read in chunks)
+    digest = hashlib.sha256()
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        digest.update(data)
+    else:
+        for chunk in iter(lambda: data.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_or_copy(src, dst):
+    # Hard links are free and survive eviction of the source name; fall back to a copy
+    try:
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+    return dst
+
+
+class ConversionCache:
+    # On-disk cache of converted files, keyed by the SHA-256 of the source bytes plus
+    # the target format. Entries are written atomically and evicted least recently
+    # used first once the cache grows beyond `max_bytes` or an entry is older than
+    # `max_age` seconds. Access time is tracked with the file's mtime.
+    def __init__(self, root=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, max_age=DEFAULT_MAX_AGE):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def key_for(data, target_format='pdf'):
+        return f"{content_hash(data)}.{target_format}"
+
+    def path_for(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key, dest_path=None):
+        # Return the cached path (or `dest_path` populated from it), or None on a miss
+        path = self.path_for(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                os.remove(path)
+                raise FileNotFoundError(path)
+            os.utime(path)  # Mark as recently used
+            if dest_path is not None:
+                path = link_or_copy(path, dest_path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def put(self, key, src_path):
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary name in the same directory, then rename into place
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file, open(src_path, 'rb') as src_file:
+                shutil.copyfileobj(src_file, tmp_file, 1024 * 1024)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+        return path
+
+    def entries(self):
+        # (mtime, size, path) for every completed entry
+        return [(st.st_mtime, st.st_size, path) for path, st in walk_files(self.root) if not path.endswith('.tmp')]
+
+    def evict(self):
+        now = time.time()
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_bytes and now - mtime <= self.max_age:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def stats(self):
+        entries = self.entries()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+        }
@@ -0,0 +1,320 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from attachments import ATTACHMENT_LABELS, ATTACHMENTS_CONVERT, split_emails
+from cache import ConversionCache
+from converters import CONVERTER_LABELS, CONVERTER_LOCAL, get_converter
+from core import (
+    ConversionError,
+    MergeError,
+    RangeError,
+    SplitError,
+    bookmark_groups,
+    burst_groups,
+    combine_pdfs,
+    convert_emails,
+    file_type,
+    is_email,
+    optimize_output,
+    page_count,
+    parse_page_ranges,
+    parse_range_groups,
+    split_pdf,
+    split_pdf_groups,
+)
+
+# Headless front end over core.py for cron jobs and queue workers, e.g.
+#
+#   python cli.py convert inbox/ -o converted/
+#   python cli.py combine cases/ -o combined/          (one PDF per subdirectory)
+#   python cli.py combine --manifest jobs.json -o combined/
+#   python cli.py combine cases/ -o combined/ --attachments separate   (attached PDFs merged as-is)
+#   python cli.py split bundle.pdf --pages '1-3, 7' -o exhibit-a.pdf
+#   python cli.py split --manifest jobs.json -o exhibits/
+#   python cli.py split bundle.pdf --every 1 -o pages/           (also --range-sets, --by-bookmark)
+#   python cli.py --optimize --image-dpi 150 combine cases/ -o combined/
+#
+# A manifest is a JSON file. Input paths are relative to the manifest and output
+# names are relative to the -o directory:
+#
+#   {"combine": [{"output": "case-1.pdf", "inputs": ["case-1/a.eml", "case-1/b.pdf"]}],
+#    "split": [{"input": "bundle.pdf", "pages": "1-3, 7", "output": "exhibit-a.pdf"}]}
+
+SUPPORTED_TYPES = ('.eml', '.msg', '.pdf')
+
+
+def find_files(paths):
+    # Expand directories into the supported files they contain, sorted by path
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dir_path, _, file_names in os.walk(path):
+                found.extend(
+                    os.path.join(dir_path, file_name) for file_name in file_names
+                    if file_type(file_name) in SUPPORTED_TYPES
+                )
+        else:
+            found.append(path)
+    return sorted(found)
+
+
+def load_manifest(path, section):
+    with open(path) as manifest_file:
+        manifest = json.load(manifest_file)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    entries = manifest.get(section, [])
+    for entry in entries:
+        if 'input' in entry:
+            entry['input'] = os.path.join(base_dir, entry['input'])
+        if 'inputs' in entry:
+            entry['inputs'] = [os.path.join(base_dir, input_path) for input_path in entry['inputs']]
+    return entries
+
+
+def build_converter(args):
+    converter = get_converter(args.converter, args.api_key)
+    if converter.needs_api_key and not args.api_key:
+        raise ConversionError("A Zamzar API key is required (--api-key or ZAMZAR_API_KEY).")
+    return converter
+
+
+def convert_all(args, email_paths, output_dir):
+    # Convert every email in one batch so the converter can run them concurrently
+    if not email_paths:
+        return {}
+    converter = build_converter(args)
+    cache = None if args.no_cache else ConversionCache()
+
+    def on_cached(file_name, output_path):
+        print(f"cached     {file_name} -> {output_path}")
+
+    def on_converted(file_names, output_path):
+        for file_name in file_names:
+            print(f"converted  {file_name} -> {output_path}")
+
+    def on_warning(file_names, message):
+        print(f"warning    {message}", file=sys.stderr)
+
+    return convert_emails(
+        converter, [(path, path) for path in email_paths], output_dir,
+        cache=cache, on_cached=on_cached, on_converted=on_converted, on_warning=on_warning
+    )
+
+
+def run_parallel(function, jobs, max_workers, verb='wrote'):
+    # Run independent (label, args) jobs in a process pool; returns the failed labels
+    failed = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(function, *job_args): label for label, job_args in jobs}
+        for future in as_completed(futures):
+            label = futures[future]
+            try:
+                print(f"{verb:<10} {future.result()}")
+            except (MergeError, SplitError, OSError) as e:
+                print(f"failed     {label}: {e}", file=sys.stderr)
+                failed.append(label)
+    return failed
+
+
+def optimize_file(path, image_dpi):
+    # Module-level so it can run in a worker process
+    start = time.perf_counter()
+    before, after = optimize_output(path, image_dpi=image_dpi)
+    return (f"{path}: {before / 1024:,.1f} KB -> {after / 1024:,.1f} KB "
+            f"in {time.perf_counter() - start:.2f} s")
+
+
+def optimize_outputs(args, paths):
+    # Optimize finished outputs in place when --optimize or --image-dpi was given
+    if not (args.optimize or args.image_dpi) or not paths:
+        return []
+    jobs = [(path, (path, args.image_dpi)) for path in paths]
+    return run_parallel(optimize_file, jobs, args.jobs, verb='optimized')
+
+
+def command_convert(args):
+    os.makedirs(args.output, exist_ok=True)
+    email_paths = [path for path in find_files(args.inputs) if is_email(path)]
+    if not email_paths:
+        print("No .eml or .msg files found.", file=sys.stderr)
+        return 1
+    convert_all(args, email_paths, args.output)
+    return 0
+
+
+def extract_group(args, inputs, output_dir):
+    # A group's inputs with its emails' attachments split out; stripped bodies are
+    # written under `output_dir` and converted like any other email
+    expanded, extracted = split_emails([(path, path) for path in inputs], output_dir,
+                                       args.attachments, args.attachment_images)
+    for name, _ in extracted:
+        print(f"extracted  {name}")
+    return [path for _, path in expanded]
+
+
+def command_combine(args):
+    os.makedirs(args.output, exist_ok=True)
+    if args.manifest:
+        groups = [(entry['output'], entry['inputs']) for entry in load_manifest(args.manifest, 'combine')]
+    else:
+        # One combined PDF per subdirectory, or one for the whole directory if it has none
+        subdirs = sorted(entry.path for entry in os.scandir(args.directory) if entry.is_dir())
+        groups = [
+            (os.path.basename(os.path.normpath(path)) + '.pdf', find_files([path]))
+            for path in subdirs or [args.directory]
+        ]
+    groups = [(os.path.join(args.output, output), inputs) for output, inputs in groups if inputs]
+    if not groups:
+        print("Nothing to combine.", file=sys.stderr)
+        return 1
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        if args.attachments != ATTACHMENTS_CONVERT:
+            groups = [
+                (output, extract_group(args, inputs, os.path.join(work_dir, 'attachments', str(position))))
+                for position, (output, inputs) in enumerate(groups)
+            ]
+            for output, inputs in groups:
+                if not inputs:
+                    print(f"skipped    {output}: no attachments to merge", file=sys.stderr)
+            groups = [(output, inputs) for output, inputs in groups if inputs]
+        email_paths = sorted({path for _, inputs in groups for path in inputs if is_email(path)})
+        pdf_paths = convert_all(args, email_paths, work_dir)
+        jobs = [
+            (output, ([pdf_paths.get(path, path) for path in inputs], output, args.streaming))
+            for output, inputs in groups
+        ]
+        failed = run_parallel(combine_pdfs, jobs, args.jobs)
+    failed += optimize_outputs(args, [output for output, _ in groups if output not in failed])
+    return 1 if failed else 0
+
+
+def command_split(args):
+    if args.manifest:
+        os.makedirs(args.output, exist_ok=True)
+        entries = load_manifest(args.manifest, 'split')
+        splits = [
+            (entry['input'], entry['pages'], os.path.join(args.output, entry['output']))
+            for entry in entries
+        ]
+    elif args.input and (args.range_sets or args.every or args.by_bookmark):
+        return split_many(args)
+    elif args.input and args.pages:
+        splits = [(args.input, args.pages, args.output)]
+    else:
+        print("Give an input PDF and --pages, or --manifest.", file=sys.stderr)
+        return 2
+
+    jobs = []
+    for input_path, pages, output_path in splits:
+        try:
+            page_numbers = parse_page_ranges(pages, page_count(input_path))
+        except RangeError as e:
+            print(f"Invalid page ranges '{pages}' for {input_path}: {e}", file=sys.stderr)
+            return 2
+        except OSError as e:
+            print(f"Could not read {input_path}: {e}", file=sys.stderr)
+            return 1
+        except SplitError as e:
+            print(str(e), file=sys.stderr)
+            return 1
+        jobs.append((output_path, (input_path, page_numbers, output_path)))
+    failed = run_parallel(split_pdf, jobs, args.jobs)
+    failed += optimize_outputs(args, [output for output, _ in jobs if output not in failed])
+    return 1 if failed else 0
+
+
+def split_many(args):
+    # Many outputs from one PDF in a single pass, written to the -o directory
+    try:
+        if args.range_sets:
+            groups = parse_range_groups(args.range_sets, page_count(args.input))
+        elif args.every:
+            groups = burst_groups(page_count(args.input), args.every)
+        else:
+            groups = bookmark_groups(args.input)
+    except RangeError as e:
+        print(f"Invalid page ranges '{args.range_sets}': {e}", file=sys.stderr)
+        return 2
+    except OSError as e:
+        print(f"Could not read {args.input}: {e}", file=sys.stderr)
+        return 1
+    except SplitError as e:
+        print(str(e), file=sys.stderr)
+        return 1
+    if not groups:
+        print(f"{args.input} has no bookmarks to split by.", file=sys.stderr)
+        return 1
+    os.makedirs(args.output, exist_ok=True)
+    try:
+        output_paths = split_pdf_groups(args.input, groups, args.output, max_workers=args.jobs)
+    except SplitError as e:
+        print(str(e), file=sys.stderr)
+        return 1
+    for output_path in output_paths:
+        print(f"wrote      {output_path}")
+    return 1 if optimize_outputs(args, output_paths) else 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Convert, combine and split email and PDF files.')
+    parser.add_argument('--converter', choices=list(CONVERTER_LABELS), default=CONVERTER_LOCAL,
+                        help='how .eml and .msg files are converted (default: local)')
+    parser.add_argument('--api-key', default=os.environ.get('ZAMZAR_API_KEY', ''),
+                        help='Zamzar API key (default: $ZAMZAR_API_KEY)')
+    parser.add_argument('--no-cache', action='store_true', help='do not use the shared conversion cache')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='number of combine/split jobs to run in parallel')
+    parser.add_argument('--optimize', action='store_true',
+                        help='shrink combined and split outputs: shared objects stored once, streams compressed')
+    parser.add_argument('--image-dpi', type=int,
+                        help='with --optimize, downsample larger images to this resolution (needs Pillow)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    convert = subparsers.add_parser('convert', help='convert emails to PDF')
+    convert.add_argument('inputs', nargs='+', help='.eml/.msg files or directories')
+    convert.add_argument('-o', '--output', required=True, help='output directory')
+    convert.set_defaults(handler=command_convert)
+
+    combine = subparsers.add_parser('combine', help='combine groups of files into PDFs')
+    source = combine.add_mutually_exclusive_group(required=True)
+    source.add_argument('directory', nargs='?', help='directory whose subdirectories are the groups')
+    source.add_argument('--manifest', help='JSON manifest with a "combine" list')
+    combine.add_argument('-o', '--output', required=True, help='output directory')
+    combine.add_argument('--streaming', action='store_true', help='use the low-memory streaming merge')
+    combine.add_argument('--attachments', choices=list(ATTACHMENT_LABELS), default=ATTACHMENTS_CONVERT,
+                         help='convert attachments with their email (default), merge attached PDFs '
+                              'separately after it, or merge only the attached PDFs')
+    combine.add_argument('--attachment-images', action='store_true',
+                         help='with --attachments separate/only, also add attached images, one per page')
+    combine.set_defaults(handler=command_combine)
+
+    split = subparsers.add_parser('split', help='extract page ranges from PDFs')
+    split.add_argument('input', nargs='?', help='PDF to split')
+    split.add_argument('--pages', help="pages to keep in output order, e.g. '1, 3-5', '5-', 'last', '10-1' or '1-:2'")
+    split.add_argument('--range-sets', help="several outputs in one pass, e.g. '1-3; 4-10; 11'")
+    split.add_argument('--every', type=int, help='one output per N pages')
+    split.add_argument('--by-bookmark', action='store_true', help='one output per top-level bookmark')
+    split.add_argument('--manifest', help='JSON manifest with a "split" list')
+    split.add_argument('-o', '--output', required=True,
+                       help='output PDF, or directory with --manifest, --range-sets, --every or --by-bookmark')
+    split.set_defaults(handler=command_split)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        return args.handler(args)
+    except ConversionError as e:
+        print(str(e), file=sys.stderr)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
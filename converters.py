@@ -0,0 +1,123 @@
+import os
+from concurrent.futures import as_completed
+
+import zamzar
+from emails import parse_email_file
+from render import render_email
+from workers import process_pool
+from zamzar import ConversionError
+
+# Converter backends offered to the user
+CONVERTER_LOCAL = 'local'
+CONVERTER_ZAMZAR = 'zamzar'
+CONVERTER_LOCAL_WITH_FALLBACK = 'local+zamzar'
+CONVERTER_LABELS = {
+    CONVERTER_LOCAL: 'Local (offline)',
+    CONVERTER_ZAMZAR: 'Zamzar',
+    CONVERTER_LOCAL_WITH_FALLBACK: 'Local with Zamzar fallback',
+}
+
+# Every backend exposes
+# `convert_files(jobs, on_complete=None, stats=None, on_warning=None, **resume)`,
+# taking the same (key, file_name, source_path, output_path) jobs as
+# zamzar.convert_files and raising ConversionError with the failed keys.
+# `on_warning(key, message)` reports a result that was produced with some loss.
+# `resume` is the `submitted`/`on_submitted` pair that lets remote jobs outlive
+# the process; backends that finish everything in one call ignore it.
+# `cache_format` keeps results from different renderers apart in the conversion
+# cache.
+
+
+class ZamzarConverter:
+    needs_api_key = True
+    cache_format = 'pdf'
+
+    def __init__(self, api_key, **options):
+        self.client = zamzar.get_client(api_key)
+        self.options = options
+
+    def convert_files(self, jobs, on_complete=None, stats=None, on_warning=None, **resume):
+        return zamzar.convert_files(self.client, jobs, on_complete=on_complete, stats=stats, **resume, **self.options)
+
+
+def render_email_file(file_name, source_path, output_path, strict=True):
+    # Module-level so it can run in a worker process; only paths cross the process
+    # boundary. Returns the output path and the characters drawn as '?', which
+    # are only allowed when not `strict`.
+    missing = None if strict else set()
+    render_email(parse_email_file(file_name, source_path), output_path, missing)
+    return output_path, ''.join(sorted(missing or ()))
+
+
+class LocalConverter:
+    # With `strict`, an email with characters the built-in fonts cannot show
+    # fails, so another converter can take it; otherwise they are drawn as '?'
+    # and reported through `on_warning`
+    needs_api_key = False
+    cache_format = 'local.pdf'
+
+    def __init__(self, max_workers=None, strict=False):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.strict = strict
+
+    def convert_files(self, jobs, on_complete=None, stats=None, on_warning=None, **resume):
+        results = {}
+        errors = []
+        failed = []
+        if not jobs:
+            return results
+
+        with process_pool(max(1, min(self.max_workers, len(jobs)))) as executor:
+            futures = {
+                executor.submit(render_email_file, file_name, source_path, output_path, self.strict): (key, file_name)
+                for key, file_name, source_path, output_path in jobs
+            }
+            for future in as_completed(futures):
+                key, file_name = futures[future]
+                try:
+                    output_path, missing = future.result()
+                except Exception as e:
+                    errors.append(f"Local conversion of {file_name} failed: {e}")
+                    failed.append(key)
+                    continue
+                if missing and on_warning is not None:
+                    on_warning(key, f"The local converter has no glyphs for {missing!r} in {file_name}; "
+                                    f"they are shown as '?'.")
+                results[key] = output_path
+                if on_complete is not None:
+                    on_complete(key, output_path)
+
+        if errors:
+            raise ConversionError(' '.join(errors), failed)
+        return results
+
+
+class FallbackConverter:
+    # Try `primary` first and send only the jobs it could not handle to `fallback`.
+    # Results from both are cached under a format of their own, so a run with
+    # only one of the backends is never served the other's render.
+    def __init__(self, primary, fallback, cache_format):
+        self.primary = primary
+        self.fallback = fallback
+        self.needs_api_key = primary.needs_api_key or fallback.needs_api_key
+        self.cache_format = cache_format
+
+    def convert_files(self, jobs, on_complete=None, stats=None, on_warning=None, **resume):
+        try:
+            return self.primary.convert_files(jobs, on_complete, stats, on_warning, **resume)
+        except ConversionError as e:
+            failed = set(e.failed)
+        results = {key: output_path for key, _, _, output_path in jobs if key not in failed}
+        retry = [job for job in jobs if job[0] in failed]
+        results.update(self.fallback.convert_files(retry, on_complete, stats, on_warning, **resume))
+        return results
+
+
+def get_converter(name, api_key=''):
+    if name == CONVERTER_LOCAL:
+        return LocalConverter()
+    if name == CONVERTER_ZAMZAR:
+        return ZamzarConverter(api_key)
+    if name == CONVERTER_LOCAL_WITH_FALLBACK:
+        return FallbackConverter(LocalConverter(strict=True), ZamzarConverter(api_key), 'local+zamzar.pdf')
+    raise ValueError(f"Unknown converter: {name}")
@@ -0,0 +1,382 @@
+import os
+import re
+import zipfile
+from concurrent.futures import as_completed
+
+from PyPDF2 import PdfMerger, PdfReader, PdfWriter
+
+from cache import content_hash
+from instrumentation import stage
+from merge import MergeError, stream_merge
+from optimize import optimize_pdf
+from ranges import RangeError, parse_ranges
+from workers import process_pool
+from zamzar import ConversionError
+
+# Core convert/combine/split operations shared by the Streamlit app and the CLI.
+# Nothing here touches Streamlit: problems are reported by raising
+# SelectionError, RangeError, SplitError, MergeError or ConversionError. Functions taking
+# `metrics` record their stages in that instrumentation.RunMetrics.
+
+EMAIL_TYPES = ('.eml', '.msg')
+
+# Below this many output pages, starting worker processes costs more than it saves
+PARALLEL_SPLIT_MIN_PAGES = 500
+
+
+class SelectionError(RangeError):
+    pass
+
+
+class SplitError(Exception):
+    pass
+
+
+def file_type(file_name):
+    return os.path.splitext(file_name)[1].lower()
+
+
+def is_email(file_name):
+    return file_type(file_name) in EMAIL_TYPES
+
+
+def parse_page_ranges(input_str, page_count):
+    # Pages such as '1, 3-5, 9-' of a `page_count`-page PDF, in the order given;
+    # see ranges.py for the syntax. Raises RangeError.
+    return parse_ranges(input_str, page_count)
+
+
+def parse_selection(input_str, count):
+    # One-based file indices such as '3, 1-2', limited to 1..count and in the
+    # order given, which is the order the files are combined in
+    try:
+        return list(parse_ranges(input_str, count, noun='file'))
+    except RangeError as e:
+        raise SelectionError(str(e)) from None
+
+
+def _read_error(source_path, error):
+    return SplitError(f"Error reading PDF file {os.path.basename(source_path)}: {error}")
+
+
+def split_pdf(source_path, page_numbers, output_path, metrics=None):
+    with open(source_path, 'rb') as pdf_file:
+        with stage(metrics, 'read') as read_stage:
+            pdf_writer = PdfWriter()
+            try:
+                pdf_reader = PdfReader(pdf_file)
+
+                # Adjust page numbers to zero-based indexing
+                max_page_number = len(pdf_reader.pages)
+                selected_pages = [p - 1 for p in page_numbers if 1 <= p <= max_page_number]
+                for page_num in selected_pages:
+                    pdf_writer.add_page(pdf_reader.pages[page_num])
+            except Exception as e:
+                raise _read_error(source_path, e) from e
+            if not selected_pages:
+                raise SplitError("No valid page numbers selected.")
+            read_stage.add(files=1, pages=len(selected_pages), bytes_in=os.path.getsize(source_path))
+
+        with stage(metrics, 'write') as write_stage:
+            with open(output_path, 'wb') as out_pdf_file:
+                pdf_writer.write(out_pdf_file)
+            write_stage.add(files=1, pages=len(selected_pages), bytes_out=os.path.getsize(output_path))
+    return output_path
+
+
+def page_count(source_path):
+    with open(source_path, 'rb') as pdf_file:
+        try:
+            return len(PdfReader(pdf_file).pages)
+        except Exception as e:
+            raise _read_error(source_path, e) from e
+
+
+def parse_range_groups(input_str, page_count):
+    # Several page-range sets separated by ';', e.g. '1-3; 4, 6; 7-'. Returns
+    # (label, pages) pairs, or raises RangeError naming the set that is invalid.
+    # Labels start with the set number, so repeated sets still get their own files.
+    groups = []
+    parts = input_str.split(';')
+    width = len(str(len(parts)))
+    for number, part in enumerate(parts, start=1):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            page_numbers = parse_page_ranges(part, page_count)
+        except RangeError as e:
+            raise RangeError(f"Set {number}: {e}") from None
+        label = f"{number:0{width}d}_pages_" + re.sub(r'\s+', '', part).replace(',', '_').replace(':', 'by')
+        groups.append((label, page_numbers))
+    if not groups:
+        raise RangeError("Enter at least one page range set.")
+    return groups
+
+
+def burst_groups(total_pages, every=1):
+    # One group per page, or per `every` pages
+    width = len(str(total_pages))
+    groups = []
+    for start in range(1, total_pages + 1, every):
+        end = min(start + every - 1, total_pages)
+        label = f"page_{start:0{width}d}" if start == end else f"pages_{start:0{width}d}-{end:0{width}d}"
+        groups.append((label, list(range(start, end + 1))))
+    return groups
+
+
+def bookmark_groups(source_path):
+    # One group per top-level bookmark, running up to the next one. Pages before
+    # the first bookmark become a 'front_matter' group.
+    with open(source_path, 'rb') as pdf_file:
+        try:
+            reader = PdfReader(pdf_file)
+            total_pages = len(reader.pages)
+            outline = reader.outline
+        except Exception as e:
+            raise _read_error(source_path, e) from e
+        starts = []
+        for item in outline:
+            if isinstance(item, list):
+                continue  # Nested bookmarks belong to the previous top-level one
+            try:
+                starts.append((reader.get_destination_page_number(item) + 1, str(item.title)))
+            except Exception:
+                continue
+    starts = sorted({start: title for start, title in starts if 1 <= start <= total_pages}.items())
+    if not starts:
+        return []
+
+    groups = []
+    if starts[0][0] > 1:
+        groups.append(('front_matter', list(range(1, starts[0][0]))))
+    for i, (start, title) in enumerate(starts):
+        end = starts[i + 1][0] - 1 if i + 1 < len(starts) else total_pages
+        label = f"{i + 1:02d}_" + (re.sub(r'[^\w.-]+', '_', title).strip('_') or 'bookmark')
+        groups.append((label, list(range(start, end + 1))))
+    return groups
+
+
+def _write_groups(source_path, groups, output_paths):
+    # Parse the source once and write every group from it; pages are only loaded
+    # when a group needs them, so the cost follows the number of pages written
+    written = []
+    with open(source_path, 'rb') as pdf_file:
+        try:
+            pdf_reader = PdfReader(pdf_file)
+            max_page_number = len(pdf_reader.pages)
+        except Exception as e:
+            raise _read_error(source_path, e) from e
+        for (_, page_numbers), output_path in zip(groups, output_paths):
+            pdf_writer = PdfWriter()
+            try:
+                for page_number in page_numbers:
+                    if 1 <= page_number <= max_page_number:
+                        pdf_writer.add_page(pdf_reader.pages[page_number - 1])
+            except Exception as e:
+                raise _read_error(source_path, e) from e
+            if not pdf_writer.pages:
+                continue
+            with open(output_path, 'wb') as out_pdf_file:
+                pdf_writer.write(out_pdf_file)
+            written.append(output_path)
+    return written
+
+
+def split_pdf_groups(source_path, groups, output_dir, base_name=None, max_workers=1, metrics=None):
+    # Write one PDF per (label, page_numbers) group. With max_workers > 1 the groups
+    # are divided into contiguous batches of similar page counts and each worker
+    # process parses the source once for its whole batch.
+    base_name = base_name or os.path.splitext(os.path.basename(source_path))[0]
+    output_paths = [os.path.join(output_dir, f"{base_name}_{label}.pdf") for label, _ in groups]
+    total_pages = sum(len(page_numbers) for _, page_numbers in groups)
+    with stage(metrics, 'split') as split_stage:
+        if max_workers <= 1 or len(groups) < 2 or total_pages < PARALLEL_SPLIT_MIN_PAGES:
+            written = _write_groups(source_path, groups, output_paths)
+        else:
+            batches = _balanced_batches(list(zip(groups, output_paths)), max_workers)
+            written_by_batch = {}
+            with process_pool(len(batches)) as executor:
+                futures = {
+                    executor.submit(_write_groups, source_path, [g for g, _ in batch], [p for _, p in batch]): i
+                    for i, batch in enumerate(batches)
+                }
+                for future in as_completed(futures):
+                    written_by_batch[futures[future]] = future.result()
+            written = [path for i in sorted(written_by_batch) for path in written_by_batch[i]]
+        if not written:
+            raise SplitError("No valid page numbers selected.")
+        split_stage.add(
+            files=len(written), pages=total_pages, bytes_in=os.path.getsize(source_path),
+            bytes_out=sum(os.path.getsize(path) for path in written)
+        )
+    return written
+
+
+def _balanced_batches(items, count):
+    total = sum(len(group[1]) for group, _ in items)
+    target = total / count
+    batches = [[]]
+    size = 0
+    for item in items:
+        if size >= target and len(batches) < count:
+            batches.append([])
+            size = 0
+        batches[-1].append(item)
+        size += len(item[0][1])
+    return batches
+
+
+def zip_files(paths, zip_path, metrics=None):
+    # Stream files into a zip one at a time; PDFs barely compress, so store them
+    with stage(metrics, 'zip') as zip_stage:
+        with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_STORED) as zip_file:
+            for path in paths:
+                zip_file.write(path, os.path.basename(path))
+        zip_stage.add(files=len(paths), bytes_out=os.path.getsize(zip_path))
+    return zip_path
+
+
+def combine_pdfs(paths, output_path, streaming=False, metrics=None):
+    if streaming:
+        # Write pages out as they are read so memory stays near one input document
+        with stage(metrics, 'stream_merge') as merge_stage:
+            stream_merge(paths, output_path, merge_stage)
+            merge_stage.add(bytes_out=os.path.getsize(output_path))
+        return output_path
+
+    pdf_merger = PdfMerger()
+    try:
+        with stage(metrics, 'read') as read_stage:
+            for path in paths:
+                try:
+                    with open(path, 'rb') as pdf_file:
+                        pdf_merger.append(PdfReader(pdf_file))
+                except Exception as e:
+                    raise MergeError(f"Error reading PDF file {os.path.basename(path)}: {e}") from e
+            read_stage.add(files=len(paths), pages=len(pdf_merger.pages),
+                           bytes_in=sum(os.path.getsize(path) for path in paths))
+        with stage(metrics, 'write') as write_stage:
+            with open(output_path, 'wb') as combined_pdf_file:
+                pdf_merger.write(combined_pdf_file)
+            write_stage.add(files=1, pages=len(pdf_merger.pages), bytes_out=os.path.getsize(output_path))
+    finally:
+        pdf_merger.close()
+    return output_path
+
+
+def optimize_output(path, image_dpi=None, metrics=None):
+    # Shrink the PDF at `path` in place (see optimize.py), keeping the original if
+    # the rewrite is no smaller. Returns (size before, size after).
+    optimized_path = path + '.optimized'
+    with stage(metrics, 'optimize') as optimize_stage:
+        try:
+            optimize_pdf(path, optimized_path, image_dpi=image_dpi, stage=optimize_stage)
+            before, after = os.path.getsize(path), os.path.getsize(optimized_path)
+            if after < before:
+                os.replace(optimized_path, path)
+            else:
+                after = before
+        finally:
+            if os.path.exists(optimized_path):
+                os.unlink(optimized_path)
+    return before, after
+
+
+def converted_name(file_name):
+    return os.path.splitext(file_name)[0] + '.pdf'
+
+
+def unique_path(path, used_paths):
+    # Add a numeric suffix if `path` was already handed out in this batch
+    stem, extension = os.path.splitext(path)
+    candidate = path
+    counter = 2
+    while candidate in used_paths:
+        candidate = f"{stem}-{counter}{extension}"
+        counter += 1
+    used_paths.add(candidate)
+    return candidate
+
+
+def convert_emails(converter, emails, output_dir, cache=None, on_cached=None, on_converted=None,
+                   stats=None, max_conversions=None, metrics=None, submitted=None, on_submitted=None,
+                   on_warning=None):
+    # Convert (file_name, source_path) emails to PDFs in `output_dir` and return a
+    # dict of file_name -> PDF path. Results already in `cache` are reused, files
+    # with identical content are converted once, and new results are added to the
+    # cache. `on_cached(file_name, path)` and `on_converted(file_names, path)` are
+    # called from the calling thread as results become available, and
+    # `on_warning(file_names, message)` for results produced with some loss. If
+    # more than `max_conversions` conversions would be needed, nothing is submitted.
+    # `submitted` and `on_submitted` are passed to the converter so remote jobs
+    # started by an earlier, interrupted call are resumed rather than redone.
+    results = {}
+    pending_jobs = []
+    pending_names = {}
+    used_paths = set()
+    stats = {} if stats is None else stats
+    with stage(metrics, 'convert') as convert_stage:
+        for file_name, source_path in emails:
+            output_path = unique_path(
+                os.path.join(output_dir, converted_name(os.path.basename(file_name))), used_paths
+            )
+            with open(source_path, 'rb') as source_file:
+                if cache is not None:
+                    key = cache.key_for(source_file, converter.cache_format)
+                else:
+                    key = f"{content_hash(source_file)}.{converter.cache_format}"
+            convert_stage.add(files=1, bytes_in=os.path.getsize(source_path))
+
+            # Check if these exact bytes have already been converted
+            if cache is not None and cache.get(key, output_path):
+                results[file_name] = output_path
+                convert_stage.add(cache_hits=1, bytes_out=os.path.getsize(output_path))
+                if on_cached is not None:
+                    on_cached(file_name, output_path)
+            elif key not in pending_names:
+                pending_names[key] = [file_name]
+                pending_jobs.append((key, file_name, source_path, output_path))
+            else:
+                # Same content selected twice under different names
+                pending_names[key].append(file_name)
+
+        new_jobs = [job for job in pending_jobs if job[0] not in (submitted or {})]
+        if max_conversions is not None and len(new_jobs) > max_conversions:
+            raise ConversionError(
+                f"Only {max_conversions} conversions remain but {len(new_jobs)} email files need converting.",
+                [job[0] for job in new_jobs]
+            )
+
+        def on_complete(key, output_path):
+            if cache is not None:
+                cache.put(key, output_path)
+            for file_name in pending_names[key]:
+                results[file_name] = output_path
+            convert_stage.add(bytes_out=os.path.getsize(output_path))
+            if on_converted is not None:
+                on_converted(pending_names[key], output_path)
+
+        def on_job_warning(key, message):
+            if on_warning is not None:
+                on_warning(pending_names[key], message)
+
+        try:
+            converter.convert_files(
+                pending_jobs, on_complete=on_complete, stats=stats, on_warning=on_job_warning,
+                submitted=submitted, on_submitted=on_submitted
+            )
+        finally:
+            # Where the time of Zamzar jobs went; these are summed over jobs that
+            # ran concurrently, so together they can exceed the stage's wall time
+            if stats:
+                jobs = stats.values()
+                convert_stage.add(api_calls=sum(job.api_calls for job in jobs))
+                convert_stage.details.update({
+                    'upload_seconds': sum(job.upload_time for job in jobs),
+                    'queue_seconds': sum(job.wait_time for job in jobs),
+                    'download_seconds': sum(job.download_time for job in jobs),
+                    'bytes_uploaded': sum(job.bytes_sent for job in jobs),
+                    'bytes_downloaded': sum(job.bytes_received for job in jobs),
+                })
+    return results
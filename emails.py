@@ -0,0 +1,202 @@
+import email
+import email.policy
+import mimetypes
+import os
+import struct
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+try:
+    import olefile
+except ImportError:  # Only needed for .msg files
+    olefile = None
+
+# Headers shown at the top of a rendered email, in this order
+SUMMARY_HEADERS = ['From', 'To', 'Cc', 'Date', 'Subject']
+
+
+class EmailParseError(Exception):
+    pass
+
+
+class Attachment:
+    __slots__ = ('filename', 'mime_type', 'data', 'content_id')
+
+    def __init__(self, filename, mime_type, data, content_id=None):
+        self.filename = filename
+        self.mime_type = mime_type
+        self.data = data
+        self.content_id = content_id
+
+    @property
+    def is_pdf(self):
+        return self.mime_type == 'application/pdf' or self.filename.lower().endswith('.pdf')
+
+    @property
+    def is_image(self):
+        return self.mime_type.startswith('image/')
+
+
+class ParsedEmail:
+    # The parts of a message needed to render it: summary headers, plain and HTML
+    # bodies, images referenced from the HTML by Content-ID, and attachments.
+    def __init__(self, headers=None, text=None, html=None, inline_images=None, attachments=None):
+        self.headers = headers or {}
+        self.text = text
+        self.html = html
+        self.inline_images = inline_images or {}
+        self.attachments = attachments or []
+
+
+def parse_email_file(file_name, source):
+    # `source` is either the raw bytes or the path of the file on disk
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension == '.eml':
+        if isinstance(source, (bytes, bytearray)):
+            return parse_eml(source)
+        with open(source, 'rb') as eml_file:
+            return parse_eml(eml_file)
+    if extension == '.msg':
+        return parse_msg(source)
+    raise EmailParseError(f"Unsupported email type: {extension}")
+
+
+def parse_eml(data):
+    # Accepts bytes or a binary file object
+    if isinstance(data, (bytes, bytearray)):
+        message = email.message_from_bytes(data, policy=email.policy.default)
+    else:
+        message = email.message_from_binary_file(data, policy=email.policy.default)
+    headers = {name: str(message[name]) for name in SUMMARY_HEADERS if message[name] is not None}
+
+    text_part = message.get_body(preferencelist=('plain',))
+    html_part = message.get_body(preferencelist=('html',))
+    text = _part_text(text_part) if text_part is not None else None
+    html = _part_text(html_part) if html_part is not None else None
+
+    inline_images = {}
+    attachments = []
+    for part in message.walk():
+        if part.is_multipart() or part is text_part or part is html_part:
+            continue
+        content_id = (part['Content-ID'] or '').strip().strip('<>') or None
+        payload = part.get_payload(decode=True) or b''
+        mime_type = part.get_content_type()
+        if content_id and part.get_content_maintype() == 'image' and part.get_content_disposition() != 'attachment':
+            inline_images[content_id] = Attachment(part.get_filename() or content_id, mime_type, payload, content_id)
+        elif part.get_filename() or part.get_content_disposition() == 'attachment':
+            attachments.append(Attachment(part.get_filename() or 'attachment', mime_type, payload, content_id))
+    return ParsedEmail(headers, text, html, inline_images, attachments)
+
+
+def _part_text(part):
+    try:
+        return part.get_content()
+    except (LookupError, UnicodeDecodeError):
+        return (part.get_payload(decode=True) or b'').decode('utf-8', errors='replace')
+
+
+# MAPI property ids used when reading Outlook .msg files
+_PR_SUBJECT = 0x0037
+_PR_CLIENT_SUBMIT_TIME = 0x0039
+_PR_SENDER_NAME = 0x0C1A
+_PR_SENDER_EMAIL = 0x0C1F
+_PR_DISPLAY_CC = 0x0E03
+_PR_DISPLAY_TO = 0x0E04
+_PR_BODY = 0x1000
+_PR_HTML = 0x1013
+_PR_ATTACH_DATA = 0x3701
+_PR_ATTACH_FILENAME = 0x3704
+_PR_ATTACH_LONG_FILENAME = 0x3707
+_PR_ATTACH_MIME_TAG = 0x370E
+_PR_ATTACH_CONTENT_ID = 0x3712
+
+
+def parse_msg(data):
+    # Accepts bytes or a path; olefile reads paths directly from disk
+    if olefile is None:
+        raise EmailParseError("The olefile package is required to read .msg files.")
+    if isinstance(data, (bytes, bytearray)):
+        header = data[:len(olefile.MAGIC)]
+    else:
+        with open(data, 'rb') as msg_file:
+            header = msg_file.read(len(olefile.MAGIC))
+    if header != olefile.MAGIC:
+        raise EmailParseError("Not an Outlook .msg file.")
+
+    with olefile.OleFileIO(data) as ole:
+        sender = _msg_string(ole, [], _PR_SENDER_NAME)
+        sender_email = _msg_string(ole, [], _PR_SENDER_EMAIL)
+        if sender and sender_email and '@' in sender_email and sender_email not in sender:
+            sender = f"{sender} <{sender_email}>"
+        headers = {
+            'From': sender or sender_email,
+            'To': _msg_string(ole, [], _PR_DISPLAY_TO),
+            'Cc': _msg_string(ole, [], _PR_DISPLAY_CC),
+            'Date': _msg_submit_time(ole),
+            'Subject': _msg_string(ole, [], _PR_SUBJECT),
+        }
+        headers = {name: value for name, value in headers.items() if value}
+
+        text = _msg_string(ole, [], _PR_BODY)
+        html = _msg_string(ole, [], _PR_HTML)
+
+        inline_images = {}
+        attachments = []
+        storages = sorted({entry[0] for entry in ole.listdir() if entry[0].startswith('__attach_version1.0_#')})
+        for storage in storages:
+            payload = _msg_stream(ole, [storage], _PR_ATTACH_DATA, '0102')
+            if payload is None:
+                continue  # Embedded messages and OLE objects are not extracted
+            filename = (_msg_string(ole, [storage], _PR_ATTACH_LONG_FILENAME)
+                        or _msg_string(ole, [storage], _PR_ATTACH_FILENAME) or 'attachment')
+            mime_type = _msg_string(ole, [storage], _PR_ATTACH_MIME_TAG) or _guess_mime_type(filename)
+            content_id = _msg_string(ole, [storage], _PR_ATTACH_CONTENT_ID)
+            attachment = Attachment(filename, mime_type.lower(), payload, content_id)
+            if content_id and attachment.is_image and html and f"cid:{content_id}" in html:
+                inline_images[content_id] = attachment
+            else:
+                attachments.append(attachment)
+    return ParsedEmail(headers, text, html, inline_images, attachments)
+
+
+def _msg_stream(ole, storage, prop_id, prop_type):
+    path = storage + [f"__substg1.0_{prop_id:04X}{prop_type}"]
+    if not ole.exists(path):
+        return None
+    return ole.openstream(path).read()
+
+
+def _msg_string(ole, storage, prop_id):
+    value = _msg_stream(ole, storage, prop_id, '001F')
+    if value is not None:
+        return value.decode('utf-16-le', errors='replace').rstrip('\x00')
+    if prop_id == _PR_HTML:
+        # Outlook usually stores the HTML body as binary in the message's code page
+        value = _msg_stream(ole, storage, prop_id, '0102')
+        if value is not None:
+            try:
+                return value.decode('utf-8').rstrip('\x00')
+            except UnicodeDecodeError:
+                return value.decode('cp1252', errors='replace').rstrip('\x00')
+    value = _msg_stream(ole, storage, prop_id, '001E')
+    if value is not None:
+        return value.decode('cp1252', errors='replace').rstrip('\x00')
+    return None
+
+
+def _msg_submit_time(ole):
+    # Fixed-size properties live in one stream: a 32-byte header then 16-byte entries
+    if not ole.exists('__properties_version1.0'):
+        return None
+    properties = ole.openstream('__properties_version1.0').read()
+    for offset in range(32, len(properties) - 15, 16):
+        prop_type, prop_id, _, value = struct.unpack_from('<HHIQ', properties, offset)
+        if prop_id == _PR_CLIENT_SUBMIT_TIME and prop_type == 0x0040:
+            submitted = datetime(1601, 1, 1, tzinfo=timezone.utc) + timedelta(microseconds=value // 10)
+            return format_datetime(submitted)
+    return None
+
+
+def _guess_mime_type(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
@@ -0,0 +1,258 @@
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Structured timings for each stage of a convert/combine or split run.
+#
+# A RunMetrics is created per run and passed down to core functions, which wrap
+# their work in `metrics.stage(name)` and add counters to the stage they are in.
+# When the run ends, `emit(run)` writes it as one JSON log line and adds it to the
+# process-wide totals exported in Prometheus text format.
+#
+# Set EMLPDF_METRICS_LOG to also append the JSON lines to a file, and
+# EMLPDF_METRICS_FILE to keep a Prometheus textfile-collector file up to date.
+# Other modules can add gauges, such as disk usage, with `publish_gauges`.
+# With EMLPDF_TRACE_MEMORY=1 each stage reports its own Python allocation peak
+# as `peak_mb` (via tracemalloc, which slows everything down); otherwise that is
+# left empty. Every stage also reports `rss_delta_mb`, how much the process's
+# resident memory grew (or shrank) while it ran. That is cheap, but it includes
+# whatever other runs in the same process allocated meanwhile.
+
+METRICS_LOG = os.environ.get('EMLPDF_METRICS_LOG', '')
+METRICS_FILE = os.environ.get('EMLPDF_METRICS_FILE', '')
+TRACE_MEMORY = os.environ.get('EMLPDF_TRACE_MEMORY', '') == '1'
+
+# Counters every stage carries, in display order
+COUNTERS = ('files', 'pages', 'bytes_in', 'bytes_out', 'cache_hits', 'api_calls')
+
+logger = logging.getLogger('emlpdf.metrics')
+
+
+def max_rss_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def rss_mb():
+    # Current resident set size, where /proc is available
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+
+class Stage:
+    __slots__ = ('name', 'seconds', 'peak_mb', 'rss_delta_mb', 'status', 'counters', 'details')
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.peak_mb = None
+        self.rss_delta_mb = None
+        self.status = 'ok'
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        # Extra per-stage breakdowns, e.g. cumulative Zamzar upload time
+        self.details = {}
+
+    def add(self, **counters):
+        for name, value in counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def as_dict(self):
+        return {
+            'stage': self.name,
+            'seconds': round(self.seconds, 4),
+            'peak_mb': None if self.peak_mb is None else round(self.peak_mb, 1),
+            'rss_delta_mb': None if self.rss_delta_mb is None else round(self.rss_delta_mb, 1),
+            'status': self.status,
+            **self.counters,
+            **{name: round(value, 4) if isinstance(value, float) else value for name, value in self.details.items()},
+        }
+
+
+class RunMetrics:
+    def __init__(self, flow, **labels):
+        self.flow = flow
+        self.run_id = uuid.uuid4().hex[:12]
+        self.labels = labels
+        self.stages = []
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.seconds = None
+        self.status = 'ok'
+
+    @contextmanager
+    def stage(self, name):
+        stage = Stage(name)
+        self.stages.append(stage)
+        tracing = TRACE_MEMORY and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        rss_start = rss_mb()
+        start = time.perf_counter()
+        try:
+            yield stage
+        except BaseException:
+            stage.status = 'error'
+            self.status = 'error'
+            raise
+        finally:
+            stage.seconds = time.perf_counter() - start
+            if tracing:
+                stage.peak_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+                tracemalloc.stop()
+            rss_end = rss_mb()
+            if rss_start is not None and rss_end is not None:
+                stage.rss_delta_mb = rss_end - rss_start
+
+    def finish(self, status=None):
+        if self.seconds is None:
+            self.seconds = time.perf_counter() - self._start
+        if status is not None:
+            self.status = status
+        return self
+
+    def totals(self):
+        totals = dict.fromkeys(COUNTERS, 0)
+        for stage in self.stages:
+            for name, value in stage.counters.items():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+    def as_dict(self):
+        return {
+            'run_id': self.run_id,
+            'flow': self.flow,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(self.started)),
+            'seconds': None if self.seconds is None else round(self.seconds, 4),
+            'status': self.status,
+            'labels': self.labels,
+            'totals': self.totals(),
+            'stages': [stage.as_dict() for stage in self.stages],
+        }
+
+
+@contextmanager
+def _untracked(name):
+    yield Stage(name)
+
+
+def stage(metrics, name):
+    # `metrics.stage(name)`, or a throwaway stage when the caller passed no metrics
+    return metrics.stage(name) if metrics is not None else _untracked(name)
+
+
+class MetricsRegistry:
+    # Cumulative totals over every emitted run in this process, by flow and stage
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._runs = {}
+        self._stages = {}
+        self._gauges = {}
+
+    def record(self, run):
+        with self._lock:
+            key = (run.flow, run.status)
+            self._runs[key] = self._runs.get(key, 0) + 1
+            for stage in run.stages:
+                totals = self._stages.setdefault((run.flow, stage.name), {'count': 0, 'seconds': 0.0})
+                totals['count'] += 1
+                totals['seconds'] += stage.seconds
+                for name, value in stage.counters.items():
+                    totals[name] = totals.get(name, 0) + value
+
+    def set_gauge(self, name, value, help_text):
+        with self._lock:
+            self._gauges[name] = (value, help_text)
+
+    def render_prometheus(self):
+        lines = [
+            '# HELP emlpdf_runs_total Completed runs by flow and status.',
+            '# TYPE emlpdf_runs_total counter',
+        ]
+        with self._lock:
+            for (flow, status), count in sorted(self._runs.items()):
+                lines.append(f'emlpdf_runs_total{{flow="{flow}",status="{status}"}} {count}')
+            stages = sorted(self._stages.items())
+            metrics = [('count', 'stage_runs_total', 'Times a stage ran.'),
+                       ('seconds', 'stage_seconds_total', 'Wall time spent in a stage.')]
+            metrics += [(name, f'stage_{name}_total', f'Total {name.replace("_", " ")} counted in a stage.')
+                        for name in COUNTERS]
+            for field, metric, help_text in metrics:
+                lines.append(f'# HELP emlpdf_{metric} {help_text}')
+                lines.append(f'# TYPE emlpdf_{metric} counter')
+                for (flow, stage), totals in stages:
+                    lines.append(f'emlpdf_{metric}{{flow="{flow}",stage="{stage}"}} {totals.get(field, 0):g}')
+            for name, (value, help_text) in sorted(self._gauges.items()):
+                lines.append(f'# HELP emlpdf_{name} {help_text}')
+                lines.append(f'# TYPE emlpdf_{name} gauge')
+                lines.append(f'emlpdf_{name} {value:g}')
+        rss = max_rss_mb()
+        if rss is not None:
+            lines.append('# HELP emlpdf_max_rss_megabytes Peak resident memory of this process.')
+            lines.append('# TYPE emlpdf_max_rss_megabytes gauge')
+            lines.append(f'emlpdf_max_rss_megabytes {rss:.1f}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        # Write atomically so a scraper never reads a half-written file
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.render_prometheus())
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+
+REGISTRY = MetricsRegistry()
+
+_log_lock = threading.Lock()
+
+
+def emit(run, status=None):
+    # Finish `run`, log it as a JSON line and add it to the Prometheus totals
+    run.finish(status)
+    line = json.dumps(run.as_dict(), sort_keys=True)
+    logger.info(line)
+    if METRICS_LOG:
+        with _log_lock, open(METRICS_LOG, 'a') as log_file:
+            log_file.write(line + '\n')
+    REGISTRY.record(run)
+    _write_metrics_file()
+    return line
+
+
+def publish_gauges(gauges):
+    # Set process-wide gauges from {name: (value, help text)} and export them
+    for name, (value, help_text) in gauges.items():
+        REGISTRY.set_gauge(name, value, help_text)
+    _write_metrics_file()
+
+
+def _write_metrics_file():
+    if METRICS_FILE:
+        try:
+            REGISTRY.write_prometheus(METRICS_FILE)
+        except OSError as e:
+            logger.warning("Could not write %s: %s", METRICS_FILE, e)
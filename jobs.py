@@ -0,0 +1,380 @@
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import link_or_copy
+from converters import CONVERTER_LOCAL, get_converter
+from core import ConversionError, MergeError, combine_pdfs, convert_emails, is_email, optimize_output
+from instrumentation import RunMetrics, emit, publish_gauges
+from workers import directory_size, run_every
+
+# Convert-and-combine jobs that run in the background and outlive the script run,
+# the browser tab and the server process that started them.
+#
+# Each job is a directory under the job root holding a copy of its inputs, its
+# converted PDFs, its output and a job.json with everything needed to carry on:
+# the Zamzar job id of every submitted conversion, the PDFs already produced and
+# how far the merge got. A JobRunner shared by every session runs at most
+# `max_workers` jobs at once and, when it starts, picks up every job that was
+# still queued or running when the previous process stopped.
+#
+# API keys are never written to disk. After a restart a job that still needs
+# Zamzar uses ZAMZAR_API_KEY if it is set, and otherwise waits for `resume()`.
+#
+# Finished jobs are swept after `max_age`, or sooner when all job directories
+# together exceed `max_bytes`; each sweep publishes their disk usage.
+
+DEFAULT_JOBS_DIR = os.environ.get('EMLPDF_JOBS_DIR', os.path.join(tempfile.gettempdir(), 'emlpdf-jobs'))
+
+# Jobs running at the same time across all sessions on this server
+DEFAULT_MAX_JOBS = int(os.environ.get('EMLPDF_MAX_JOBS', '2'))
+
+# Finished jobs and their files are removed after this many seconds
+DEFAULT_JOB_MAX_AGE = float(os.environ.get('EMLPDF_JOB_MAX_AGE', str(24 * 3600)))
+
+# Seconds between sweeps for finished jobs while the server runs
+DEFAULT_JOB_SWEEP_INTERVAL = float(os.environ.get('EMLPDF_JOB_SWEEP_INTERVAL', '600'))
+
+# Bytes all job directories may use; past this the oldest finished jobs are
+# removed early. Unfinished jobs are never removed for space.
+DEFAULT_JOBS_QUOTA = int(os.environ.get('EMLPDF_JOBS_QUOTA', str(10 * 1024 ** 3)))
+
+QUEUED = 'queued'
+RUNNING = 'running'
+WAITING = 'waiting for API key'
+DONE = 'done'
+FAILED = 'failed'
+UNFINISHED = (QUEUED, RUNNING, WAITING)
+
+# Progress lines kept per job for the UI
+MAX_EVENTS = 200
+
+
+class JobStore:
+    # One directory per job; job.json is replaced atomically on every save
+    def __init__(self, root=DEFAULT_JOBS_DIR):
+        self.root = root
+        # Disk usage as of the last sweep
+        self.bytes = 0
+        self.jobs = 0
+        os.makedirs(self.root, exist_ok=True)
+
+    def job_dir(self, job_id):
+        return os.path.join(self.root, job_id)
+
+    def save(self, state):
+        state['updated'] = time.time()
+        job_dir = self.job_dir(state['id'])
+        fd, temp_path = tempfile.mkstemp(dir=job_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f)
+            os.replace(temp_path, os.path.join(job_dir, 'job.json'))
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def load(self, job_id):
+        try:
+            with open(os.path.join(self.job_dir(job_id), 'job.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def all(self):
+        states = []
+        for entry in os.scandir(self.root):
+            if entry.is_dir():
+                state = self.load(entry.name)
+                if state is not None:
+                    states.append(state)
+        return sorted(states, key=lambda state: state['created'])
+
+    def delete(self, job_id):
+        shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+
+    def sweep(self, max_age=DEFAULT_JOB_MAX_AGE, max_bytes=None):
+        # Remove finished jobs older than `max_age`, and directories without a
+        # job.json; then, while the rest take more than `max_bytes`, the finished
+        # jobs that were updated longest ago. Returns the ids removed.
+        now = time.time()
+        swept = []
+        finished = []
+        total = 0
+        jobs = 0
+        for entry in os.scandir(self.root):
+            if not entry.is_dir():
+                continue
+            state = self.load(entry.name)
+            if state is None:
+                if now - entry.stat().st_mtime > max_age:
+                    self.delete(entry.name)
+                    swept.append(entry.name)
+                    continue
+            elif state['status'] not in UNFINISHED and now - state['updated'] > max_age:
+                self.delete(entry.name)
+                swept.append(entry.name)
+                continue
+            # Files linked from session storage or the cache count in full
+            size = directory_size(entry.path)
+            total += size
+            jobs += 1
+            if state is not None and state['status'] not in UNFINISHED:
+                finished.append((state['updated'], entry.name, size))
+        for _, job_id, size in sorted(finished):
+            if max_bytes is None or total <= max_bytes:
+                break
+            self.delete(job_id)
+            swept.append(job_id)
+            total -= size
+            jobs -= 1
+        self.bytes = total
+        self.jobs = jobs
+        return swept
+
+
+class Job:
+    # In-memory view of one job's state. All changes go through `update`, which
+    # persists them before anyone else can see them.
+    def __init__(self, store, state):
+        self.store = store
+        self.state = state
+        self._lock = threading.Lock()
+
+    @property
+    def id(self):
+        return self.state['id']
+
+    @property
+    def directory(self):
+        return self.store.job_dir(self.id)
+
+    def snapshot(self):
+        with self._lock:
+            return json.loads(json.dumps(self.state))
+
+    def update(self, event=None, **changes):
+        with self._lock:
+            self.state.update(changes)
+            if event:
+                self.state['events'] = (self.state['events'] + [event])[-MAX_EVENTS:]
+            self.store.save(self.state)
+
+    def record_submitted(self, key, zamzar_job_id):
+        with self._lock:
+            self.state['submitted'][key] = zamzar_job_id
+            self.store.save(self.state)
+
+    def record_converted(self, file_names, path, event):
+        with self._lock:
+            for file_name in file_names:
+                self.state['converted'][file_name] = path
+            self.state['events'] = (self.state['events'] + [event])[-MAX_EVENTS:]
+            self.store.save(self.state)
+
+
+class JobRunner:
+    # With `sweep_interval`, finished jobs older than `max_age`, or past
+    # `max_bytes`, are removed every that many seconds for as long as the process
+    # runs, not only at startup
+    def __init__(self, store=None, max_workers=DEFAULT_MAX_JOBS, cache=None, max_age=DEFAULT_JOB_MAX_AGE,
+                 sweep_interval=None, max_bytes=DEFAULT_JOBS_QUOTA):
+        self.store = store or JobStore()
+        self.cache = cache
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.swept_jobs = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._jobs = {}
+        self._api_keys = {}
+        self._lock = threading.Lock()
+        self.sweep()
+        self._resume_unfinished()
+        if sweep_interval:
+            self._stop = run_every(sweep_interval, self.sweep, 'job-sweep')
+
+    def sweep(self):
+        # Remove old finished jobs from disk and forget them, then publish disk usage
+        with self._lock:
+            swept = self.store.sweep(self.max_age, self.max_bytes)
+            for job_id in swept:
+                self._jobs.pop(job_id, None)
+                self._api_keys.pop(job_id, None)
+            self.swept_jobs += len(swept)
+        publish_gauges({
+            'jobs_bytes': (self.store.bytes, 'Bytes of background job directories on disk.'),
+            'jobs_count': (self.store.jobs, 'Background job directories on disk.'),
+            'jobs_swept': (self.swept_jobs, 'Background job directories removed.'),
+        })
+
+    def submit_combine(self, inputs, converter_name, api_key='', streaming=False, output_name=None,
+                       max_conversions=None, optimize=False, image_dpi=None):
+        # Queue a convert-and-combine job. `inputs` are (file_name, path) pairs in
+        # combine order; they are copied into the job so the caller's files can go.
+        # With `optimize` the combined PDF is shrunk with core.optimize_output.
+        job_id = uuid.uuid4().hex
+        job_dir = self.store.job_dir(job_id)
+        os.makedirs(os.path.join(job_dir, 'inputs'))
+        os.makedirs(os.path.join(job_dir, 'converted'))
+        job_inputs = []
+        for position, (file_name, path) in enumerate(inputs):
+            # A numbered subdirectory keeps inputs with the same base name apart
+            input_dir = os.path.join(job_dir, 'inputs', str(position))
+            os.makedirs(input_dir)
+            job_inputs.append({
+                'name': file_name,
+                'path': link_or_copy(path, os.path.join(input_dir, os.path.basename(file_name))),
+            })
+
+        state = {
+            'id': job_id,
+            'kind': 'combine',
+            'status': QUEUED,
+            'message': '',
+            'created': time.time(),
+            'converter': converter_name,
+            'streaming': streaming,
+            'max_conversions': max_conversions,
+            'optimize': optimize,
+            'image_dpi': image_dpi,
+            'optimized': None,
+            'inputs': job_inputs,
+            'submitted': {},
+            'converted': {},
+            'merged': 0,
+            'output': None,
+            'output_name': output_name or 'combined_output.pdf',
+            'events': [],
+            'poll_stats': [],
+            'metrics': None,
+        }
+        job = Job(self.store, state)
+        job.update()
+        with self._lock:
+            self._jobs[job_id] = job
+            self._api_keys[job_id] = api_key
+        self._executor.submit(self._run, job)
+        return job_id
+
+    def get(self, job_id):
+        # Snapshot of a job's state, or None if it is unknown or has been swept
+        if not re.fullmatch(r'[0-9a-f]{32}', job_id or ''):
+            return None  # Ids come from the URL, so never let one name another path
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job.snapshot()
+        return self.store.load(job_id)
+
+    def resume(self, job_id, api_key):
+        # Restart a job that was waiting for its API key after a restart
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.state['status'] != WAITING:
+                return False
+            self._api_keys[job_id] = api_key
+        job.update(status=QUEUED, message='')
+        self._executor.submit(self._run, job)
+        return True
+
+    def _resume_unfinished(self):
+        env_key = os.environ.get('ZAMZAR_API_KEY', '')
+        for state in self.store.all():
+            if state['status'] not in UNFINISHED:
+                continue
+            job = Job(self.store, state)
+            self._jobs[job.id] = job
+            self._api_keys[job.id] = env_key
+            if self._needs_api_key(state) and not env_key:
+                job.update(status=WAITING, message="The server restarted; enter the API key to resume.")
+            else:
+                job.update(status=QUEUED, event='Resuming after a server restart')
+                self._executor.submit(self._run, job)
+
+    def _needs_api_key(self, state):
+        pending = [i for i in state['inputs'] if is_email(i['name']) and i['name'] not in state['converted']]
+        return bool(pending) and state['converter'] != CONVERTER_LOCAL
+
+    def _run(self, job):
+        state = job.snapshot()
+        metrics = RunMetrics('combine', converter=state['converter'], streaming=state['streaming'],
+                             files=len(state['inputs']), job=job.id)
+        job.update(status=RUNNING, message='')
+        try:
+            self._convert(job, metrics)
+            self._merge(job, metrics)
+        except (ConversionError, MergeError, OSError) as e:
+            emit(metrics, FAILED)
+            job.update(status=FAILED, message=str(e), metrics=metrics.as_dict())
+            return
+        except Exception as e:
+            # Nobody is waiting on this thread, so the job state is the only place to report it
+            emit(metrics, FAILED)
+            job.update(status=FAILED, message=f"Unexpected error: {e}", metrics=metrics.as_dict())
+            return
+        emit(metrics)
+        job.update(status=DONE, metrics=metrics.as_dict(), event='Combined PDF is ready')
+
+    def _convert(self, job, metrics):
+        state = job.snapshot()
+        emails = [
+            (i['name'], i['path']) for i in state['inputs']
+            if is_email(i['name']) and not os.path.exists(state['converted'].get(i['name']) or '')
+        ]
+        if not emails:
+            return
+        converter = get_converter(state['converter'], self._api_keys.get(job.id, ''))
+        if converter.needs_api_key and not self._api_keys.get(job.id):
+            raise ConversionError('API key is required for .eml and .msg to .pdf conversion.')
+
+        def on_cached(file_name, path):
+            job.record_converted([file_name], path, f"Using cached PDF for {file_name}")
+
+        def on_converted(file_names, path):
+            job.record_converted(file_names, path, f"PDF created: {os.path.basename(path)}")
+
+        def on_warning(file_names, message):
+            job.update(event=message)
+
+        poll_stats = {}
+        try:
+            # A fresh directory per attempt, so names given out by an earlier attempt are never reused
+            output_dir = tempfile.mkdtemp(dir=os.path.join(job.directory, 'converted'))
+            convert_emails(
+                converter, emails, output_dir,
+                cache=self.cache,
+                on_cached=on_cached,
+                on_converted=on_converted,
+                on_warning=on_warning,
+                stats=poll_stats,
+                max_conversions=state['max_conversions'],
+                metrics=metrics,
+                submitted=state['submitted'],
+                on_submitted=job.record_submitted,
+            )
+        finally:
+            job.update(poll_stats=[s.as_dict() for s in poll_stats.values()])
+
+    def _merge(self, job, metrics):
+        state = job.snapshot()
+        paths = [
+            state['converted'][i['name']] if is_email(i['name']) else i['path']
+            for i in state['inputs']
+        ]
+        output_path = os.path.join(job.directory, os.path.basename(state['output_name']))
+        job.update(merged=0, event='Combining PDF files...')
+        # Merge into a temporary name so an interrupted merge never looks finished
+        partial_path = output_path + '.partial'
+        combine_pdfs(paths, partial_path, streaming=state['streaming'], metrics=metrics)
+        if state.get('optimize'):
+            job.update(event='Optimizing the combined PDF...')
+            before, after = optimize_output(partial_path, image_dpi=state.get('image_dpi'), metrics=metrics)
+            job.update(optimized={'before': before, 'after': after, 'seconds': metrics.stages[-1].seconds})
+        os.replace(partial_path, output_path)
+        job.update(merged=len(paths), output=output_path)
@@ -0,0 +1,168 @@
+import os
+
+from PyPDF2 import PdfReader
+from PyPDF2.generic import (
+    ArrayObject,
+    DecodedStreamObject,
+    DictionaryObject,
+    EncodedStreamObject,
+    IndirectObject,
+    NameObject,
+    NumberObject,
+    StreamObject,
+)
+
+
+class MergeError(Exception):
+    pass
+
+
+class StreamingPdfWriter:
+    # Writes pages straight to the output file as they are added. Each page and
+    # every object it references are serialized immediately, so the writer only
+    # keeps byte offsets and an object-number map for the current source; nothing
+    # of a source document stays in memory once its pages have been written.
+    def __init__(self, stream):
+        self._stream = stream
+        self._offsets = {}
+        self._next_num = 1
+        self._pages_num = self._reserve()
+        self._page_nums = []
+        # Extra catalog entries, e.g. an outline carried over by a subclass
+        self._catalog = {}
+        self._map = {}
+        self._queue = []
+        self._stream.write(b'%PDF-1.7\n%\xe2\xe3\xcf\xd3\n')
+
+    def _reserve(self):
+        num = self._next_num
+        self._next_num += 1
+        return num
+
+    def begin_document(self, reader):
+        # Object numbers are per source: give every page its new number up front so
+        # links between pages of the same document still resolve
+        self._map = {}
+        for page in reader.pages:
+            if page.indirect_reference is not None:
+                key = (page.indirect_reference.idnum, page.indirect_reference.generation)
+                self._map[key] = self._reserve()
+
+    def add_page(self, page):
+        ref = page.indirect_reference
+        key = (ref.idnum, ref.generation) if ref is not None else None
+        num = self._map.get(key) if key else None
+        if num is None:
+            num = self._reserve()
+            if key:
+                self._map[key] = num
+
+        new_page = DictionaryObject()
+        for name, value in dict.items(page):
+            if name != '/Parent':
+                new_page[NameObject(name)] = self._remap(value)
+        new_page[NameObject('/Parent')] = IndirectObject(self._pages_num, 0, None)
+        self._write_object(num, new_page)
+        self._page_nums.append(num)
+
+        # Write everything the page pulled in before moving on
+        self._flush()
+
+    def _flush(self):
+        while self._queue:
+            obj_num, ref = self._queue.pop()
+            self._write_object(obj_num, self._remap(ref.get_object()))
+
+    def add_document(self, reader):
+        self.begin_document(reader)
+        for page in reader.pages:
+            self.add_page(page)
+        # The reader and its pages reference each other, so without this the parsed
+        # objects would linger until the next garbage collection
+        reader.resolved_objects.clear()
+        reader.flattened_pages = None
+
+    def _remap(self, obj):
+        if isinstance(obj, IndirectObject):
+            key = (obj.idnum, obj.generation)
+            num = self._map.get(key)
+            if num is None:
+                num = self._map[key] = self._reserve()
+                self._queue.append((num, obj))
+            return IndirectObject(num, 0, None)
+        if isinstance(obj, StreamObject):
+            new = EncodedStreamObject() if '/Filter' in obj else DecodedStreamObject()
+            for name, value in dict.items(obj):
+                if name != '/Length':
+                    new[NameObject(name)] = self._remap(value)
+            new._data = obj._data
+            return new
+        if isinstance(obj, DictionaryObject):
+            new = DictionaryObject()
+            for name, value in dict.items(obj):
+                # Pages are only reachable through the new page tree
+                if name == '/Parent' and obj.get('/Type') == '/Page':
+                    continue
+                new[NameObject(name)] = self._remap(value)
+            return new
+        if isinstance(obj, ArrayObject):
+            return ArrayObject(self._remap(value) for value in list.__iter__(obj))
+        return obj
+
+    def _write_object(self, num, obj):
+        self._offsets[num] = self._stream.tell()
+        self._stream.write(b'%d 0 obj\n' % num)
+        obj.write_to_stream(self._stream, None)
+        self._stream.write(b'\nendobj\n')
+
+    def close(self):
+        pages = DictionaryObject({
+            NameObject('/Type'): NameObject('/Pages'),
+            NameObject('/Kids'): ArrayObject(IndirectObject(num, 0, None) for num in self._page_nums),
+            NameObject('/Count'): NumberObject(len(self._page_nums)),
+        })
+        self._write_object(self._pages_num, pages)
+        catalog_num = self._reserve()
+        self._write_object(catalog_num, DictionaryObject({
+            **self._catalog,
+            NameObject('/Type'): NameObject('/Catalog'),
+            NameObject('/Pages'): IndirectObject(self._pages_num, 0, None),
+        }))
+
+        xref_offset = self._stream.tell()
+        self._stream.write(b'xref\n0 %d\n0000000000 65535 f \n' % self._next_num)
+        for num in range(1, self._next_num):
+            offset = self._offsets.get(num)
+            # Numbers reserved for pages that were never added are left free
+            if offset is None:
+                self._stream.write(b'0000000000 00000 f \n')
+            else:
+                self._stream.write(b'%010d 00000 n \n' % offset)
+        self._stream.write(b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+                           % (self._next_num, catalog_num, xref_offset))
+
+
+def open_reader(pdf_file):
+    reader = PdfReader(pdf_file)
+    if reader.is_encrypted and not reader.decrypt(''):
+        raise MergeError("the file is encrypted")
+    return reader
+
+
+def stream_merge(paths, output_path, stage=None):
+    # Merge PDFs with peak memory of roughly one input document. Unlike PdfMerger,
+    # bookmarks and document-level metadata of the inputs are not carried over.
+    # Each document's file and page counts are added to `stage` if one is given.
+    with open(output_path, 'wb') as output:
+        writer = StreamingPdfWriter(output)
+        for path in paths:
+            try:
+                with open(path, 'rb') as pdf_file:
+                    reader = open_reader(pdf_file)
+                    if stage is not None:
+                        stage.add(files=1, pages=len(reader.pages), bytes_in=os.path.getsize(path))
+                    writer.add_document(reader)
+            except Exception as e:
+                raise MergeError(f"Error reading PDF file {os.path.basename(path)}: {e}") from e
+        writer.close()
+    return output_path
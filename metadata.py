@@ -0,0 +1,103 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PyPDF2 import PdfReader
+
+from cache import content_hash
+from core import file_type, is_email
+from emails import EmailParseError, olefile, parse_email_file
+
+# Parsed results are reused for identical content, up to this many files
+DEFAULT_MAX_ENTRIES = 10000
+
+
+class FileMetadata:
+    # What is known about an uploaded file without running any action on it
+    __slots__ = ('sha256', 'size', 'page_count', 'encrypted', 'error', 'headers', 'attachment_count')
+
+    def __init__(self, sha256, size, page_count=None, encrypted=False, error=None, headers=None,
+                 attachment_count=None):
+        self.sha256 = sha256
+        self.size = size
+        self.page_count = page_count
+        self.encrypted = encrypted
+        self.error = error
+        self.headers = headers or {}
+        self.attachment_count = attachment_count
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def status(self):
+        if self.error:
+            return f"Error: {self.error}"
+        return 'Encrypted (no password)' if self.encrypted else 'OK'
+
+
+def inspect_pdf(path, sha256, size):
+    try:
+        with open(path, 'rb') as pdf_file:
+            reader = PdfReader(pdf_file)
+            encrypted = reader.is_encrypted
+            if encrypted and not reader.decrypt(''):
+                return FileMetadata(sha256, size, encrypted=True, error='password protected')
+            return FileMetadata(sha256, size, page_count=len(reader.pages), encrypted=encrypted)
+    except Exception as e:
+        return FileMetadata(sha256, size, error=f"unreadable PDF ({e})")
+
+
+def inspect_email(path, file_name, sha256, size):
+    if file_type(file_name) == '.msg' and olefile is None:
+        # Without an OLE reader the headers are unknown, but Zamzar can still convert it
+        return FileMetadata(sha256, size)
+    try:
+        parsed = parse_email_file(file_name, path)
+    except (EmailParseError, OSError, ValueError) as e:
+        return FileMetadata(sha256, size, error=f"unreadable email ({e})")
+    return FileMetadata(sha256, size, headers=parsed.headers, attachment_count=len(parsed.attachments))
+
+
+def inspect_file(path, file_name, sha256=None):
+    if sha256 is None:
+        with open(path, 'rb') as f:
+            sha256 = content_hash(f)
+    size = os.path.getsize(path)
+    if is_email(file_name):
+        return inspect_email(path, file_name, sha256, size)
+    if file_type(file_name) == '.pdf':
+        return inspect_pdf(path, sha256, size)
+    return FileMetadata(sha256, size, error=f"unsupported file type {file_type(file_name)}")
+
+
+class MetadataIndex:
+    # Builds FileMetadata in a background thread pool and keeps the results keyed
+    # by content hash, so the same bytes are only parsed once per server.
+    def __init__(self, max_workers=4, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='metadata')
+        self._by_hash = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, path, file_name, sha256=None):
+        return self._executor.submit(self._inspect, path, file_name, sha256)
+
+    def _inspect(self, path, file_name, sha256=None):
+        if sha256 is None:
+            with open(path, 'rb') as f:
+                sha256 = content_hash(f)
+        key = (sha256, file_type(file_name))
+        with self._lock:
+            metadata = self._by_hash.get(key)
+            if metadata is not None:
+                self._by_hash.move_to_end(key)
+                return metadata
+        metadata = inspect_file(path, file_name, sha256)
+        with self._lock:
+            self._by_hash[key] = metadata
+            while len(self._by_hash) > self.max_entries:
+                self._by_hash.popitem(last=False)
+        return metadata
@@ -0,0 +1,235 @@
+import hashlib
+import os
+import struct
+import zlib
+from io import BytesIO
+
+from PyPDF2.generic import (
+    ArrayObject,
+    DictionaryObject,
+    EncodedStreamObject,
+    IndirectObject,
+    NameObject,
+    NumberObject,
+    StreamObject,
+)
+
+from merge import MergeError, StreamingPdfWriter, open_reader
+
+try:
+    from PIL import Image
+except ImportError:  # Optional: images are only downsampled when Pillow is installed
+    Image = None
+
+# Rewriting a finished PDF so it is smaller on disk and on the wire.
+#
+# Converted emails each carry their own copies of the same fonts, logos and
+# signature images. The optimizing writer fingerprints every object it copies
+# by content (references included, so two identical fonts that point at
+# identical font files match) and writes each distinct object once. Streams
+# stored without a filter are Flate-compressed, and with `image_dpi` images
+# larger than their page at that resolution are scaled down.
+#
+# Objects that reach a page (annotations, outline items) are never merged.
+
+# Images are only re-encoded when this much smaller than they were
+MIN_IMAGE_SCALE = 0.9
+
+
+class _Unhashable(Exception):
+    pass
+
+
+class OptimizingPdfWriter(StreamingPdfWriter):
+    def __init__(self, stream, compress=True, image_dpi=None):
+        super().__init__(stream)
+        self.compress = compress
+        self.image_dpi = image_dpi
+        self.counts = {'duplicates': 0, 'compressed': 0, 'downsampled': 0}
+        # Content fingerprint -> object number, across every document written
+        self._by_content = {}
+        # Source object -> fingerprint (None if it cannot have one), per document
+        self._fingerprints = {}
+        self._visiting = set()
+        self._page_size = None
+
+    def begin_document(self, reader):
+        super().begin_document(reader)
+        self._fingerprints = {}
+
+    def add_page(self, page):
+        box = page.mediabox
+        self._page_size = (float(box.width), float(box.height))
+        super().add_page(page)
+
+    def add_outline(self, reader):
+        # Carry over the bookmarks of the document just added; its pages are still mapped
+        outlines = reader.trailer['/Root'].raw_get('/Outlines') if '/Outlines' in reader.trailer['/Root'] else None
+        if outlines is not None:
+            self._catalog[NameObject('/Outlines')] = self._remap(outlines)
+            self._flush()
+
+    def _remap(self, obj):
+        if isinstance(obj, IndirectObject):
+            key = (obj.idnum, obj.generation)
+            if key not in self._map:
+                fingerprint = self._fingerprint(obj)
+                num = self._by_content.get(fingerprint) if fingerprint else None
+                if num is not None:
+                    self._map[key] = num
+                    self.counts['duplicates'] += 1
+                    return IndirectObject(num, 0, None)
+                num = self._map[key] = self._reserve()
+                if fingerprint:
+                    self._by_content[fingerprint] = num
+                self._queue.append((num, obj))
+            return IndirectObject(self._map[key], 0, None)
+        new = super()._remap(obj)
+        if isinstance(obj, StreamObject):
+            new = self._downsample(obj, new) or new
+            if self.compress and '/Filter' not in new:
+                new = self._deflate(new)
+        return new
+
+    def _fingerprint(self, ref):
+        key = (ref.idnum, ref.generation)
+        if key in self._fingerprints:
+            return self._fingerprints[key]
+        if key in self._visiting:
+            raise _Unhashable  # A cycle, e.g. outline items pointing at their parent
+        self._visiting.add(key)
+        try:
+            obj = ref.get_object()
+            if isinstance(obj, DictionaryObject) and obj.get('/Type') in ('/Page', '/Pages'):
+                raise _Unhashable
+            digest = hashlib.sha256()
+            self._hash(digest, obj)
+            fingerprint = digest.digest()
+        except _Unhashable:
+            fingerprint = None
+        finally:
+            self._visiting.discard(key)
+        self._fingerprints[key] = fingerprint
+        return fingerprint
+
+    def _hash(self, digest, obj):
+        if isinstance(obj, IndirectObject):
+            fingerprint = self._fingerprint(obj)
+            if fingerprint is None:
+                raise _Unhashable
+            digest.update(b'R' + fingerprint)
+        elif isinstance(obj, DictionaryObject):
+            digest.update(b'<<')
+            for name in sorted(dict.keys(obj)):
+                if name != '/Length':
+                    digest.update(name.encode() + b' ')
+                    self._hash(digest, dict.__getitem__(obj, name))
+            digest.update(b'>>')
+            if isinstance(obj, StreamObject):
+                digest.update(b'stream%d:' % len(obj._data) + obj._data)
+        elif isinstance(obj, ArrayObject):
+            digest.update(b'[')
+            for value in list.__iter__(obj):
+                self._hash(digest, value)
+            digest.update(b']')
+        else:
+            buffer = BytesIO()
+            obj.write_to_stream(buffer, None)
+            digest.update(buffer.getvalue() + b' ')
+
+    def _deflate(self, stream):
+        data = zlib.compress(stream._data, 9)
+        if len(data) >= len(stream._data):
+            return stream
+        new = EncodedStreamObject()
+        new.update(dict.items(stream))
+        new[NameObject('/Filter')] = NameObject('/FlateDecode')
+        new._data = data
+        self.counts['compressed'] += 1
+        return new
+
+    def _downsample(self, source, stream):
+        # 8-bit grey or RGB images drawn at most page-sized; anything else is left alone
+        if Image is None or not self.image_dpi or self._page_size is None or source.get('/Subtype') != '/Image':
+            return None
+        mode = {'/DeviceRGB': 'RGB', '/DeviceGray': 'L'}.get(source.get('/ColorSpace'))
+        width, height = int(source.get('/Width', 0)), int(source.get('/Height', 0))
+        if mode is None or source.get('/BitsPerComponent') != 8 or '/Decode' in source or not width or not height:
+            return None
+        scale = min(self._page_size[0] / 72 * self.image_dpi / width, self._page_size[1] / 72 * self.image_dpi / height)
+        if scale >= MIN_IMAGE_SCALE:
+            return None
+
+        image_filter = source.get('/Filter')
+        try:
+            if image_filter == '/DCTDecode':
+                image = Image.open(BytesIO(source._data))
+                image.load()
+            elif image_filter in (None, '/FlateDecode'):
+                image = _flate_image(source, mode, width, height)
+            else:
+                return None
+        except Exception:
+            return None  # Leave images Pillow cannot read exactly as they were
+        if image.mode != mode:
+            return None
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        image = image.resize(size, Image.LANCZOS)
+        if image_filter == '/DCTDecode':
+            buffer = BytesIO()
+            image.save(buffer, format='JPEG', quality=85)
+            data = buffer.getvalue()
+        else:
+            data = zlib.compress(image.tobytes(), 9)
+
+        new = EncodedStreamObject()
+        new.update((name, value) for name, value in dict.items(stream) if name not in ('/Filter', '/DecodeParms'))
+        new[NameObject('/Width')] = NumberObject(size[0])
+        new[NameObject('/Height')] = NumberObject(size[1])
+        new[NameObject('/Filter')] = NameObject(image_filter or '/FlateDecode')
+        new._data = data
+        self.counts['downsampled'] += 1
+        return new
+
+
+def _png_chunk(chunk_type, data):
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+
+def _flate_image(source, mode, width, height):
+    # PyPDF2 3.0 cannot undo PNG predictors on multi-channel images, so rows
+    # filtered that way are wrapped back into the PNG they most likely came from
+    params = source.get('/DecodeParms') or {}
+    if source.get('/Filter') is None:
+        return Image.frombytes(mode, (width, height), source._data)
+    if params.get('/Predictor', 1) < 10:
+        return Image.frombytes(mode, (width, height), zlib.decompress(source._data))
+    header = struct.pack('>IIBBBBB', width, height, 8, 2 if mode == 'RGB' else 0, 0, 0, 0)
+    png = b'\x89PNG\r\n\x1a\n' + _png_chunk(b'IHDR', header) + _png_chunk(b'IDAT', source._data) + _png_chunk(b'IEND', b'')
+    image = Image.open(BytesIO(png))
+    image.load()
+    return image
+
+
+def optimize_pdf(source_path, output_path, image_dpi=None, stage=None):
+    # Rewrite `source_path` to `output_path` with shared objects written once,
+    # unfiltered streams compressed and, with `image_dpi`, oversized images
+    # scaled down. Pages and bookmarks are kept; document metadata is not.
+    # Returns the writer's counts of duplicates, compressed and downsampled objects.
+    try:
+        with open(source_path, 'rb') as pdf_file, open(output_path, 'wb') as output:
+            reader = open_reader(pdf_file)
+            writer = OptimizingPdfWriter(output, image_dpi=image_dpi)
+            writer.begin_document(reader)
+            for page in reader.pages:
+                writer.add_page(page)
+            writer.add_outline(reader)
+            writer.close()
+            pages = len(reader.pages)
+    except Exception as e:
+        raise MergeError(f"Error optimizing PDF file {os.path.basename(source_path)}: {e}") from e
+    if stage is not None:
+        stage.add(files=1, pages=pages, bytes_in=os.path.getsize(source_path), bytes_out=os.path.getsize(output_path))
+        for name, count in writer.counts.items():
+            stage.details[name] = stage.details.get(name, 0) + count
+    return writer.counts
@@ -0,0 +1,138 @@
+import heapq
+import itertools
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+
+class PollPolicy:
+    # How often to ask Zamzar for a job's status: a short first poll so small
+    # emails finish quickly, then exponential backoff with jitter up to a cap,
+    # and a total deadline after which the job is given up on.
+    def __init__(self, first_delay=0.5, factor=2.0, max_delay=10.0, jitter=0.2, deadline=600.0):
+        self.first_delay = first_delay
+        self.factor = factor
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.deadline = deadline
+
+    def next_delay(self, attempt, retry_after=None):
+        delay = min(self.first_delay * (self.factor ** attempt), self.max_delay)
+        if self.jitter:
+            delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        # The server knows best: never poll sooner than Retry-After allows
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class JobStats:
+    __slots__ = ('key', 'submitted_at', 'finished_at', 'polls', 'transient_errors', 'status',
+                 'upload_time', 'download_time', 'bytes_sent', 'bytes_received')
+
+    def __init__(self, key, submitted_at):
+        self.key = key
+        self.submitted_at = submitted_at
+        self.finished_at = None
+        self.polls = 0
+        self.transient_errors = 0
+        self.status = 'pending'
+        self.upload_time = 0.0
+        self.download_time = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    @property
+    def wait_time(self):
+        end = self.finished_at if self.finished_at is not None else time.monotonic()
+        return end - self.submitted_at
+
+    @property
+    def api_calls(self):
+        # The upload, every status poll, and the download if one was started
+        return 1 + self.polls + (1 if self.download_time or self.bytes_received else 0)
+
+    def as_dict(self):
+        return {
+            'Job': self.key,
+            'Status': self.status,
+            'Polls': self.polls,
+            'Transient Errors': self.transient_errors,
+            'Upload (s)': round(self.upload_time, 2),
+            'Wait (s)': round(self.wait_time, 2),
+            'Download (s)': round(self.download_time, 2),
+        }
+
+
+class PollScheduler:
+    # A single timer queue for every job in flight. Callers add jobs, ask how long
+    # until the next one is due, and pop due jobs to poll them; there is no
+    # per-job sleeping loop.
+    def __init__(self, policy=None):
+        self.policy = policy or PollPolicy()
+        self.stats = {}
+        self._heap = []
+        self._attempts = {}
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._attempts)
+
+    def add(self, key, job):
+        now = time.monotonic()
+        self.stats[key] = JobStats(key, now)
+        self._attempts[key] = 0
+        self._push(now + self.policy.next_delay(0), key, job)
+
+    def reschedule(self, key, job, retry_after=None, transient=False):
+        stats = self.stats[key]
+        if transient:
+            stats.transient_errors += 1
+        if stats.wait_time > self.policy.deadline:
+            self.finish(key, 'timed out')
+            return False
+        self._attempts[key] += 1
+        delay = self.policy.next_delay(self._attempts[key], retry_after)
+        if retry_after is not None and stats.wait_time + retry_after > self.policy.deadline:
+            # Told not to ask again until after the deadline: give up now rather than then
+            self.finish(key, 'timed out')
+            return False
+        self._push(time.monotonic() + delay, key, job)
+        return True
+
+    def finish(self, key, status):
+        stats = self.stats[key]
+        stats.status = status
+        stats.finished_at = time.monotonic()
+        self._attempts.pop(key, None)
+
+    def time_until_next(self):
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - time.monotonic())
+
+    def pop_due(self):
+        now = time.monotonic()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, _, key, job = heapq.heappop(self._heap)
+            self.stats[key].polls += 1
+            due.append((key, job))
+        return due
+
+    def _push(self, when, key, job):
+        heapq.heappush(self._heap, (when, next(self._counter), key, job))
@@ -0,0 +1,150 @@
+import bisect
+import itertools
+import re
+
+# Page and file selections such as '1, 3-5, 9-', 'last', '-3-', '10-1' or '1-:2'.
+# Terms are separated by commas and are kept in the order they are typed:
+#
+#   7         item 7                 -1, last   the last item
+#   3-5       items 3 to 5           5-         item 5 to the end
+#   10-1      10 down to 1           -3-        the last three items
+#   1-9:2     every second item      -1-1       everything, in reverse
+#
+# Nothing is expanded up front: each term becomes a `range` clamped to the
+# number of items that exist, so '1-2000000000' costs the same as '1-10'.
+# Repeated items are only yielded the first time.
+
+_TERM = re.compile(
+    r'^(?P<start>last|-?\d+)'
+    r'(?:\s*(?P<dash>-)\s*(?P<end>last|-?\d+)?)?'
+    r'(?:\s*:\s*(?P<step>\d+))?$'
+)
+
+
+class RangeError(ValueError):
+    pass
+
+
+def _out_of_range(term, count, noun):
+    there = f"is only 1 {noun}" if count == 1 else f"are only {count} {noun}s"
+    return RangeError(f"'{term}' is out of range: there {there}.")
+
+
+def _resolve(value, term, count, noun):
+    # An endpoint as a 1-based position; 'last' and negatives count back from the end
+    if value == 'last':
+        return count
+    number = int(value)
+    if number == 0:
+        raise RangeError(f"'{term}': {noun}s are numbered from 1.")
+    return count + 1 + number if number < 0 else number
+
+
+def _clamp(items, count):
+    # The part of an ascending or descending range that lies within 1..count
+    if items.step < 0:
+        return _clamp(items[::-1], count)[::-1]
+    if items and items.start < 1:
+        items = items[-(-(1 - items.start) // items.step):]
+    if items and items[-1] > count:
+        items = items[:max(0, (count - items.start) // items.step + 1)]
+    return items
+
+
+def parse_term(term, count, noun='page'):
+    match = _TERM.match(term)
+    if match is None:
+        raise RangeError(
+            f"'{term}' is not a {noun} number or range "
+            f"(use forms like 7, 3-5, 5-, last, -2, 10-1 or 1-9:2)."
+        )
+    start = _resolve(match['start'], term, count, noun)
+    if match['dash'] is None:
+        if not 1 <= start <= count:
+            raise _out_of_range(term, count, noun)
+        return range(start, start + 1)
+
+    if match['end'] is not None:
+        end = _resolve(match['end'], term, count, noun)
+    else:
+        # Open-ended ranges always run forwards to the end
+        end = max(count, start)
+    step = int(match['step']) if match['step'] is not None else 1
+    if step == 0:
+        raise RangeError(f"'{term}': the step must be at least 1.")
+    items = range(start, end + 1, step) if start <= end else range(start, end - 1, -step)
+    clamped = _clamp(items, count)
+    if not clamped:
+        raise _out_of_range(term, count, noun)
+    return clamped
+
+
+class RangeSelection:
+    __slots__ = ('ranges', 'count', '_intervals')
+
+    def __init__(self, ranges, count):
+        self.ranges = ranges
+        self.count = count
+        self._intervals = None
+
+    def intervals(self):
+        # Sorted, merged (first, last) pairs covering every selected item. Stepped
+        # terms add one pair per item, which is bounded by `count` after clamping.
+        if self._intervals is None:
+            pieces = []
+            for items in self.ranges:
+                if abs(items.step) == 1:
+                    pieces.append((min(items[0], items[-1]), max(items[0], items[-1])))
+                else:
+                    pieces.extend((item, item) for item in items)
+            pieces.sort()
+            merged = []
+            for first, last in pieces:
+                if merged and first <= merged[-1][1] + 1:
+                    if last > merged[-1][1]:
+                        merged[-1] = (merged[-1][0], last)
+                else:
+                    merged.append((first, last))
+            self._intervals = merged
+        return self._intervals
+
+    def __len__(self):
+        return sum(last - first + 1 for first, last in self.intervals())
+
+    def __contains__(self, item):
+        intervals = self.intervals()
+        index = bisect.bisect_right(intervals, (item, float('inf'))) - 1
+        return index >= 0 and intervals[index][0] <= item <= intervals[index][1]
+
+    def __iter__(self):
+        # In the order typed, each item once
+        if sum(len(items) for items in self.ranges) == len(self):
+            return itertools.chain.from_iterable(self.ranges)
+        return self._unique()
+
+    def _unique(self):
+        seen = set()
+        for items in self.ranges:
+            for item in items:
+                if item not in seen:
+                    seen.add(item)
+                    yield item
+
+    def sorted(self):
+        # In ascending order, each item once
+        for first, last in self.intervals():
+            yield from range(first, last + 1)
+
+    def __repr__(self):
+        return f"RangeSelection({', '.join(map(str, self.ranges))}, count={self.count})"
+
+
+def parse_ranges(expression, count, noun='page'):
+    # Parse `expression` against `count` items, or raise RangeError saying which term is wrong
+    if count < 1:
+        raise RangeError(f"There are no {noun}s to select from.")
+    terms = [term.strip() for term in expression.split(',')]
+    terms = [term for term in terms if term]
+    if not terms:
+        raise RangeError(f"Enter at least one {noun} number or range.")
+    return RangeSelection([parse_term(term, count, noun) for term in terms], count)
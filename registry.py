@@ -0,0 +1,158 @@
+import hashlib
+import os
+import tempfile
+from datetime import datetime
+
+import pandas as pd
+
+from cache import content_hash
+from core import file_type
+
+# Columns of the registry's display view, in order
+VIEW_COLUMNS = ['File Name', 'File Type', 'Date Modified', 'Temp File Path']
+
+
+class FileRecord:
+    # One uploaded or converted file. `metadata` holds the future of its
+    # metadata.FileMetadata once it has been submitted.
+    __slots__ = ('sha256', 'name', 'file_type', 'path', 'added', 'metadata')
+
+    def __init__(self, sha256, name, path, added=None):
+        self.sha256 = sha256
+        self.name = name
+        self.file_type = file_type(name)
+        self.path = path
+        self.added = added or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.metadata = None
+
+    def as_row(self):
+        return {
+            'File Name': self.name,
+            'File Type': self.file_type,
+            'Date Modified': self.added,
+            'Temp File Path': self.path,
+        }
+
+
+def spool_file(stream, directory, chunk_size=1024 * 1024):
+    # Copy `stream` into a temporary file under `directory`, hashing it on the way.
+    # Returns (sha256, temp_path).
+    os.makedirs(directory, exist_ok=True)
+    digest = hashlib.sha256()
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+    with os.fdopen(fd, 'wb') as spool:
+        for chunk in iter(lambda: stream.read(chunk_size), b''):
+            digest.update(chunk)
+            spool.write(chunk)
+    return digest.hexdigest(), temp_path
+
+
+class FileRegistry:
+    # The files of one session, in the order they were added. Records are keyed by
+    # content hash, so the same bytes are only listed once whatever they are
+    # called, and names are kept unique so they can identify a file in results.
+    # Upload ids already seen are remembered so a rerun does not re-read them,
+    # and the display view is rebuilt only after the registry changes.
+    def __init__(self, directory):
+        self.directory = directory
+        self.version = 0
+        self._records = []
+        self._by_hash = {}
+        self._by_name = {}
+        self._uploads = {}
+        self._view = None
+        self._view_version = None
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def get(self, name):
+        return self._by_name.get(name)
+
+    def has_upload(self, upload_id):
+        return upload_id in self._uploads
+
+    def add_upload(self, upload_id, name, stream):
+        # Spool an upload to disk and register it. Returns (record, added); when the
+        # same content is already registered, that record is returned with added=False.
+        if upload_id in self._uploads:
+            return self._by_hash[self._uploads[upload_id]], False
+        upload_dir = os.path.join(self.directory, 'uploads')
+        sha256, temp_path = spool_file(stream, upload_dir)
+        self._uploads[upload_id] = sha256
+        existing = self._by_hash.get(sha256)
+        if existing is not None:
+            os.unlink(temp_path)
+            return existing, False
+
+        path = os.path.join(upload_dir, sha256[:16], os.path.basename(name))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+        return self._add(FileRecord(sha256, self._unique_name(name), path)), True
+
+    def add_path(self, name, path, sha256=None):
+        # Register a file that is already on disk
+        if sha256 is None:
+            with open(path, 'rb') as f:
+                sha256 = content_hash(f)
+        existing = self._by_hash.get(sha256)
+        if existing is not None:
+            return existing, False
+        return self._add(FileRecord(sha256, self._unique_name(name), path)), True
+
+    def replace(self, name, new_name, path):
+        # Swap the record called `name` for the file at `path`, keeping its position.
+        # If that content is already listed, the old record is simply removed.
+        old = self._by_name[name]
+        with open(path, 'rb') as f:
+            sha256 = content_hash(f)
+        position = self._records.index(old)
+        self._remove(old)
+        if sha256 in self._by_hash:
+            self._records.pop(position)
+            self._changed()
+            return self._by_hash[sha256]
+        record = FileRecord(sha256, self._unique_name(new_name), path)
+        self._records[position] = record
+        self._by_hash[sha256] = record
+        self._by_name[record.name] = record
+        self._changed()
+        return record
+
+    def view(self):
+        # DataFrame of the records indexed from 1, rebuilt only when something changed
+        if self._view_version != self.version:
+            self._view = pd.DataFrame([record.as_row() for record in self._records], columns=VIEW_COLUMNS)
+            self._view.index = self._view.index + 1
+            self._view_version = self.version
+        return self._view
+
+    def _add(self, record):
+        self._records.append(record)
+        self._by_hash[record.sha256] = record
+        self._by_name[record.name] = record
+        self._changed()
+        return record
+
+    def _remove(self, record):
+        del self._by_hash[record.sha256]
+        del self._by_name[record.name]
+
+    def _unique_name(self, name):
+        # 'report.pdf', then 'report (2).pdf' for a different file with the same name
+        stem, extension = os.path.splitext(name)
+        candidate = name
+        counter = 2
+        while candidate in self._by_name:
+            candidate = f"{stem} ({counter}){extension}"
+            counter += 1
+        return candidate
+
+    def _changed(self):
+        self.version += 1
@@ -0,0 +1,422 @@
+import re
+import struct
+import unicodedata
+import zlib
+from html.parser import HTMLParser
+from io import BytesIO
+
+from emails import EmailParseError
+
+try:
+    from PIL import Image
+except ImportError:  # Optional: only used for image formats we cannot embed directly
+    Image = None
+
+# US Letter, in points
+PAGE_WIDTH = 612
+PAGE_HEIGHT = 792
+MARGIN = 54
+
+# Advance widths of Helvetica for characters 32-126, in 1/1000 em
+_HELVETICA_WIDTHS = [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+]
+
+
+def text_width(text, size, bold=False):
+    width = sum(_HELVETICA_WIDTHS[ord(c) - 32] if 32 <= ord(c) <= 126 else 556 for c in text)
+    # Helvetica-Bold is about 5% wider on average
+    return width * size / 1000 * (1.05 if bold else 1.0)
+
+
+def _pdf_string(text, missing=None):
+    # The standard fonts only have Western European glyphs. Invisible formatting
+    # characters are dropped and odd spaces become plain ones. Without `missing`
+    # anything else the fonts lack fails the email, so it can go to a converter
+    # that can show it; with it, such characters are drawn as '?' and added to
+    # `missing`.
+    text = ''.join(
+        ' ' if category == 'Zs' else c
+        for c in text
+        for category in [unicodedata.category(c)] if category != 'Cf'
+    )
+    try:
+        data = text.encode('cp1252')
+    except UnicodeEncodeError as e:
+        if missing is None:
+            raise EmailParseError(
+                f"The local converter cannot show {text[e.start:e.end]!r}; only Western European text is supported."
+            ) from None
+        missing.update(c for c in text if not _has_glyph(c))
+        data = text.encode('cp1252', errors='replace')
+    return b'(' + data.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)') + b')'
+
+
+def _has_glyph(c):
+    try:
+        c.encode('cp1252')
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+class PdfDocument:
+    # Minimal PDF writer: Helvetica text and JPEG/PNG images, enough to render an
+    # email or wrap images as pages without any external PDF library.
+    def __init__(self):
+        self._objects = []
+        self._pages = []
+        self._pages_num = self._reserve()
+        self._fonts = {
+            'F1': self._add(b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>'),
+            'F2': self._add(b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>'),
+        }
+
+    @property
+    def page_count(self):
+        return len(self._pages)
+
+    def _reserve(self):
+        self._objects.append(None)
+        return len(self._objects)
+
+    def _add(self, body):
+        self._objects.append(body)
+        return len(self._objects)
+
+    def _add_stream(self, entries, data):
+        return self._add(b'<< ' + entries + b' /Length %d >>\nstream\n' % len(data) + data + b'\nendstream')
+
+    def add_image(self, data, mime_type=None):
+        # Returns (object number, width, height), or None if the image cannot be embedded
+        image = _jpeg_image(data) or _png_image(data) or _pil_image(data)
+        if image is None:
+            return None
+        entries, stream, width, height = image
+        entries = b'/Type /XObject /Subtype /Image /Width %d /Height %d ' % (width, height) + entries
+        return self._add_stream(entries, stream), width, height
+
+    def add_page(self, content, images=None, width=PAGE_WIDTH, height=PAGE_HEIGHT):
+        fonts = b' '.join(b'/%s %d 0 R' % (name.encode(), num) for name, num in self._fonts.items())
+        xobjects = b' '.join(b'/%s %d 0 R' % (name.encode(), num) for name, num in (images or {}).items())
+        contents = self._add_stream(b'/Filter /FlateDecode', zlib.compress(content))
+        self._pages.append(self._add(
+            b'<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %s %s] /Contents %d 0 R '
+            b'/Resources << /Font << %s >> /XObject << %s >> >> >>'
+            % (self._pages_num, _num(width), _num(height), contents, fonts, xobjects)
+        ))
+
+    def save(self, output):
+        kids = b' '.join(b'%d 0 R' % num for num in self._pages)
+        self._objects[self._pages_num - 1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, len(self._pages))
+        catalog = self._add(b'<< /Type /Catalog /Pages %d 0 R >>' % self._pages_num)
+
+        buffer = BytesIO()
+        buffer.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        offsets = []
+        for num, body in enumerate(self._objects, start=1):
+            offsets.append(buffer.tell())
+            buffer.write(b'%d 0 obj\n' % num + body + b'\nendobj\n')
+        xref_offset = buffer.tell()
+        buffer.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(self._objects) + 1))
+        for offset in offsets:
+            buffer.write(b'%010d 00000 n \n' % offset)
+        buffer.write(b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+                     % (len(self._objects) + 1, catalog, xref_offset))
+        self._objects.pop()  # Allow further pages to be added before saving again
+
+        if hasattr(output, 'write'):
+            output.write(buffer.getvalue())
+        else:
+            with open(output, 'wb') as f:
+                f.write(buffer.getvalue())
+
+
+def _num(value):
+    return (b'%.2f' % value).rstrip(b'0').rstrip(b'.')
+
+
+def _jpeg_image(data):
+    if not data.startswith(b'\xff\xd8'):
+        return None
+    offset = 2
+    while offset + 9 < len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        length = struct.unpack('>H', data[offset + 2:offset + 4])[0]
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>HH', data[offset + 5:offset + 9])
+            components = data[offset + 9]
+            color_space = {1: b'/DeviceGray', 3: b'/DeviceRGB', 4: b'/DeviceCMYK'}.get(components)
+            if color_space is None:
+                return None
+            entries = b'/ColorSpace %s /BitsPerComponent 8 /Filter /DCTDecode' % color_space
+            if components == 4:
+                entries += b' /Decode [1 0 1 0 1 0 1 0]'  # Adobe CMYK JPEGs are inverted
+            return entries, data, width, height
+        offset += 2 + length
+    return None
+
+
+def _png_image(data):
+    # Non-interlaced 8-bit greyscale, RGB and palette PNGs can be embedded as-is
+    if not data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return None
+    offset = 8
+    header = palette = None
+    idat = []
+    while offset + 8 <= len(data):
+        length, chunk_type = struct.unpack('>I4s', data[offset:offset + 8])
+        chunk = data[offset + 8:offset + 8 + length]
+        if chunk_type == b'IHDR':
+            header = struct.unpack('>IIBBBBB', chunk)
+        elif chunk_type == b'PLTE':
+            palette = chunk
+        elif chunk_type == b'IDAT':
+            idat.append(chunk)
+        elif chunk_type == b'IEND':
+            break
+        offset += 12 + length
+    if header is None:
+        return None
+    width, height, bit_depth, color_type, _, _, interlace = header
+    if bit_depth != 8 or interlace or color_type not in (0, 2, 3):
+        return _pil_image(data)
+    if color_type == 3:
+        if palette is None:
+            return None
+        color_space = b'[/Indexed /DeviceRGB %d <%s>]' % (len(palette) // 3 - 1, palette.hex().encode())
+        colors = 1
+    else:
+        color_space = b'/DeviceGray' if color_type == 0 else b'/DeviceRGB'
+        colors = 1 if color_type == 0 else 3
+    entries = (b'/ColorSpace %s /BitsPerComponent 8 /Filter /FlateDecode '
+               b'/DecodeParms << /Predictor 15 /Colors %d /BitsPerComponent 8 /Columns %d >>'
+               % (color_space, colors, width))
+    return entries, b''.join(idat), width, height
+
+
+def _pil_image(data):
+    if Image is None:
+        return None
+    try:
+        with Image.open(BytesIO(data)) as image:
+            buffer = BytesIO()
+            image.convert('RGB').save(buffer, format='JPEG', quality=90)
+    except Exception:
+        return None
+    return _jpeg_image(buffer.getvalue())
+
+
+class PageLayout:
+    # Flows text and images top to bottom across as many pages as needed.
+    # `missing` is passed on to _pdf_string.
+    def __init__(self, document, width=PAGE_WIDTH, height=PAGE_HEIGHT, margin=MARGIN, missing=None):
+        self.document = document
+        self.missing = missing
+        self.width = width
+        self.height = height
+        self.margin = margin
+        self._ops = []
+        self._images = {}
+        self._y = height - margin
+
+    @property
+    def content_width(self):
+        return self.width - 2 * self.margin
+
+    def _ensure(self, needed):
+        if self._y - needed < self.margin and (self._ops or self._images):
+            self.new_page()
+
+    def new_page(self):
+        self.document.add_page(b'\n'.join(self._ops), self._images, self.width, self.height)
+        self._ops = []
+        self._images = {}
+        self._y = self.height - self.margin
+
+    def finish(self):
+        if self._ops or self._images or not self.document.page_count:
+            self.new_page()
+
+    def space(self, points):
+        self._y -= points
+
+    def text_line(self, text, size=10, bold=False, x=None):
+        leading = size * 1.3
+        self._ensure(leading)
+        self._y -= leading
+        font = b'F2' if bold else b'F1'
+        self._ops.append(b'BT /%s %s Tf %s %s Td %s Tj ET' % (
+            font, _num(size), _num(self.margin if x is None else x), _num(self._y + size * 0.3), _pdf_string(text, self.missing)
+        ))
+
+    def paragraph(self, text, size=10, bold=False, indent=0):
+        max_width = self.content_width - indent
+        for raw_line in text.expandtabs(4).split('\n'):
+            for line in wrap_text(raw_line.rstrip(), max_width, size, bold):
+                self.text_line(line, size, bold, self.margin + indent)
+
+    def labelled(self, label, value, size=10, label_width=60):
+        lines = []
+        for raw_line in str(value).split('\n'):
+            lines.extend(wrap_text(raw_line, self.content_width - label_width, size))
+        for i, line in enumerate(lines or ['']):
+            if i == 0:
+                self._ensure(size * 1.3)
+                self._ops.append(b'BT /F2 %s Tf %s %s Td %s Tj ET' % (
+                    _num(size), _num(self.margin), _num(self._y - size * 1.3 + size * 0.3), _pdf_string(label, self.missing)
+                ))
+            self.text_line(line, size, x=self.margin + label_width)
+
+    def rule(self):
+        self._ensure(12)
+        self._y -= 6
+        self._ops.append(b'0.5 w %s %s m %s %s l S' % (
+            _num(self.margin), _num(self._y), _num(self.width - self.margin), _num(self._y)
+        ))
+        self._y -= 6
+
+    def image(self, data, mime_type=None, max_height=None):
+        image = self.document.add_image(data, mime_type)
+        if image is None:
+            return False
+        num, width, height = image
+        # Scale down (never up) to fit the text column and the page
+        max_height = max_height or self.height - 2 * self.margin
+        scale = min(1.0, self.content_width / width, max_height / height)
+        draw_width, draw_height = width * scale, height * scale
+        self._ensure(draw_height + 4)
+        self._y -= draw_height + 4
+        name = f"Im{num}"
+        self._images[name] = num
+        self._ops.append(b'q %s 0 0 %s %s %s cm /%s Do Q' % (
+            _num(draw_width), _num(draw_height), _num(self.margin), _num(self._y), name.encode()
+        ))
+        return True
+
+
+def wrap_text(text, max_width, size, bold=False):
+    if not text:
+        return ['']
+    lines = []
+    current = ''
+    for word in re.split(r'(\s+)', text):
+        candidate = current + word
+        if text_width(candidate, size, bold) <= max_width:
+            current = candidate
+            continue
+        if current.strip():
+            lines.append(current.rstrip())
+        current = word.lstrip()
+        # Break words that are wider than a whole line
+        while text_width(current, size, bold) > max_width:
+            cut = len(current)
+            while cut > 1 and text_width(current[:cut], size, bold) > max_width:
+                cut -= 1
+            lines.append(current[:cut])
+            current = current[cut:]
+    if current.strip() or not lines:
+        lines.append(current.rstrip())
+    return lines
+
+
+class _HtmlToBlocks(HTMLParser):
+    # Reduces HTML to a list of ('text', str) and ('image', content_id) blocks
+    BLOCK_TAGS = {'p', 'div', 'br', 'tr', 'li', 'ul', 'ol', 'table', 'blockquote', 'hr',
+                  'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'pre', 'section', 'article', 'header', 'footer'}
+    SKIP_TAGS = {'script', 'style', 'head', 'title'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.blocks = []
+        self._text = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self._skip += 1
+        elif tag == 'img':
+            src = dict(attrs).get('src') or ''
+            if src.lower().startswith('cid:'):
+                self._flush()
+                self.blocks.append(('image', src[4:]))
+        elif tag in self.BLOCK_TAGS:
+            self._text.append('\n')
+            if tag == 'li':
+                self._text.append('• ')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self._skip = max(0, self._skip - 1)
+        elif tag in self.BLOCK_TAGS:
+            self._text.append('\n')
+
+    def handle_data(self, data):
+        if not self._skip:
+            self._text.append(re.sub(r'\s+', ' ', data))
+
+    def close(self):
+        super().close()
+        self._flush()
+
+    def _flush(self):
+        text = re.sub(r' *\n *', '\n', ''.join(self._text))
+        text = re.sub(r'\n{3,}', '\n\n', text).strip()
+        if text:
+            self.blocks.append(('text', text))
+        self._text = []
+
+
+def html_to_blocks(html):
+    parser = _HtmlToBlocks()
+    parser.feed(html)
+    parser.close()
+    return parser.blocks
+
+
+def render_email(parsed, output, missing=None):
+    # With `missing`, text the standard fonts cannot show is drawn as '?' and its
+    # characters are added to that set rather than raising EmailParseError
+    document = PdfDocument()
+    layout = PageLayout(document, missing=missing)
+
+    subject = parsed.headers.get('Subject') or '(no subject)'
+    layout.paragraph(subject, size=14, bold=True)
+    layout.space(4)
+    for name in ('From', 'To', 'Cc', 'Date'):
+        if parsed.headers.get(name):
+            layout.labelled(f"{name}:", parsed.headers[name])
+    layout.rule()
+
+    used_images = set()
+    if parsed.html:
+        for kind, value in html_to_blocks(parsed.html):
+            if kind == 'text':
+                layout.paragraph(value)
+            elif value in parsed.inline_images and layout.image(parsed.inline_images[value].data):
+                used_images.add(value)
+    elif parsed.text:
+        layout.paragraph(parsed.text)
+
+    # Inline images the body never referenced still belong to the message
+    for content_id, attachment in parsed.inline_images.items():
+        if content_id not in used_images:
+            layout.image(attachment.data)
+
+    if parsed.attachments:
+        layout.space(8)
+        layout.rule()
+        layout.text_line('Attachments:', bold=True)
+        for attachment in parsed.attachments:
+            layout.paragraph(f"{attachment.filename} ({len(attachment.data):,} bytes)", indent=12)
+
+    layout.finish()
+    document.save(output)
+    return output
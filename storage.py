@@ -0,0 +1,374 @@
+import os
+import secrets
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+
+from cache import content_hash, link_or_copy
+from instrumentation import publish_gauges
+from workers import run_every, walk_files
+
+# Disk space for every session's files on this server.
+#
+# Each session gets a directory under sessions/ holding its uploads, which last
+# as long as the session, and an artifacts/ directory of intermediate files
+# (split outputs, zips) that can be recreated and are evicted least recently
+# used first when a quota would be exceeded. An artifact is used when it is made
+# and whenever it is downloaded; each session's newest artifact, whose download
+# button may still be on screen, is never evicted. Every session has its own
+# byte quota and all sessions together share a global one.
+#
+# Finished files can be shared: the file becomes a hard link to a blob named by
+# its content hash, so identical uploads and outputs from any session are
+# stored once. A blob's reference count is its link count; blobs nobody links
+# to any more are removed by the sweep. Shared files must never be modified in
+# place, only replaced.
+#
+# Sessions touch a heartbeat file on every rerun. A session directory whose
+# heartbeat is older than `session_idle` belongs to a session that is gone and
+# is removed by the sweep, unless the session is still alive in this process
+# (say, a tab left open overnight). The sweep runs every `sweep_interval`
+# seconds and also publishes disk usage gauges. Background jobs (see jobs.py)
+# and the conversion cache keep their own directories, limits and gauges.
+#
+# With a `downloads_dir`, finished files from here or from job directories can
+# be published as hard links under a directory named by an unguessable token,
+# for the web server to send straight from disk. A link expires `link_age`
+# seconds after it was last published, or at the next sweep once the file it
+# was made from is gone (evicted, or its job swept). Links are only tracked in
+# memory, so the first sweep after a restart removes them all.
+
+DEFAULT_STORAGE_DIR = os.environ.get('EMLPDF_STORAGE_DIR', os.path.join(tempfile.gettempdir(), 'emlpdf-storage'))
+DEFAULT_SESSION_QUOTA = int(os.environ.get('EMLPDF_SESSION_QUOTA', str(2 * 1024 ** 3)))
+DEFAULT_GLOBAL_QUOTA = int(os.environ.get('EMLPDF_STORAGE_QUOTA', str(20 * 1024 ** 3)))
+DEFAULT_SESSION_IDLE = float(os.environ.get('EMLPDF_SESSION_IDLE', str(12 * 3600)))
+DEFAULT_SWEEP_INTERVAL = float(os.environ.get('EMLPDF_STORAGE_SWEEP_INTERVAL', '600'))
+DEFAULT_LINK_AGE = float(os.environ.get('EMLPDF_DOWNLOAD_LINK_AGE', str(12 * 3600)))
+
+HEARTBEAT_FILE = '.alive'
+
+
+class StorageQuotaError(Exception):
+    pass
+
+
+class SessionStorage:
+    # One session's directory. `name` is where its files go, as with the
+    # tempfile.TemporaryDirectory it replaces; the directory is removed when the
+    # session object is garbage collected, or later by the sweep.
+    def __init__(self, manager, session_id):
+        self.manager = manager
+        self.id = session_id
+        self.name = os.path.join(manager.sessions_dir, session_id)
+        self.artifacts_dir = os.path.join(self.name, 'artifacts')
+        os.makedirs(self.artifacts_dir)
+        self.touch()
+        weakref.finalize(self, manager.remove_session, session_id)
+
+    def touch(self):
+        # Returns False if the directory is gone, e.g. removed by the sweep of
+        # another server process sharing the storage root
+        try:
+            with open(os.path.join(self.name, HEARTBEAT_FILE), 'a'):
+                pass
+            os.utime(os.path.join(self.name, HEARTBEAT_FILE))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def artifact_dir(self):
+        # A new directory for one run's intermediate files, which may be evicted.
+        # The newest one is the session's current output, whose download button
+        # may still be on screen, so it is kept until the next one is made.
+        path = tempfile.mkdtemp(dir=self.artifacts_dir)
+        self.manager.set_current(self.id, path)
+        return path
+
+    def use(self, artifact_dir):
+        # Mark an artifact directory as recently used, e.g. when it is downloaded
+        try:
+            os.utime(artifact_dir)
+        except FileNotFoundError:
+            pass
+
+    def usage(self):
+        # Bytes of this session's files, counting shared files in full
+        return self.manager.session_usage(self.id)
+
+    def reserve(self, nbytes):
+        self.manager.reserve(self, nbytes)
+
+    def share(self, path, sha256=None):
+        return self.manager.share(path, sha256)
+
+
+class StorageManager:
+    # Usage is kept as running byte counts, updated as space is reserved, files
+    # are shared and artifacts are evicted, so checking a quota never walks the
+    # disk. Reservations are estimates; each sweep measures the real usage and
+    # resets the counts to it.
+    def __init__(self, root=DEFAULT_STORAGE_DIR, session_quota=DEFAULT_SESSION_QUOTA,
+                 global_quota=DEFAULT_GLOBAL_QUOTA, session_idle=DEFAULT_SESSION_IDLE, sweep_interval=None,
+                 downloads_dir=None, link_age=DEFAULT_LINK_AGE):
+        self.root = root
+        self.downloads_dir = downloads_dir
+        self.link_age = link_age
+        self.sessions_dir = os.path.join(root, 'sessions')
+        self.blobs_dir = os.path.join(root, 'blobs')
+        self.session_quota = session_quota
+        self.global_quota = global_quota
+        self.session_idle = session_idle
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.swept_sessions = 0
+        self._lock = threading.RLock()
+        # Session id -> bytes of its files, shared files counted in full
+        self._session_bytes = {}
+        # Bytes on disk, shared files counted once
+        self._total_bytes = 0
+        self._blob_count = 0
+        # Session id -> its current artifact directory, never evicted
+        self._current = {}
+        # Sessions alive in this process, whose directories are never swept
+        self._live = set()
+        # (source path, file name) -> token of its published download link
+        self._links = {}
+        os.makedirs(self.sessions_dir, exist_ok=True)
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        if downloads_dir:
+            os.makedirs(downloads_dir, exist_ok=True)
+        self.sweep()
+        if sweep_interval:
+            self._stop = run_every(sweep_interval, self.sweep, 'storage-sweep')
+
+    def session(self):
+        session_id = uuid.uuid4().hex
+        with self._lock:
+            self._live.add(session_id)
+        return SessionStorage(self, session_id)
+
+    def remove_session(self, session_id):
+        # Delete a session's directory once the session is gone
+        path = os.path.join(self.sessions_dir, session_id)
+        with self._lock:
+            freed = sum(stat.st_size for _, stat in walk_files(path) if stat.st_nlink == 1)
+            shutil.rmtree(path, ignore_errors=True)
+            self._total_bytes = max(0, self._total_bytes - freed)
+            self._session_bytes.pop(session_id, None)
+            self._current.pop(session_id, None)
+            self._live.discard(session_id)
+
+    def set_current(self, session_id, artifact_dir):
+        with self._lock:
+            self._current[session_id] = os.path.abspath(artifact_dir)
+
+    def session_usage(self, session_id):
+        with self._lock:
+            return self._session_bytes.get(session_id, 0)
+
+    def blob_path(self, sha256):
+        return os.path.join(self.blobs_dir, sha256[:2], sha256)
+
+    def share(self, path, sha256=None):
+        # Store the content of the finished file at `path` once for the whole server
+        if sha256 is None:
+            with open(path, 'rb') as shared_file:
+                sha256 = content_hash(shared_file)
+        blob = self.blob_path(sha256)
+        with self._lock:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            try:
+                if not os.path.exists(blob):
+                    os.link(path, blob)
+                    self._blob_count += 1
+                elif not os.path.samefile(blob, path):
+                    # Swap our copy for another link to the blob in one step
+                    size = os.path.getsize(path)
+                    link_path = path + '.link'
+                    os.link(blob, link_path)
+                    os.replace(link_path, path)
+                    self._total_bytes = max(0, self._total_bytes - size)
+            except OSError:
+                pass  # No hard links here: the file simply keeps its own copy
+        return path
+
+    def publish(self, path, file_name):
+        # A download link to the finished file at `path`, served as `file_name`;
+        # returns its path relative to `downloads_dir`. Publishing the same file
+        # again reuses the link and keeps it from expiring.
+        file_name = os.path.basename(file_name)
+        key = (os.path.abspath(path), file_name)
+        with self._lock:
+            token = self._links.get(key)
+            if token is not None and os.path.exists(os.path.join(self.downloads_dir, token, file_name)):
+                os.utime(os.path.join(self.downloads_dir, token))
+                return f"{token}/{file_name}"
+            token = secrets.token_urlsafe(24)
+            link_dir = os.path.join(self.downloads_dir, token)
+            os.makedirs(link_dir)
+            link_or_copy(path, os.path.join(link_dir, file_name))
+            self._links[key] = token
+        return f"{token}/{file_name}"
+
+    def _sweep_links(self, now):
+        # Remove expired links, links to files that are gone and links we do not know
+        sources = {token: source for (source, _), token in self._links.items()}
+        for entry in os.scandir(self.downloads_dir):
+            source = sources.get(entry.name)
+            try:
+                expired = now - entry.stat().st_mtime > self.link_age
+            except FileNotFoundError:
+                continue
+            if source is None or expired or not os.path.exists(source):
+                shutil.rmtree(entry.path, ignore_errors=True)
+        self._links = {
+            key: token for key, token in self._links.items()
+            if os.path.isdir(os.path.join(self.downloads_dir, token))
+        }
+
+    def usage(self):
+        # Disk usage of all sessions from the running counts
+        with self._lock:
+            return {
+                'bytes': self._total_bytes,
+                'apparent_bytes': sum(self._session_bytes.values()),
+                'sessions': len(self._session_bytes),
+                'blobs': self._blob_count,
+            }
+
+    def _measure(self):
+        # Walk everything and reset the running counts to what is on disk
+        seen = set()
+        total = 0
+        session_bytes = {}
+        for entry in os.scandir(self.sessions_dir):
+            if not entry.is_dir():
+                continue
+            session_bytes[entry.name] = 0
+            for _, stat in walk_files(entry.path):
+                session_bytes[entry.name] += stat.st_size
+                if (stat.st_dev, stat.st_ino) not in seen:
+                    seen.add((stat.st_dev, stat.st_ino))
+                    total += stat.st_size
+        blob_count = 0
+        for _, stat in walk_files(self.blobs_dir):
+            blob_count += 1
+            if (stat.st_dev, stat.st_ino) not in seen:
+                seen.add((stat.st_dev, stat.st_ino))
+                total += stat.st_size
+        self._session_bytes = session_bytes
+        self._total_bytes = total
+        self._blob_count = blob_count
+        self._current = {key: path for key, path in self._current.items() if key in session_bytes}
+
+    def reserve(self, session, nbytes):
+        # Make room for `nbytes` more in `session`, evicting the least recently used
+        # artifacts of that session, then of all sessions. Raises StorageQuotaError
+        # if that is not enough. No session's current artifact is ever evicted.
+        with self._lock:
+            keep = set(self._current.values())
+
+            def session_fits():
+                return self._session_bytes.get(session.id, 0) + nbytes <= self.session_quota
+
+            def server_fits():
+                return self._total_bytes + nbytes <= self.global_quota
+
+            if not session_fits():
+                self._evict(self._artifacts([session.name]), keep, session_fits)
+                if not session_fits():
+                    raise StorageQuotaError(
+                        f"This session has {self._session_bytes.get(session.id, 0) / 1024 ** 2:.0f} MB of files "
+                        f"and may keep {self.session_quota / 1024 ** 2:.0f} MB; reload the page to start a new session."
+                    )
+            if not server_fits():
+                sessions = [entry.path for entry in os.scandir(self.sessions_dir) if entry.is_dir()]
+                self._evict(self._artifacts(sessions), keep, server_fits)
+                if not server_fits():
+                    raise StorageQuotaError("The server is out of space for files; please try again later.")
+            self._session_bytes[session.id] = self._session_bytes.get(session.id, 0) + nbytes
+            self._total_bytes += nbytes
+
+    def _artifacts(self, session_dirs):
+        # (last used, path) of every artifact directory in `session_dirs`, oldest first
+        artifacts = []
+        for session_dir in session_dirs:
+            try:
+                entries = list(os.scandir(os.path.join(session_dir, 'artifacts')))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                try:
+                    artifacts.append((entry.stat().st_mtime, os.path.abspath(entry.path)))
+                except FileNotFoundError:
+                    continue
+        return sorted(artifacts)
+
+    def _evict(self, artifacts, keep, enough):
+        # Remove artifacts not in `keep`, oldest first, until `enough()` is true,
+        # along with blobs nothing else links to any more
+        blobs = None
+        for _, path in artifacts:
+            if enough():
+                break
+            if path in keep:
+                continue
+            files = list(walk_files(path))
+            if blobs is None and any(stat.st_nlink == 2 for _, stat in files):
+                blobs = {(stat.st_dev, stat.st_ino): blob for blob, stat in walk_files(self.blobs_dir)}
+            size = freed = 0
+            for _, stat in files:
+                size += stat.st_size
+                if stat.st_nlink == 1:
+                    freed += stat.st_size
+                elif stat.st_nlink == 2 and blobs and (stat.st_dev, stat.st_ino) in blobs:
+                    # The blob was its only other link
+                    os.remove(blobs.pop((stat.st_dev, stat.st_ino)))
+                    self._blob_count -= 1
+                    freed += stat.st_size
+            shutil.rmtree(path, ignore_errors=True)
+            session_id = os.path.basename(os.path.dirname(os.path.dirname(path)))
+            if session_id in self._session_bytes:
+                self._session_bytes[session_id] = max(0, self._session_bytes[session_id] - size)
+            self._total_bytes = max(0, self._total_bytes - freed)
+            self.evictions += 1
+            self.evicted_bytes += size
+
+    def _collect_blobs(self):
+        # Remove blobs no session links to any more
+        for path, stat in walk_files(self.blobs_dir):
+            if stat.st_nlink == 1:
+                os.remove(path)
+
+    def sweep(self):
+        # Remove the directories of sessions that are gone and unused blobs,
+        # measure what is left, then publish disk usage
+        now = time.time()
+        with self._lock:
+            for entry in os.scandir(self.sessions_dir):
+                if not entry.is_dir() or entry.name in self._live:
+                    continue
+                try:
+                    last_seen = os.path.getmtime(os.path.join(entry.path, HEARTBEAT_FILE))
+                except FileNotFoundError:
+                    last_seen = entry.stat().st_mtime
+                if now - last_seen > self.session_idle:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    self.swept_sessions += 1
+            self._collect_blobs()
+            self._measure()
+            if self.downloads_dir:
+                self._sweep_links(now)
+            usage = self.usage()
+        publish_gauges({
+            'storage_bytes': (usage['bytes'], 'Bytes of session files on disk, shared files counted once.'),
+            'storage_apparent_bytes': (usage['apparent_bytes'], 'Bytes of session files, shared files counted per use.'),
+            'storage_sessions': (usage['sessions'], 'Session directories on disk.'),
+            'storage_blobs': (usage['blobs'], 'Distinct shared files.'),
+            'storage_evicted_bytes': (self.evicted_bytes, 'Bytes of intermediate files evicted to stay under quota.'),
+            'storage_swept_sessions': (self.swept_sessions, 'Abandoned session directories removed.'),
+        })
+        return usage
@@ -0,0 +1,97 @@
+import os
+
+import pytest
+from PyPDF2 import PdfReader
+
+from benchmark import FakeZamzarServer
+from core import combine_pdfs, convert_emails
+from polling import PollPolicy
+from zamzar import ConversionError, ZamzarClient, convert_files
+
+# Concurrent conversion through ZamzarClient against the fake server from benchmark.py
+
+FAST_POLLS = PollPolicy(first_delay=0.02, max_delay=0.05, jitter=0, deadline=10)
+
+
+def pdf_text(path):
+    return ' '.join(page.extract_text() for page in PdfReader(path).pages)
+
+
+@pytest.fixture
+def emails(tmp_path):
+    paths = []
+    for name in ('first.eml', 'second.eml', 'third.eml'):
+        path = tmp_path / name
+        path.write_bytes(b'Subject: ' + name.encode() + b'\r\n\r\nbody\r\n')
+        paths.append((name, str(path)))
+    return paths
+
+
+def client_for(server):
+    return ZamzarClient('test', base_url=server.url, requests_per_second=0)
+
+
+class FastZamzarConverter:
+    needs_api_key = True
+    cache_format = 'pdf'
+
+    def __init__(self, client):
+        self.client = client
+
+    def convert_files(self, jobs, on_complete=None, stats=None, on_warning=None, **resume):
+        return convert_files(self.client, jobs, policy=FAST_POLLS, on_complete=on_complete, stats=stats, **resume)
+
+
+def test_results_follow_selection_order(tmp_path, emails):
+    # The first email selected is the last to finish converting
+    latencies = {'first.eml': 0.4, 'second.eml': 0.2, 'third.eml': 0.0}
+    output_dir = tmp_path / 'converted'
+    output_dir.mkdir()
+    completed = []
+    with FakeZamzarServer(latencies=latencies) as server, client_for(server) as client:
+        results = convert_emails(
+            FastZamzarConverter(client), emails, str(output_dir),
+            on_converted=lambda file_names, path: completed.extend(file_names)
+        )
+
+    assert completed == ['third.eml', 'second.eml', 'first.eml']
+    assert set(results) == {name for name, _ in emails}
+    for name, _ in emails:
+        assert f"Converted {name}" in pdf_text(results[name])
+
+    combined = str(tmp_path / 'combined.pdf')
+    combine_pdfs([results[name] for name, _ in emails], combined)
+    pages = [page.extract_text() for page in PdfReader(combined).pages]
+    assert [name for name, _ in emails] == [
+        next(name for name, _ in emails if f"Converted {name}" in text) for text in pages
+    ]
+
+
+def test_partial_failure_names_failed_jobs(tmp_path, emails):
+    output_dir = tmp_path / 'converted'
+    output_dir.mkdir()
+    jobs = [(name, name, path, str(output_dir / (name + '.pdf'))) for name, path in emails]
+    completed = []
+    with FakeZamzarServer(latency=0.05, failing={'second.eml'}) as server, client_for(server) as client:
+        with pytest.raises(ConversionError) as raised:
+            convert_files(client, jobs, policy=FAST_POLLS, on_complete=lambda key, path: completed.append(key))
+
+    assert raised.value.failed == ['second.eml']
+    assert 'second.eml' in str(raised.value)
+    # Jobs that succeeded were delivered before the error was raised
+    assert sorted(completed) == ['first.eml', 'third.eml']
+    assert os.path.exists(output_dir / 'first.eml.pdf')
+    assert not os.path.exists(output_dir / 'second.eml.pdf')
+
+
+def test_resumed_jobs_are_not_uploaded_again(tmp_path, emails):
+    output_dir = tmp_path / 'converted'
+    output_dir.mkdir()
+    jobs = [(name, name, path, str(output_dir / (name + '.pdf'))) for name, path in emails]
+    submitted = {}
+    with FakeZamzarServer(latency=0.05) as server, client_for(server) as client:
+        convert_files(client, jobs[:1], policy=FAST_POLLS, on_submitted=submitted.__setitem__)
+        results = convert_files(client, jobs, policy=FAST_POLLS, submitted=submitted)
+        # One upload for the first call and two for the new jobs of the second
+        assert len(server._jobs) == 3
+    assert set(results) == {name for name, _ in emails}
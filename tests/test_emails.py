@@ -0,0 +1,184 @@
+import struct
+from datetime import datetime, timezone
+from email.message import EmailMessage
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from emails import EmailParseError, parse_email_file
+
+ENDOFCHAIN = 0xFFFFFFFE
+FREESECT = 0xFFFFFFFF
+FATSECT = 0xFFFFFFFD
+NOSTREAM = 0xFFFFFFFF
+
+
+def png_bytes(size=(4, 3), color=(200, 30, 30)):
+    buffer = BytesIO()
+    Image.new('RGB', size, color).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def plain_eml():
+    message = EmailMessage()
+    message['From'] = 'Alice <alice@example.com>'
+    message['To'] = 'bob@example.com'
+    message['Subject'] = 'Quarterly report'
+    message['Date'] = 'Tue, 01 Apr 2025 09:30:00 +0000'
+    message.set_content('Hello Bob,\n\nThe report is attached.\n')
+    message.add_attachment(b'%PDF-1.4 fake', maintype='application', subtype='pdf', filename='report.pdf')
+    return bytes(message)
+
+
+def html_eml(body='<p>See the chart:</p><img src="cid:chart@example">'):
+    message = EmailMessage()
+    message['From'] = 'alice@example.com'
+    message['Subject'] = 'Chart'
+    message.set_content('See the chart.')
+    message.add_alternative(f'<html><body>{body}</body></html>', subtype='html')
+    message.get_payload()[1].add_related(png_bytes(), 'image', 'png', cid='<chart@example>')
+    return bytes(message)
+
+
+def compound_file(streams):
+    # A minimal version 3 OLE compound file holding `streams`, {'storage/name': bytes}.
+    # Every stream goes in the mini stream, so each must be under 4096 bytes.
+    nodes = [{'name': 'Root Entry', 'type': 5, 'children': [], 'data': b''}]
+    index = {(): 0}
+    for path, data in streams.items():
+        parts = tuple(path.split('/'))
+        for depth in range(1, len(parts)):
+            if parts[:depth] not in index:
+                index[parts[:depth]] = len(nodes)
+                nodes[index[parts[:depth - 1]]]['children'].append(len(nodes))
+                nodes.append({'name': parts[depth - 1], 'type': 1, 'children': [], 'data': b''})
+        nodes[index[parts[:-1]]]['children'].append(len(nodes))
+        nodes.append({'name': parts[-1], 'type': 2, 'children': [], 'data': data})
+
+    ministream = b''
+    minifat = []
+    for node in nodes:
+        node['start'] = 0
+        if node['type'] == 2:
+            assert len(node['data']) < 4096
+            count = (len(node['data']) + 63) // 64
+            node['start'] = len(minifat) if count else ENDOFCHAIN
+            minifat += [len(minifat) + i + 1 for i in range(count)]
+            if count:
+                minifat[-1] = ENDOFCHAIN
+            ministream += node['data'].ljust(count * 64, b'\0')
+
+    def sectors(data):
+        return [data[i:i + 512].ljust(512, b'\0') for i in range(0, len(data), 512)]
+
+    # Sector 0 holds the FAT, followed by the mini FAT, the directory and the mini stream
+    minifat_sectors = sectors(struct.pack(f'<{len(minifat)}I', *minifat))
+    mini_sectors = sectors(ministream)
+    directory_count = (len(nodes) * 128 + 511) // 512
+    fat = [FATSECT]
+    chains = []
+    for count in (len(minifat_sectors), directory_count, len(mini_sectors)):
+        chains.append(len(fat))
+        fat += [len(fat) + i + 1 for i in range(count)]
+        fat[-1] = ENDOFCHAIN
+    assert len(fat) <= 128
+    fat += [FREESECT] * (128 - len(fat))
+    first_minifat, first_directory, first_mini = chains
+
+    # The root entry's stream is the mini stream itself. Siblings are chained
+    # through their right pointers, a valid if unbalanced tree.
+    nodes[0]['start'] = first_mini
+    nodes[0]['data'] = ministream
+    for node in nodes:
+        children = node['children']
+        for child, right in zip(children, children[1:] + [NOSTREAM]):
+            nodes[child]['right'] = right
+    directory = b''
+    for node in nodes:
+        name = node['name'].encode('utf-16-le') + b'\0\0'
+        directory += struct.pack(
+            '<64sHBBIII16sIQQIQ', name, len(name), node['type'], 1, NOSTREAM, node.get('right', NOSTREAM),
+            node['children'][0] if node['children'] else NOSTREAM, b'', 0, 0, 0, node['start'], len(node['data'])
+        )
+    directory_sectors = sectors(directory)
+
+    header = struct.pack(
+        '<8s16sHHHHH6sIIIIIIIII', b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', b'', 0x3E, 3, 0xFFFE, 9, 6, b'',
+        0, 1, first_directory, 0, 4096, first_minifat, len(minifat_sectors), ENDOFCHAIN, 0
+    ) + struct.pack('<109I', 0, *[FREESECT] * 108)
+    return header + struct.pack('<128I', *fat) + b''.join(minifat_sectors + directory_sectors + mini_sectors)
+
+
+def msg_string(value):
+    return value.encode('utf-16-le')
+
+
+def outlook_msg():
+    submitted = datetime(2025, 4, 1, 9, 30, tzinfo=timezone.utc)
+    filetime = int((submitted - datetime(1601, 1, 1, tzinfo=timezone.utc)).total_seconds() * 10 ** 7)
+    attach = '__attach_version1.0_#0000000{}'
+    return compound_file({
+        '__substg1.0_0037001F': msg_string('Budget'),
+        '__substg1.0_0C1A001F': msg_string('Alice'),
+        '__substg1.0_0C1F001F': msg_string('alice@example.com'),
+        '__substg1.0_0E04001F': msg_string('Bob'),
+        '__substg1.0_1000001F': msg_string('Numbers inside.'),
+        '__substg1.0_10130102': b'<p>Numbers:</p><img src="cid:logo@example">',
+        '__properties_version1.0': b'\0' * 32 + struct.pack('<HHIQ', 0x0040, 0x0039, 0, filetime),
+        f"{attach.format(0)}/__substg1.0_37010102": png_bytes(),
+        f"{attach.format(0)}/__substg1.0_3707001F": msg_string('logo.png'),
+        f"{attach.format(0)}/__substg1.0_370E001F": msg_string('image/png'),
+        f"{attach.format(0)}/__substg1.0_3712001F": msg_string('logo@example'),
+        f"{attach.format(1)}/__substg1.0_37010102": b'%PDF-1.4 fake',
+        f"{attach.format(1)}/__substg1.0_3704001F": msg_string('budget.pdf'),
+    })
+
+
+def test_plain_eml():
+    parsed = parse_email_file('report.eml', plain_eml())
+    assert parsed.headers['Subject'] == 'Quarterly report'
+    assert parsed.headers['From'] == 'Alice <alice@example.com>'
+    assert parsed.text.startswith('Hello Bob,')
+    assert parsed.html is None
+    assert [(a.filename, a.is_pdf) for a in parsed.attachments] == [('report.pdf', True)]
+
+
+def test_eml_from_disk(tmp_path):
+    path = tmp_path / 'report.eml'
+    path.write_bytes(plain_eml())
+    assert parse_email_file('report.eml', str(path)).headers['To'] == 'bob@example.com'
+
+
+def test_html_eml_with_inline_image():
+    parsed = parse_email_file('chart.eml', html_eml())
+    assert 'cid:chart@example' in parsed.html
+    assert parsed.text.strip() == 'See the chart.'
+    assert list(parsed.inline_images) == ['chart@example']
+    assert parsed.inline_images['chart@example'].is_image
+    assert parsed.attachments == []
+
+
+def test_outlook_msg(tmp_path):
+    path = tmp_path / 'budget.msg'
+    path.write_bytes(outlook_msg())
+    for source in (path.read_bytes(), str(path)):
+        parsed = parse_email_file('budget.msg', source)
+        assert parsed.headers == {
+            'From': 'Alice <alice@example.com>',
+            'To': 'Bob',
+            'Date': 'Tue, 01 Apr 2025 09:30:00 +0000',
+            'Subject': 'Budget',
+        }
+        assert parsed.text == 'Numbers inside.'
+        assert list(parsed.inline_images) == ['logo@example']
+        assert [(a.filename, a.mime_type, a.is_pdf) for a in parsed.attachments] == [
+            ('budget.pdf', 'application/pdf', True)
+        ]
+
+
+def test_rejects_files_that_are_not_emails():
+    with pytest.raises(EmailParseError):
+        parse_email_file('fake.msg', b'not an OLE file')
+    with pytest.raises(EmailParseError):
+        parse_email_file('notes.txt', b'hello')
@@ -0,0 +1,21 @@
+import sys
+
+import pytest
+
+from instrumentation import RunMetrics
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='reads /proc')
+def test_stages_report_their_own_memory_growth():
+    metrics = RunMetrics('test')
+    with metrics.stage('allocate'):
+        buffer = bytearray(64 * 1024 * 1024)
+    with metrics.stage('free'):
+        del buffer
+    with metrics.stage('idle'):
+        pass
+    allocate, free, idle = metrics.as_dict()['stages']
+    assert allocate['rss_delta_mb'] > 50
+    assert free['rss_delta_mb'] < -50
+    assert abs(idle['rss_delta_mb']) < 5
+    assert allocate['peak_mb'] is None  # Only with EMLPDF_TRACE_MEMORY=1
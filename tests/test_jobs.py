@@ -0,0 +1,59 @@
+import os
+import random
+import time
+
+from benchmark import text_pdf
+from jobs import DONE, UNFINISHED, JobRunner, JobStore
+from test_emails import html_eml
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.05)
+
+
+def test_finished_jobs_are_swept_while_running(tmp_path):
+    path = str(tmp_path / 'a.pdf')
+    text_pdf(path, 1, random.Random(0))
+    store = JobStore(str(tmp_path / 'jobs'))
+    runner = JobRunner(store, max_age=0.5, sweep_interval=0.2)
+    job_id = runner.submit_combine([('a.pdf', path)], 'local')
+    wait_for(lambda: runner.get(job_id)['status'] == DONE)
+    assert os.path.exists(runner.get(job_id)['output'])
+
+    wait_for(lambda: runner.get(job_id) is None)
+    assert job_id not in runner._jobs
+    assert os.listdir(store.root) == []
+
+
+def test_oldest_finished_jobs_are_swept_past_the_byte_limit(tmp_path):
+    path = str(tmp_path / 'a.pdf')
+    text_pdf(path, 3, random.Random(0))
+    store = JobStore(str(tmp_path / 'jobs'))
+    runner = JobRunner(store, max_bytes=None)
+    job_ids = []
+    for _ in range(3):
+        job_ids.append(runner.submit_combine([('a.pdf', path)], 'local'))
+        wait_for(lambda: runner.get(job_ids[-1])['status'] == DONE)
+    runner.sweep()
+    assert store.jobs == 3
+    one_job = store.bytes // 3
+
+    runner.max_bytes = 2 * one_job + one_job // 2
+    runner.sweep()
+    assert runner.get(job_ids[0]) is None
+    assert runner.get(job_ids[1]) is not None and runner.get(job_ids[2]) is not None
+    assert store.jobs == 2 and store.bytes <= runner.max_bytes
+
+
+def test_local_job_with_missing_glyphs_finishes_with_a_warning(tmp_path):
+    path = tmp_path / 'hi.eml'
+    path.write_bytes(html_eml('<p>hi \U0001F600 there</p>'))
+    runner = JobRunner(JobStore(str(tmp_path / 'jobs')))
+    job_id = runner.submit_combine([('hi.eml', str(path))], 'local')
+    wait_for(lambda: runner.get(job_id)['status'] not in UNFINISHED)
+    state = runner.get(job_id)
+    assert state['status'] == DONE
+    assert any('\U0001F600' in event for event in state['events'])
@@ -0,0 +1,27 @@
+import os
+import tracemalloc
+
+from PyPDF2 import PdfReader
+
+from benchmark import build_corpus
+from core import page_count
+from merge import stream_merge
+
+
+def test_stream_merge_memory_stays_near_largest_input(tmp_path):
+    # About 40 MB of PDFs, the largest a 10 MB scan
+    corpus = build_corpus(str(tmp_path), 'medium')
+    paths = corpus['pdfs'] + corpus['scans']
+    sizes = [os.path.getsize(path) for path in paths]
+    output_path = str(tmp_path / 'merged.pdf')
+
+    tracemalloc.start()
+    try:
+        stream_merge(paths, output_path)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert sum(sizes) > 3 * max(sizes)
+    assert peak < 1.5 * max(sizes)
+    assert len(PdfReader(output_path).pages) == sum(page_count(path) for path in paths)
@@ -0,0 +1,87 @@
+import time
+
+import pytest
+
+from core import SelectionError, parse_range_groups, parse_selection
+from ranges import RangeError, parse_ranges
+
+
+def pages(expression, count=10):
+    return list(parse_ranges(expression, count))
+
+
+@pytest.mark.parametrize('expression, expected', [
+    ('7', [7]),
+    ('3-5', [3, 4, 5]),
+    (' 3 - 5 ', [3, 4, 5]),
+    ('5-', [5, 6, 7, 8, 9, 10]),
+    ('last', [10]),
+    ('-1', [10]),
+    ('-3', [8]),
+    ('-3-', [8, 9, 10]),
+    ('last-8', [10, 9, 8]),
+    ('10-7', [10, 9, 8, 7]),
+    ('-1-1', [10, 9, 8, 7, 6, 5, 4, 3, 2, 1]),
+    ('1-9:2', [1, 3, 5, 7, 9]),
+    ('1-:3', [1, 4, 7, 10]),
+    ('10-1:4', [10, 6, 2]),
+    ('9, 2-3, last', [9, 2, 3, 10]),
+])
+def test_forms(expression, expected):
+    assert pages(expression) == expected
+
+
+def test_huge_ranges_are_clamped_without_expanding():
+    start = time.perf_counter()
+    selection = parse_ranges('1-2000000000', 10)
+    assert list(selection) == list(range(1, 11))
+    assert len(selection) == 10
+    assert pages('2000000000-1') == list(range(10, 0, -1))
+    assert pages('8-2000000000:2') == [8, 10]
+    assert time.perf_counter() - start < 1
+
+
+def test_duplicates_are_removed_keeping_typed_order():
+    assert pages('5, 1-6, 5, 2') == [5, 1, 2, 3, 4, 6]
+    assert pages('3-1, 1-4') == [3, 2, 1, 4]
+    selection = parse_ranges('5, 1-6', 10)
+    assert list(selection.sorted()) == [1, 2, 3, 4, 5, 6]
+    assert 6 in selection and 7 not in selection
+
+
+@pytest.mark.parametrize('expression, message', [
+    ('11', "'11' is out of range: there are only 10 pages."),
+    ('-11', "'-11' is out of range: there are only 10 pages."),
+    ('11-20', "'11-20' is out of range: there are only 10 pages."),
+    ('0', "'0': pages are numbered from 1."),
+    ('0-3', "'0-3': pages are numbered from 1."),
+    ('1-5:0', "'1-5:0': the step must be at least 1."),
+    ('abc', "'abc' is not a page number or range (use forms like 7, 3-5, 5-, last, -2, 10-1 or 1-9:2)."),
+    (' , ', "Enter at least one page number or range."),
+])
+def test_errors(expression, message):
+    with pytest.raises(RangeError) as error:
+        parse_ranges(expression, 10)
+    assert str(error.value) == message
+
+
+def test_singular_count_in_messages():
+    with pytest.raises(RangeError, match=r"there is only 1 page\."):
+        parse_ranges('2', 1)
+    with pytest.raises(RangeError, match="no pages"):
+        parse_ranges('1', 0)
+
+
+def test_parse_selection():
+    assert parse_selection('3, 1-2', 3) == [3, 1, 2]
+    with pytest.raises(SelectionError) as error:
+        parse_selection('4', 3)
+    assert str(error.value) == "'4' is out of range: there are only 3 files."
+    with pytest.raises(SelectionError):
+        parse_selection('0', 3)
+
+
+def test_range_groups_name_the_bad_set():
+    assert [label for label, _ in parse_range_groups('1-2; 2-1', 5)] == ['1_pages_1-2', '2_pages_2-1']
+    with pytest.raises(RangeError, match=r"^Set 2: '9' is out of range"):
+        parse_range_groups('1; 9', 5)
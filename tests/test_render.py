@@ -0,0 +1,73 @@
+import pytest
+from PyPDF2 import PdfReader
+
+from converters import CONVERTER_LOCAL, LocalConverter, get_converter
+from emails import EmailParseError, parse_email_file
+from render import render_email
+from test_emails import html_eml, outlook_msg, plain_eml
+from zamzar import ConversionError
+
+
+def page_text(path):
+    return '\n'.join(page.extract_text() for page in PdfReader(str(path)).pages)
+
+
+def page_images(path):
+    return [
+        name for page in PdfReader(str(path)).pages
+        for name in page['/Resources'].get('/XObject', {})
+    ]
+
+
+def test_plain_eml(tmp_path):
+    output = tmp_path / 'report.pdf'
+    render_email(parse_email_file('report.eml', plain_eml()), str(output))
+    text = page_text(output)
+    assert 'Quarterly report' in text
+    assert 'The report is attached.' in text
+    assert 'report.pdf' in text  # Listed under Attachments
+
+
+def test_html_eml_with_inline_image(tmp_path):
+    output = tmp_path / 'chart.pdf'
+    render_email(parse_email_file('chart.eml', html_eml()), str(output))
+    assert 'See the chart:' in page_text(output)
+    assert len(page_images(output)) == 1
+
+
+def test_outlook_msg(tmp_path):
+    output = tmp_path / 'budget.pdf'
+    render_email(parse_email_file('budget.msg', outlook_msg()), str(output))
+    text = page_text(output)
+    assert 'Budget' in text and 'Numbers:' in text and 'budget.pdf' in text
+    assert len(page_images(output)) == 1
+
+
+def test_missing_glyphs_fail_only_when_asked(tmp_path):
+    parsed = parse_email_file('hi.eml', html_eml('<p>hi \U0001F600 there → Привет</p>'))
+    with pytest.raises(EmailParseError):
+        render_email(parsed, str(tmp_path / 'strict.pdf'))
+
+    missing = set()
+    render_email(parsed, str(tmp_path / 'lossy.pdf'), missing)
+    assert missing == set('\U0001F600→Привет')
+    assert 'hi ? there ? ??????' in page_text(tmp_path / 'lossy.pdf')
+
+
+def test_local_converter_warns_instead_of_failing(tmp_path):
+    source = tmp_path / 'hi.eml'
+    source.write_bytes(html_eml('<p>hi \U0001F600 there</p>'))
+    jobs = [('key', 'hi.eml', str(source), str(tmp_path / 'hi.pdf'))]
+    warnings = []
+    results = LocalConverter(max_workers=1).convert_files(jobs, on_warning=lambda *args: warnings.append(args))
+    assert results == {'key': str(tmp_path / 'hi.pdf')}
+    assert len(warnings) == 1 and warnings[0][0] == 'key' and '\U0001F600' in warnings[0][1]
+
+    with pytest.raises(ConversionError) as error:
+        LocalConverter(max_workers=1, strict=True).convert_files(jobs)
+    assert error.value.failed == ['key']
+
+
+def test_fallback_results_are_cached_apart():
+    formats = {get_converter(name, 'key').cache_format for name in (CONVERTER_LOCAL, 'zamzar', 'local+zamzar')}
+    assert len(formats) == 3
@@ -0,0 +1,62 @@
+import os
+import random
+import zipfile
+
+import pytest
+
+import core
+from benchmark import text_pdf
+from cli import main
+from core import (
+    SplitError,
+    bookmark_groups,
+    page_count,
+    parse_range_groups,
+    split_pdf,
+    split_pdf_groups,
+    zip_files,
+)
+
+
+@pytest.fixture
+def not_a_pdf(tmp_path):
+    path = tmp_path / 'bad.pdf'
+    path.write_bytes(b'not a pdf at all')
+    return str(path)
+
+
+def test_unreadable_pdf_raises_split_error(tmp_path, not_a_pdf):
+    for call in (lambda: page_count(not_a_pdf), lambda: bookmark_groups(not_a_pdf),
+                 lambda: split_pdf(not_a_pdf, [1], str(tmp_path / 'out.pdf'))):
+        with pytest.raises(SplitError, match='bad.pdf'):
+            call()
+
+
+def test_cli_reports_unreadable_pdf(tmp_path, not_a_pdf, capsys):
+    assert main(['split', not_a_pdf, '--pages', '1', '-o', str(tmp_path / 'out.pdf')]) == 1
+    assert main(['split', not_a_pdf, '--every', '1', '-o', str(tmp_path / 'out')]) == 1
+    assert 'Error reading PDF file bad.pdf' in capsys.readouterr().err
+
+
+@pytest.fixture
+def ten_pages(tmp_path):
+    path = str(tmp_path / 'ten.pdf')
+    text_pdf(path, 10, random.Random(0))
+    return path
+
+
+def test_repeated_range_sets_get_their_own_files(tmp_path, ten_pages, monkeypatch):
+    groups = parse_range_groups('1-3; 1 - 3; 9-', 10)
+    assert [label for label, _ in groups] == ['1_pages_1-3', '2_pages_1-3', '3_pages_9-']
+
+    # Through the worker processes too, which must return the outputs in group order
+    monkeypatch.setattr(core, 'PARALLEL_SPLIT_MIN_PAGES', 0)
+    output_dir = tmp_path / 'out'
+    output_dir.mkdir()
+    paths = split_pdf_groups(ten_pages, groups, str(output_dir), 'ten', max_workers=2)
+    assert [os.path.basename(path) for path in paths] == [
+        'ten_1_pages_1-3.pdf', 'ten_2_pages_1-3.pdf', 'ten_3_pages_9-.pdf'
+    ]
+    assert [page_count(path) for path in paths] == [3, 3, 2]
+    with zipfile.ZipFile(zip_files(paths, str(tmp_path / 'out.zip'))) as zip_file:
+        assert len(set(zip_file.namelist())) == 3
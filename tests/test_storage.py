@@ -0,0 +1,139 @@
+import os
+import shutil
+import time
+
+import pytest
+
+from storage import StorageManager, StorageQuotaError
+
+
+def write(directory, name, nbytes, fill=b'x'):
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as f:
+        f.write(fill * nbytes)
+    return path
+
+
+def make_artifact(session, name, nbytes, fill=b'x'):
+    session.reserve(nbytes)
+    directory = session.artifact_dir()
+    write(directory, name, nbytes, fill)
+    return directory
+
+
+def age(directory, seconds):
+    then = time.time() - seconds
+    os.utime(directory, (then, then))
+
+
+def test_eviction_follows_last_use(tmp_path):
+    manager = StorageManager(str(tmp_path), session_quota=3000, global_quota=10 ** 9)
+    session = manager.session()
+    first = make_artifact(session, 'a', 1000)
+    second = make_artifact(session, 'b', 1000, b'y')
+    age(first, 20)
+    age(second, 10)
+    session.use(first)  # The first one was downloaded since
+    make_artifact(session, 'c', 1000, b'z')
+
+    make_artifact(session, 'd', 1000, b'w')
+    assert os.path.exists(first)
+    assert not os.path.exists(second)
+    assert manager.evictions == 1
+
+
+def test_current_artifact_survives_another_sessions_reserve(tmp_path):
+    manager = StorageManager(str(tmp_path), session_quota=10 ** 9, global_quota=2500)
+    shown = manager.session()
+    on_screen = make_artifact(shown, 'a', 1000)
+    age(on_screen, 3600)
+    other = manager.session()
+    make_artifact(other, 'b', 1000, b'y')
+
+    with pytest.raises(StorageQuotaError):
+        other.reserve(1000)
+    assert os.path.exists(on_screen)
+
+
+def test_counters_track_reserve_share_and_evict(tmp_path):
+    manager = StorageManager(str(tmp_path), session_quota=2500, global_quota=10 ** 9)
+    first, second = manager.session(), manager.session()
+    a = make_artifact(first, 'a', 1000)
+    b = make_artifact(second, 'b', 1000)
+    assert manager.usage()['bytes'] == 2000
+    first.share(os.path.join(a, 'a'))
+    second.share(os.path.join(b, 'b'))  # Same content: now stored once
+    assert manager.usage() == {'bytes': 1000, 'apparent_bytes': 2000, 'sessions': 2, 'blobs': 1}
+
+    age(a, 10)
+    make_artifact(first, 'c', 1000, b'y')
+    make_artifact(first, 'd', 1000, b'z')  # Evicts 'a', still linked from the other session
+    assert first.usage() == 2000
+    assert manager.usage()['bytes'] == 3000
+    assert manager.sweep() == manager.usage()
+    assert manager.usage()['bytes'] == 3000
+
+
+def test_sweep_reconciles_estimates(tmp_path):
+    manager = StorageManager(str(tmp_path), session_quota=10 ** 9, global_quota=10 ** 9)
+    session = manager.session()
+    session.reserve(5000)  # More than gets written
+    write(session.artifact_dir(), 'a', 1000)
+    assert session.usage() == 5000
+    manager.sweep()
+    assert session.usage() == 1000
+    assert manager.usage()['bytes'] == 1000
+
+
+def test_sweep_keeps_live_sessions(tmp_path):
+    manager = StorageManager(str(tmp_path), session_idle=0)
+    session = manager.session()
+    age(os.path.join(session.name, '.alive'), 3600)
+    manager.sweep()
+    assert session.touch()
+    assert os.path.isdir(session.artifact_dir())
+
+    session_id = session.id
+    del session
+    manager.sweep()
+    assert os.listdir(manager.sessions_dir) == []
+    assert session_id not in manager._live
+
+
+def test_touch_reports_a_removed_directory(tmp_path):
+    manager = StorageManager(str(tmp_path))
+    session = manager.session()
+    shutil.rmtree(session.name)
+    assert not session.touch()
+
+
+def test_download_links(tmp_path):
+    downloads = tmp_path / 'downloads'
+    manager = StorageManager(str(tmp_path / 'storage'), downloads_dir=str(downloads), link_age=3600)
+    session = manager.session()
+    path = write(make_artifact(session, 'a', 10), 'out.pdf', 100)
+    link = manager.publish(path, 'split_out.pdf')
+    token, file_name = link.split('/')
+    assert file_name == 'split_out.pdf' and len(token) >= 32
+    assert os.path.samefile(downloads / link, path)
+    assert manager.publish(path, 'split_out.pdf') == link  # Shown again: same link
+    assert manager.publish(path, 'other.pdf') != link
+
+    manager.sweep()
+    assert (downloads / link).exists()
+    os.remove(path)  # Evicted, or its job swept
+    manager.sweep()
+    assert not (downloads / token).exists()
+
+
+def test_download_links_expire(tmp_path):
+    downloads = tmp_path / 'downloads'
+    manager = StorageManager(str(tmp_path / 'storage'), downloads_dir=str(downloads), link_age=60)
+    path = write(str(tmp_path), 'out.pdf', 100)
+    token = manager.publish(path, 'out.pdf').split('/')[0]
+    (downloads / 'stale').mkdir()  # Left by an earlier process
+    manager.sweep()
+    assert os.listdir(downloads) == [token]
+    age(str(downloads / token), 120)
+    manager.sweep()
+    assert os.listdir(downloads) == []
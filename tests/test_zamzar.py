@@ -0,0 +1,155 @@
+import time
+
+import pytest
+
+from benchmark import FakeZamzarServer
+from polling import PollPolicy
+from zamzar import ConversionError, RateLimiter, ZamzarClient, convert_files
+
+# ZamzarClient against the fake server from benchmark.py
+
+FAST_POLLS = PollPolicy(first_delay=0.02, max_delay=0.05, jitter=0, deadline=10)
+
+
+@pytest.fixture
+def server():
+    with FakeZamzarServer(latency=0.05) as server:
+        yield server
+
+
+@pytest.fixture
+def client(server):
+    with ZamzarClient('test', base_url=server.url, backoff_factor=0, requests_per_second=0) as client:
+        yield client
+
+
+@pytest.fixture
+def email(tmp_path):
+    path = tmp_path / 'message.eml'
+    path.write_bytes(b'Subject: test\r\n\r\nbody\r\n')
+    return str(path)
+
+
+def test_requests_reuse_one_connection(server, client, email):
+    for _ in range(5):
+        client.account()
+    assert server.connections == 1
+
+    job_id = client.start_job('message.eml', email)
+    for _ in range(3):
+        client.check_job('message.eml', job_id)
+    # Polls have a pool of their own; everything else shares the first connection
+    assert server.connections == 2
+    assert server.requests == 9
+
+
+def test_account_lookups_and_downloads_are_retried(server, client, email, tmp_path):
+    server.fail_next('/account', 503, count=2)
+    assert client.account()['credits_remaining'] == server.credits
+    assert server.requests == 3
+
+    job_id = client.start_job('message.eml', email)
+    time.sleep(server.latency)
+    job_status, _ = client.check_job('message.eml', job_id)
+    server.fail_next('/content', 502)
+    output_path = client.download_target('message.eml', job_status, str(tmp_path / 'message.pdf'))
+    with open(output_path, 'rb') as pdf_file:
+        assert pdf_file.read(5) == b'%PDF-'
+
+
+def test_status_polls_are_left_to_the_scheduler(server, client, email):
+    job_id = client.start_job('message.eml', email)
+    server.fail_next('/jobs/', 429, retry_after=7)
+    requests_before = server.requests
+    assert client.check_job('message.eml', job_id) == (None, 7.0)
+    assert server.requests == requests_before + 1
+
+
+def test_throttled_job_does_not_hold_up_others(server, client, email, tmp_path):
+    jobs = [(key, f"{key}.eml", email, str(tmp_path / f"{key}.pdf")) for key in ('slow', 'fast')]
+    completed = []
+    stats = {}
+    server.fail_next('/jobs/1', 429, count=2, retry_after=0.5)
+    convert_files(client, jobs, max_concurrency=1, policy=FAST_POLLS, stats=stats,
+                  on_complete=lambda key, path: completed.append((key, time.monotonic())))
+
+    assert [key for key, _ in completed] == ['fast', 'slow']
+    assert stats['slow'].transient_errors == 2
+    polls = [when for when, method, path in server.request_times if method == 'GET' and path.endswith('/jobs/1')]
+    assert polls[1] - polls[0] >= 0.5 and polls[2] - polls[1] >= 0.5
+    # The other job finished while the throttled one was waiting out its Retry-After
+    assert completed[0][1] < polls[1]
+
+
+def test_retry_after_past_the_deadline_fails_at_once(server, client, email, tmp_path):
+    jobs = [('job', 'message.eml', email, str(tmp_path / 'message.pdf'))]
+    server.fail_next('/jobs/', 503, retry_after=3600)
+    start = time.monotonic()
+    with pytest.raises(ConversionError) as raised:
+        convert_files(client, jobs, policy=FAST_POLLS)
+    assert raised.value.failed == ['job']
+    assert time.monotonic() - start < 2
+
+
+def test_rate_limiter_spaces_requests():
+    limiter = RateLimiter(rate=50, burst=1)
+    start = time.monotonic()
+    for _ in range(11):
+        limiter.acquire()
+    assert time.monotonic() - start >= 0.19
+
+
+def test_client_requests_pass_through_the_rate_limiter(server):
+    with ZamzarClient('test', base_url=server.url, requests_per_second=20) as client:
+        start = time.monotonic()
+        for _ in range(25):
+            client.account()
+        # The first 20 are the burst; the other 5 wait 1/20 s each
+        assert time.monotonic() - start >= 0.24
+
+
+def test_credits_are_read_from_response_headers(server, client, email):
+    assert client.credits_remaining is None
+    assert client.remaining_credits() == 1000000
+    client.start_job('message.eml', email)
+    assert client.credits_remaining == 999999
+    requests_before = server.requests
+    # Known from the last response, so no account lookup is needed
+    assert client.remaining_credits() == 999999
+    assert server.requests == requests_before
+
+
+@pytest.mark.parametrize('status', [401, 403, 404])
+def test_poll_errors_without_json_fail_at_once(server, client, email, status):
+    server.fail_next('/jobs/', status, body=b'<html>Denied</html>')
+    jobs = [('key', 'message.eml', email, email + '.pdf')]
+    start = time.monotonic()
+    with pytest.raises(ConversionError) as error:
+        convert_files(client, jobs, policy=FAST_POLLS)
+    assert error.value.failed == ['key']
+    assert f"HTTP {status}" in str(error.value)
+    assert time.monotonic() - start < 2
+
+
+@pytest.mark.parametrize('path, body', [
+    ('/jobs/', {'id': 1}),
+    ('/jobs/', ['not', 'an', 'object']),
+    ('/jobs', {'status': 'initialising'}),
+])
+def test_malformed_job_data_fails_the_job(server, client, email, path, body):
+    # A status without a status, or a job without an id
+    server.fail_next(path, 201 if path == '/jobs' else 200, body=body)
+    jobs = [('key', 'message.eml', email, email + '.pdf')]
+    with pytest.raises(ConversionError) as error:
+        convert_files(client, jobs, policy=FAST_POLLS)
+    assert error.value.failed == ['key']
+    assert 'Unexpected' not in str(error.value)
+
+
+def test_success_without_target_files_fails_the_job(server, client, email):
+    server.fail_next('/jobs/', 200, body={'id': 1, 'status': 'successful', 'target_files': []})
+    jobs = [('key', 'message.eml', email, email + '.pdf')]
+    with pytest.raises(ConversionError) as error:
+        convert_files(client, jobs, policy=FAST_POLLS)
+    assert error.value.failed == ['key']
+    assert 'did not return a converted file' in str(error.value)
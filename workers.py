@@ -0,0 +1,45 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# Helpers for work done off the script thread: process pools, periodic sweeps
+# of files on disk, and walking the directories those sweeps look after.
+
+
+def process_pool(max_workers):
+    # Workers are spawned, not forked: pools are started from threads of a
+    # multi-threaded server, and a forked child can inherit a lock held by one of them
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def run_every(interval, function, name):
+    # Call `function` every `interval` seconds on a daemon thread until the
+    # returned event is set
+    stop = threading.Event()
+
+    def loop():
+        while not stop.wait(interval):
+            try:
+                function()
+            except OSError:
+                pass  # Try again next time; a sweep must never stop the thread
+
+    threading.Thread(target=loop, name=name, daemon=True).start()
+    return stop
+
+
+def walk_files(directory):
+    # (path, stat) for every file below `directory`
+    for dir_path, _, file_names in os.walk(directory):
+        for file_name in file_names:
+            path = os.path.join(dir_path, file_name)
+            try:
+                yield path, os.stat(path)
+            except FileNotFoundError:
+                continue
+
+
+def directory_size(directory):
+    # Hard-linked files count in full
+    return sum(stat.st_size for _, stat in walk_files(directory))
@@ -0,0 +1,371 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from io import BytesIO
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
+
+from polling import PollScheduler, parse_retry_after
+
+# Base URL of the Zamzar API. Point ZAMZAR_API_URL at a local fake server to
+# exercise the conversion path without spending real conversions.
+ZAMZAR_API_URL = os.environ.get('ZAMZAR_API_URL', 'https://sandbox.zamzar.com/v1').rstrip('/')
+
+# Maximum number of conversion jobs that are in flight at the same time
+DEFAULT_MAX_CONCURRENCY = int(os.environ.get('ZAMZAR_MAX_CONCURRENCY', '8'))
+
+# Client-side request rate limit, kept below the API's own limit so we are not throttled
+DEFAULT_REQUESTS_PER_SECOND = float(os.environ.get('ZAMZAR_REQUESTS_PER_SECOND', '10'))
+
+# Seconds to wait for any single HTTP request before treating it as failed
+REQUEST_TIMEOUT = 60
+
+# Longest Retry-After honoured while retrying account lookups and downloads
+MAX_RETRY_AFTER = 30
+
+
+class ConversionError(Exception):
+    # `failed` lists the keys of the jobs in a batch that did not convert
+    def __init__(self, message, failed=()):
+        super().__init__(message)
+        self.failed = list(failed)
+
+
+class RateLimiter:
+    # Token bucket shared by every thread using a client
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+
+class MultipartUpload:
+    # A multipart/form-data request body that reads the source file from disk while
+    # it is being sent. It has a known length, so requests streams it with a normal
+    # Content-Length instead of building the whole body in memory.
+    def __init__(self, fields, file_field, file_name, path):
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        head = ''.join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+            for name, value in fields.items()
+        )
+        quoted_name = file_name.replace('\\', '\\\\').replace('"', '%22').replace('\r', '%0D').replace('\n', '%0A')
+        head += (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{quoted_name}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'
+        )
+        tail = f"\r\n--{boundary}--\r\n".encode()
+        self._file = open(path, 'rb')
+        self._parts = [BytesIO(head.encode('utf-8')), self._file, BytesIO(tail)]
+        self.len = len(head.encode('utf-8')) + os.fstat(self._file.fileno()).st_size + len(tail)
+
+    def __len__(self):
+        return self.len
+
+    def read(self, size=-1):
+        chunks = []
+        while self._parts and (size < 0 or size > 0):
+            chunk = self._parts[0].read(size)
+            if not chunk:
+                self._parts.pop(0)
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CappedRetry(Retry):
+    # Waits at most MAX_RETRY_AFTER before a retry, whatever the server asks for,
+    # so no request blocks its thread for an unbounded time
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, MAX_RETRY_AFTER)
+
+
+def _json(response):
+    # The body as a dict, or an empty one if it is not a JSON object
+    try:
+        body = response.json()
+    except ValueError:
+        return {}
+    return body if isinstance(body, dict) else {}
+
+
+class ZamzarClient:
+    # A Zamzar API client on one keep-alive session. Connections are pooled and
+    # reused by every upload, poll and download; account lookups and downloads are
+    # retried with backoff on connection errors and 429/5xx; every request passes
+    # through a client-side rate limiter; and the credit headers on each response
+    # are kept so the remaining quota is known before a batch starts.
+    #
+    # Status polls are never retried here: a 429 or 5xx goes straight back to the
+    # caller's PollScheduler, which reschedules the job with its own backoff and
+    # Retry-After instead of blocking the loop that polls every other job.
+    def __init__(self, api_key, base_url=ZAMZAR_API_URL, pool_size=DEFAULT_MAX_CONCURRENCY,
+                 max_retries=3, backoff_factor=0.5, requests_per_second=DEFAULT_REQUESTS_PER_SECOND):
+        self.base_url = base_url.rstrip('/')
+        self.test_mode = 'sandbox' in self.base_url
+        self.credits_remaining = None
+        self.rate_limiter = RateLimiter(requests_per_second)
+
+        retry = CappedRetry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset({'GET', 'HEAD'}),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        poll_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session = requests.Session()
+        self.session.auth = HTTPBasicAuth(api_key, '')
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # The most specific prefix wins, so /jobs/{id} polls use the adapter without retries
+        self.session.mount(f"{self.base_url}/jobs/", poll_adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _request(self, method, path, **kwargs):
+        self.rate_limiter.acquire()
+        response = self.session.request(method, f"{self.base_url}{path}", timeout=REQUEST_TIMEOUT, **kwargs)
+        self._read_credits(response.headers)
+        return response
+
+    def _read_credits(self, headers):
+        test_value = headers.get('Zamzar-Test-Credits-Remaining')
+        live_value = headers.get('Zamzar-Credits-Remaining')
+        value = (test_value or live_value) if self.test_mode else (live_value or test_value)
+        if value is not None:
+            try:
+                self.credits_remaining = int(value)
+            except ValueError:
+                pass
+
+    def account(self):
+        response = self._request('GET', '/account')
+        if response.status_code != 200:
+            raise ConversionError(f"Could not read the Zamzar account (HTTP {response.status_code}).")
+        account = _json(response)
+        field = 'test_credits_remaining' if self.test_mode else 'credits_remaining'
+        if field in account:
+            self.credits_remaining = account[field]
+        return account
+
+    def remaining_credits(self):
+        # Credits left on the account, from the last response or a fresh account lookup
+        if self.credits_remaining is None:
+            self.account()
+        return self.credits_remaining
+
+    def start_job(self, file_name, source_path, target_format='pdf'):
+        with MultipartUpload({'target_format': target_format}, 'source_file', file_name, source_path) as body:
+            response = self._request('POST', '/jobs', data=body, headers={'Content-Type': body.content_type})
+        if response.status_code != 201:
+            raise ConversionError(f"Error starting conversion job for {file_name}.")
+        job_id = _json(response).get('id')
+        if job_id is None:
+            raise ConversionError(f"Zamzar did not return a job id for {file_name}.")
+        return job_id
+
+    def check_job(self, file_name, job_id):
+        # Returns (job_status, retry_after). job_status is None when the answer was
+        # transient (rate limited, 5xx, or a 200 that is not JSON) and the job
+        # should be polled again. Any other error status fails the job at once.
+        response = self._request('GET', f"/jobs/{job_id}")
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        if response.status_code == 429 or response.status_code >= 500:
+            return None, retry_after
+        if response.status_code != 200:
+            raise ConversionError(f"Error checking the conversion job for {file_name} (HTTP {response.status_code}).")
+        try:
+            job_status = response.json()
+        except ValueError:
+            return None, retry_after
+        if not isinstance(job_status, dict) or 'status' not in job_status:
+            raise ConversionError(f"Zamzar sent an unexpected status for the conversion job for {file_name}.")
+        if job_status['status'] == 'failed':
+            raise ConversionError(f"The conversion job for {file_name} failed.")
+        return job_status, retry_after
+
+    def download_target(self, file_name, job_status, output_path):
+        try:
+            target_file_id = job_status['target_files'][0]['id']
+        except (KeyError, IndexError, TypeError):
+            raise ConversionError(f"Zamzar did not return a converted file for {file_name}.") from None
+        with self._request('GET', f"/files/{target_file_id}/content", stream=True) as response:
+            if response.status_code != 200:
+                raise ConversionError(f"Failed to download the converted PDF for {file_name}.")
+            with open(output_path, 'wb') as pdf_file:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    if chunk:
+                        pdf_file.write(chunk)
+        return output_path
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(api_key, base_url=ZAMZAR_API_URL):
+    # One pooled client per API key, shared by every batch and session in the process
+    with _clients_lock:
+        client = _clients.get((api_key, base_url))
+        if client is None:
+            client = _clients[(api_key, base_url)] = ZamzarClient(api_key, base_url)
+        return client
+
+
+def convert_file(client, file_name, source_path, output_path, target_format='pdf', policy=None):
+    results = convert_files(
+        client, [(file_name, file_name, source_path, output_path)],
+        target_format=target_format, policy=policy
+    )
+    return results[file_name]
+
+
+def _timed(function, *args):
+    start = time.monotonic()
+    result = function(*args)
+    return result, time.monotonic() - start
+
+
+def convert_files(client, jobs, target_format='pdf', max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                  policy=None, on_complete=None, stats=None, submitted=None, on_submitted=None):
+    # Convert many files at once. `jobs` is a list of (key, file_name, source_path, output_path)
+    # tuples; every job is submitted up front and at most `max_concurrency` uploads
+    # and downloads run at the same time. A single timer loop in the calling thread
+    # polls every submitted job according to `policy`.
+    #
+    # `on_complete(key, output_path)` is called from the calling thread as each job
+    # finishes, so it is safe to update the UI from it. If `stats` is a dict it is
+    # filled with a polling.JobStats per key, including upload and download times
+    # and bytes transferred. Returns a dict mapping each key to its
+    # output path; ordering is left to the caller.
+    #
+    # `on_submitted(key, job_id)` is called as soon as a job has been created, so
+    # the caller can persist it. Jobs whose key is in `submitted` (key -> Zamzar
+    # job id) are not uploaded again; polling picks up where it left off.
+    results = {}
+    errors = []
+    failed = []
+    if not jobs:
+        return results
+
+    scheduler = PollScheduler(policy)
+    if stats is not None:
+        scheduler.stats = stats
+    source_paths = {key: source_path for key, _, source_path, _ in jobs}
+    submitted = submitted or {}
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(jobs)))) as executor:
+        running = {
+            executor.submit(_timed, client.start_job, file_name, source_path, target_format):
+                ('upload', key, file_name, output_path)
+            for key, file_name, source_path, output_path in jobs if key not in submitted
+        }
+        for key, file_name, _, output_path in jobs:
+            if key in submitted:
+                scheduler.add(key, (file_name, submitted[key], output_path))
+
+        while running or len(scheduler):
+            # Sleep until either an upload/download finishes or the next poll is due
+            timeout = scheduler.time_until_next()
+            if running:
+                done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            else:
+                time.sleep(timeout or 0)
+                done = ()
+
+            for future in done:
+                stage, key, file_name, output_path = running.pop(future)
+                try:
+                    result, elapsed = future.result()
+                except ConversionError as e:
+                    errors.append(str(e))
+                    failed.append(key)
+                    continue
+                except requests.RequestException as e:
+                    errors.append(f"Network error while converting {file_name}: {e}")
+                    failed.append(key)
+                    continue
+                if stage == 'upload':
+                    if on_submitted is not None:
+                        on_submitted(key, result)
+                    scheduler.add(key, (file_name, result, output_path))
+                    scheduler.stats[key].upload_time = elapsed
+                    scheduler.stats[key].bytes_sent = os.path.getsize(source_paths[key])
+                else:
+                    scheduler.stats[key].download_time = elapsed
+                    scheduler.stats[key].bytes_received = os.path.getsize(result)
+                    results[key] = result
+                    if on_complete is not None:
+                        on_complete(key, result)
+
+            for key, job in scheduler.pop_due():
+                file_name, job_id, output_path = job
+                try:
+                    job_status, retry_after = client.check_job(file_name, job_id)
+                except ConversionError as e:
+                    scheduler.finish(key, 'failed')
+                    errors.append(str(e))
+                    failed.append(key)
+                    continue
+                except requests.RequestException:
+                    job_status, retry_after = None, None
+
+                if job_status is not None and job_status.get('status') == 'successful':
+                    scheduler.finish(key, 'successful')
+                    future = executor.submit(_timed, client.download_target, file_name, job_status, output_path)
+                    running[future] = ('download', key, file_name, output_path)
+                elif not scheduler.reschedule(key, job, retry_after, transient=job_status is None):
+                    errors.append(
+                        f"The conversion job for {file_name} did not finish within "
+                        f"{scheduler.policy.deadline:.0f} seconds."
+                    )
+                    failed.append(key)
+
+    # Jobs that did succeed have already been reported, so they are not lost
+    if errors:
+        raise ConversionError(' '.join(errors), failed)
+    return results